@@ -15,6 +15,10 @@ cp "${SSH_PRIVKEY_FILE}" "${SSH_ID_FILE}"
 chmod 600 "${SSH_ID_FILE}"
 chown "${TARGET_USER}:root" "${SSH_ID_FILE}"
 
+# Create the directory for persistent agent state.
+mkdir -p "${STATE_DIR}"
+chown "${TARGET_USER}:root" "${STATE_DIR}"
+
 # Switch away from root for increased security.
 su "${TARGET_USER}"
 
@@ -27,5 +31,6 @@ rds-agent \
     --ssh-option="-i ${SSH_ID_FILE}" \
     --restic-arg="--password-file=${RESTIC_REPO_PASSWORD_FILE}" \
     --listen="localhost:5555" \
+    --state-dir="${STATE_DIR}" \
     ${EXTRA_ARGS} \
     "${BACKUP_PATH}"
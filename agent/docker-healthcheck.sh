@@ -0,0 +1,21 @@
+#!/bin/sh
+
+# Check the status file written by rds-agent. The container is unhealthy if
+# the file is missing, if it hasn't been updated within HEALTHCHECK_MAX_AGE
+# seconds or if any backup has failed or is stale.
+
+STATUS_FILE="${STATUS_FILE:-${STATE_DIR}/status}"
+
+exec awk \
+    -v now="$(date +%s)" \
+    -v max_age="${HEALTHCHECK_MAX_AGE:-60}" '
+    $1 == "updated" { updated = $2 }
+    $1 == "failed" || $1 == "stale" { bad += $2 }
+    $1 == "service" { print $2 ": " toupper($3) }
+    END {
+        if (now - updated > max_age) {
+            print "Status file not updated for " now - updated "s."
+            exit 1
+        }
+        exit bad > 0
+    }' "${STATUS_FILE}"
@@ -0,0 +1,141 @@
+"""Worker pool for running backup jobs."""
+
+import logging
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Dict, Optional
+
+from restic_docker_swarm_agent._internal import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BackupExecutor:
+    """A worker pool for running backup jobs concurrently.
+
+    Each job is identified by a key, eg. a service ID. A job is not
+    accepted if a job with the same key is still queued or running.
+    Jobs which start later than miss_threshold seconds after their
+    scheduled time are reported as late.
+    """
+
+    def __init__(self, max_jobs: int, miss_threshold: float):
+        """Initialize a BackupExecutor.
+
+        :param int max_jobs: The maximum number of concurrent jobs.
+        :param float miss_threshold: The number of seconds a job may start
+            late before it's reported as late.
+        """
+
+        self.pool = ThreadPoolExecutor(max_workers=max_jobs)
+        self.miss_threshold = miss_threshold
+
+        self.active = set()
+        self.lock = threading.Lock()
+        self.counters = {
+            "max_jobs": max_jobs,
+            "submitted": 0,
+            "completed": 0,
+            "missed": 0,
+            "late": 0,
+            "last_lag": None,
+            "max_lag": 0.0
+        }
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Get a copy of the executor counters.
+
+        :return: The counters as a dict.
+        :rtype: Dict[str, Any]
+        """
+
+        with self.lock:
+            stats = self.counters.copy()
+            stats["active"] = len(self.active)
+
+        return stats
+
+    def submit(
+        self,
+        key: str,
+        scheduled: Optional[float],
+        func: Callable[..., Any],
+        *args
+    ) -> Optional[Future]:
+        """Submit a job to the worker pool.
+
+        :param str key: A key identifying the job.
+        :param Optional[float] scheduled: The scheduled start time of the job
+            as a timestamp or None if the job wasn't scheduled.
+        :param Callable[..., Any] func: The function to run.
+
+        All varargs are passed to func.
+
+        :return: A Future of the job or None if a job with the same key
+            is still queued or running.
+        :rtype: Optional[Future]
+        """
+
+        with self.lock:
+            if key in self.active:
+                self.counters["missed"] += 1
+                return None
+
+            self.active.add(key)
+            self.counters["submitted"] += 1
+
+        return self.pool.submit(self.run_job, key, scheduled, func, *args)
+
+    def run_job(
+        self,
+        key: str,
+        scheduled: Optional[float],
+        func: Callable[..., Any],
+        *args
+    ) -> Any:
+        """Run a job in a worker thread.
+
+        :param str key: A key identifying the job.
+        :param Optional[float] scheduled: The scheduled start time.
+        :param Callable[..., Any] func: The function to run.
+
+        :return: The return value of func.
+        :rtype: Any
+        """
+
+        try:
+            if scheduled is not None:
+                self.report_lag(key, time.time() - scheduled)
+
+            return func(*args)
+        except Exception:
+            logger.exception("Unhandled exception in job %s.", key)
+            raise
+        finally:
+            with self.lock:
+                self.active.discard(key)
+                self.counters["completed"] += 1
+
+    def report_lag(self, key: str, lag: float) -> None:
+        """Record the start lag of a job.
+
+        :param str key: A key identifying the job.
+        :param float lag: The number of seconds the job started late.
+        """
+
+        metrics.SCHEDULE_LAG.observe(lag)
+
+        with self.lock:
+            self.counters["last_lag"] = lag
+            self.counters["max_lag"] = max(self.counters["max_lag"], lag)
+            if lag > self.miss_threshold:
+                self.counters["late"] += 1
+
+        if lag > self.miss_threshold:
+            logger.warning(
+                "Job %s started %.1f seconds later than scheduled.",
+                key,
+                lag
+            )
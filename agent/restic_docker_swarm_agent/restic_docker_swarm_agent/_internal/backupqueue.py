@@ -0,0 +1,269 @@
+"""An indexed queue of scheduled events."""
+
+import heapq
+import itertools
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set
+
+
+class ScheduledEvent:  # pylint: disable=too-few-public-methods
+    """An event in a BackupQueue."""
+
+    def __init__(
+        self,
+        ts: float,
+        priority: int,
+        action: Callable[..., Any],
+        kwargs: Dict[str, Any],
+        key: Optional[Hashable]
+    ):
+        """Initialize a ScheduledEvent.
+
+        :param float ts: The time of the event as a timestamp.
+        :param int priority: The priority of the event. Events with the
+            same time are run in the order of their priority.
+        :param Callable[..., Any] action: The function to run.
+        :param Dict[str, Any] kwargs: Keyword arguments passed to action.
+        :param Optional[Hashable] key: The key of the event in the index.
+        """
+
+        self.time = ts
+        self.priority = priority
+        self.action = action
+        self.kwargs = kwargs
+        self.key = key
+        self.cancelled = False
+
+
+class BackupQueue:
+    """A priority queue of scheduled events with an index by key.
+
+    This works like sched.scheduler but events can be looked up by
+    a key, eg. a service ID, in constant time. At most one pending
+    event can exist per key. Cancelled events are only marked as
+    cancelled and they are dropped once they reach the head of the
+    queue or when the queue is compacted.
+    """
+
+    def __init__(self):
+        """Initialize a BackupQueue."""
+
+        self.heap = []
+        self.index = {}
+        self.cancelled = 0
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Get the number of pending events."""
+
+        with self.lock:
+            return len(self.heap) - self.cancelled
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Get statistics about the queue.
+
+        :return: A dict with the number of pending, indexed and
+            cancelled events.
+        :rtype: Dict[str, int]
+        """
+
+        with self.lock:
+            return {
+                "pending": len(self.heap) - self.cancelled,
+                "indexed": len(self.index),
+                "cancelled": self.cancelled
+            }
+
+    def enterabs(
+        self,
+        ts: float,
+        priority: int,
+        action: Callable[..., Any],
+        kwargs: Optional[Dict[str, Any]] = None,
+        key: Optional[Hashable] = None
+    ) -> ScheduledEvent:
+        """Schedule an event at an absolute time.
+
+        If an event with the same key is already pending, it's cancelled.
+
+        :param float ts: The time of the event as a timestamp.
+        :param int priority: The priority of the event.
+        :param Callable[..., Any] action: The function to run.
+        :param Optional[Dict[str, Any]] kwargs: Keyword arguments passed
+            to action.
+        :param Optional[Hashable] key: An optional key for indexing the event.
+
+        :return: The scheduled event.
+        :rtype: ScheduledEvent
+        """
+
+        ev = ScheduledEvent(ts, priority, action, kwargs or {}, key)
+
+        with self.lock:
+            if key is not None:
+                self._cancel(self.index.get(key))
+                self.index[key] = ev
+
+            heapq.heappush(self.heap, (ts, priority, next(self.counter), ev))
+
+        return ev
+
+    def enter(
+        self,
+        delay: float,
+        priority: int,
+        action: Callable[..., Any],
+        kwargs: Optional[Dict[str, Any]] = None,
+        key: Optional[Hashable] = None
+    ) -> ScheduledEvent:
+        """Schedule an event after a delay.
+
+        :param float delay: The delay in seconds.
+        :param int priority: The priority of the event.
+        :param Callable[..., Any] action: The function to run.
+        :param Optional[Dict[str, Any]] kwargs: Keyword arguments passed
+            to action.
+        :param Optional[Hashable] key: An optional key for indexing the event.
+
+        :return: The scheduled event.
+        :rtype: ScheduledEvent
+        """
+
+        return self.enterabs(
+            time.time() + delay,
+            priority,
+            action,
+            kwargs,
+            key
+        )
+
+    def get(self, key: Hashable) -> Optional[ScheduledEvent]:
+        """Get the pending event of a key.
+
+        :param Hashable key: The key of the event.
+
+        :return: The event or None if no event is pending for the key.
+        :rtype: Optional[ScheduledEvent]
+        """
+
+        with self.lock:
+            return self.index.get(key)
+
+    def events(self) -> List[ScheduledEvent]:
+        """Get all pending events in the order they are run.
+
+        :return: A list of events.
+        :rtype: List[ScheduledEvent]
+        """
+
+        with self.lock:
+            return [x[3] for x in sorted(self.heap) if not x[3].cancelled]
+
+    def keys(self) -> Set[Hashable]:
+        """Get the keys of all indexed pending events.
+
+        :return: A set of keys.
+        :rtype: Set[Hashable]
+        """
+
+        with self.lock:
+            return set(self.index)
+
+    def cancel(self, key: Hashable) -> bool:
+        """Cancel the pending event of a key.
+
+        :param Hashable key: The key of the event.
+
+        :return: True if an event was cancelled, False otherwise.
+        :rtype: bool
+        """
+
+        with self.lock:
+            return self._cancel(self.index.get(key))
+
+    def _cancel(self, ev: Optional[ScheduledEvent]) -> bool:
+        """Mark an event as cancelled. The lock must be held by the caller.
+
+        :param Optional[ScheduledEvent] ev: The event to cancel.
+
+        :return: True if an event was cancelled, False otherwise.
+        :rtype: bool
+        """
+
+        if ev is None or ev.cancelled:
+            return False
+
+        ev.cancelled = True
+        self.cancelled += 1
+        if ev.key is not None and self.index.get(ev.key) is ev:
+            del self.index[ev.key]
+
+        # Drop cancelled events once they make up most of the heap.
+        if self.cancelled > len(self.heap) // 2:
+            self.heap = [x for x in self.heap if not x[3].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+        return True
+
+    def pop_due(self, now: float) -> Optional[ScheduledEvent]:
+        """Remove and return the next event if it's due.
+
+        :param float now: The current time as a timestamp.
+
+        :return: The event or None if no event is due.
+        :rtype: Optional[ScheduledEvent]
+        """
+
+        with self.lock:
+            self._drop_cancelled()
+            if not self.heap or self.heap[0][0] > now:
+                return None
+
+            ev = heapq.heappop(self.heap)[3]
+            if ev.key is not None and self.index.get(ev.key) is ev:
+                del self.index[ev.key]
+            return ev
+
+    def _drop_cancelled(self) -> None:
+        """Drop cancelled events from the head of the queue.
+
+        The lock must be held by the caller.
+        """
+
+        while self.heap and self.heap[0][3].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+
+    def next_time(self) -> Optional[float]:
+        """Get the time of the next pending event.
+
+        :return: The time as a timestamp or None if the queue is empty.
+        :rtype: Optional[float]
+        """
+
+        with self.lock:
+            self._drop_cancelled()
+            return self.heap[0][0] if self.heap else None
+
+    def run(self) -> Optional[float]:
+        """Run all due events without blocking.
+
+        :return: The number of seconds until the next pending event or
+            None if the queue is empty.
+        :rtype: Optional[float]
+        """
+
+        while True:
+            now = time.time()
+            ev = self.pop_due(now)
+            if ev is None:
+                break
+
+            ev.action(**ev.kwargs)
+
+        ts = self.next_time()
+        return None if ts is None else max(0.0, ts - time.time())
@@ -1,49 +1,122 @@
 """Backup scheduler class."""
 
 import logging
+import sqlite3
 import time
-import sched
 from datetime import datetime
-from typing import Callable, Dict
+from typing import Any, Callable, Dict, List, Optional
 import threading
 
-import pause
 from croniter import croniter
-from croniter import CroniterBadCronError
-from docker.errors import NotFound
 from docker.models.services import Service
 from docker.client import DockerClient
 
+from restic_docker_swarm_agent._internal.backupexecutor import \
+    BackupExecutor
+from restic_docker_swarm_agent._internal.backupqueue import BackupQueue
+from restic_docker_swarm_agent._internal.loadspreader import LoadSpreader
+from restic_docker_swarm_agent._internal.servicebackupconfig import \
+    ServiceBackupConfig, ServiceConfigCache
 from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+from restic_docker_swarm_agent._internal.statusfile import StatusFile
+from restic_docker_swarm_agent._internal.historystore import HistoryStore
+from restic_docker_swarm_agent._internal.shardcoordinator import \
+    ShardCoordinator
+from restic_docker_swarm_agent._internal.retrypolicy import RetryPolicy
+from restic_docker_swarm_agent._internal import metrics
+from restic_docker_swarm_agent._internal.servicewatcher import \
+    ServiceWatcher
 
 logger = logging.getLogger(__name__)
 
 
-class BackupScheduler:
+# pylint: disable=too-many-public-methods
+class BackupScheduler:  # pylint: disable=too-many-instance-attributes
     """Backup scheduler class."""
 
     SCHED_INTERVAL = 10
     SCHED_PRIORITY = 5
+    STATUS_INTERVAL = 10
+    STATUS_PRIORITY = 6
     BACKUP_PRIORITY = 10
+    MAINTENANCE_PRIORITY = 15
 
     def __init__(
         self,
         docker_client: DockerClient,
-        backup_func: Callable[[Service], None]
+        backup_func: Callable[[Service, ServiceBackupConfig], bool],
+        *,
+        watcher: Optional[ServiceWatcher] = None,
+        executor: Optional[BackupExecutor] = None,
+        spreader: Optional[LoadSpreader] = None,
+        status_file: Optional[StatusFile] = None,
+        history: Optional[HistoryStore] = None,
+        coordinator: Optional[ShardCoordinator] = None,
+        maintenance_func: Optional[
+            Callable[[Service, ServiceBackupConfig, float], bool]
+        ] = None,
+        maintenance_at: Optional[str] = None,
+        retry_policy: Optional[RetryPolicy] = None
     ):
         """Initialize a BackupScheduler.
 
         :param DockerClient docker_client: The DockerClient to use.
-        :param Callable[[Service], None] backup_func: The backup method to use.
-            This should accept the Service to backup as the only argument.
+        :param Callable[[Service, ServiceBackupConfig], bool] backup_func:
+            The backup method to use. This should accept the Service to
+            backup and its parsed config and return the backup status,
+            eg. a BackupResult.
+        :param ServiceWatcher watcher: An optional ServiceWatcher to use for
+            discovering services. If this is None, services are polled using
+            services.list() every SCHED_INTERVAL seconds.
+        :param BackupExecutor executor: The BackupExecutor used for running
+            backups. If this is None, backups are run one at a time.
+        :param LoadSpreader spreader: An optional LoadSpreader used for
+            spreading backups scheduled at the same time.
+        :param StatusFile status_file: An optional StatusFile which is
+            updated every STATUS_INTERVAL seconds.
+        :param HistoryStore history: An optional HistoryStore where
+            finished backup jobs are recorded. The backup status is
+            restored from it on startup.
+        :param ShardCoordinator coordinator: An optional ShardCoordinator.
+            If this is given, only services owned by this agent are
+            backed up.
+        :param Callable[[Service, ServiceBackupConfig, float], bool]
+            maintenance_func: The repository maintenance method to use.
+            This should accept the Service, its parsed config and the
+            scheduled time of the job and return the maintenance status.
+            If this is None, no maintenance jobs are scheduled.
+        :param Optional[str] maintenance_at: The default cron expression
+            of maintenance jobs for services which don't set their own.
+        :param RetryPolicy retry_policy: An optional RetryPolicy. If this
+            is given, failed backups are rescheduled according to it.
         """
 
         self.docker_client = docker_client
         self.backup_func = backup_func
-        self.backup_sched = sched.scheduler(time.time, pause.seconds)
+        self.watcher = watcher
+        self.executor = executor or BackupExecutor(1, 60)
+        self.spreader = spreader
+        self.status_file = status_file
+        self.history = history
+        self.coordinator = coordinator
+        self.maintenance_func = maintenance_func
+        self.maintenance_at = maintenance_at
+        self.retry_policy = retry_policy
+        self.maintenance_executor = BackupExecutor(
+            1,
+            self.executor.miss_threshold
+        )
+        self.configs = ServiceConfigCache()
+        self.latest = {}
+        self.backup_sched = BackupQueue()
+        self.wakeup = threading.Event()
+        self.rescan = threading.Event()
 
         self.internal_status = {}
+        self.last_success = {}
+        self.first_seen = {}
         self.internal_status_lock = threading.Lock()
+        self.stats_providers = {}
 
     @property
     def status(self) -> Dict[str, bool]:
@@ -63,73 +136,504 @@ class BackupScheduler:
 
         return status
 
-    def do_backup(self, service: Service) -> None:
+    def health(self) -> List[Dict[str, Any]]:
+        """Get the backup health of all current services.
+
+        :return: A list of dicts with the ID, name, last backup status
+            (None if not backed up yet), last success timestamp and the
+            time the service was first seen by the scheduler.
+        :rtype: List[Dict[str, Any]]
+        """
+
+        services = self.latest
+
+        with self.internal_status_lock:
+            return [
+                {
+                    "id": sid,
+                    "name": s.name,
+                    "status": self.internal_status.get(sid),
+                    "last_success": self.last_success.get(sid),
+                    "since": self.first_seen.get(sid, time.time())
+                }
+                for sid, s in services.items()
+            ]
+
+    @property
+    def stats(self) -> Dict[str, dict]:
+        """Get statistics about the scheduler.
+
+        :return: A dict of statistics dicts.
+        :rtype: Dict[str, dict]
+        """
+
+        if self.watcher is not None:
+            discovery = self.watcher.stats
+        else:
+            discovery = {"mode": "poll"}
+
+        stats = {
+            "discovery": discovery,
+            "executor": self.executor.stats,
+            "maintenance_executor": self.maintenance_executor.stats,
+            "queue": self.backup_sched.stats,
+            "configs": self.configs.stats
+        }
+        for name, provider in self.stats_providers.items():
+            stats[name] = provider()
+
+        return stats
+
+    def query_stats(self, name: str) -> Any:
+        """Get statistics from a single registered provider.
+
+        :param str name: The name of the statistics.
+
+        :return: The statistics or None if no such provider exists.
+        :rtype: Any
+        """
+
+        provider = self.stats_providers.get(name)
+        return None if provider is None else provider()
+
+    def register_stats(self, name: str, provider: Callable[[], Any]) -> None:
+        """Register a function which provides statistics.
+
+        The return value of the function is included in the dict
+        returned by the stats property under the given name.
+
+        :param str name: The name of the statistics.
+        :param Callable[[], Any] provider: The function which returns the
+            statistics. This must be thread-safe.
+        """
+
+        self.stats_providers[name] = provider
+
+    def notify(self) -> None:
+        """Wake up the scheduler to rescan services immediately.
+
+        This method is thread-safe and is meant to be called eg. by
+        a ServiceWatcher when the set of backup services changes.
+        """
+
+        self.rescan.set()
+        self.wakeup.set()
+
+    def services(self) -> List[Service]:
+        """Get all services which should be backed up.
+
+        :return: A list of Service objects.
+        :rtype: List[Service]
+        """
+
+        if self.watcher is not None:
+            services = self.watcher.services()
+        else:
+            with metrics.DOCKER_API_DURATION.time(call="services.list"):
+                services = self.docker_client.services.list()
+            services = [s for s in services if ResticUtils.service_backup(s)]
+
+        # Leave services owned by other agent replicas to them.
+        if self.coordinator is not None:
+            services = [s for s in services if self.coordinator.owns(s.id)]
+
+        return services
+
+    def do_backup(
+        self,
+        config: ServiceBackupConfig,
+        scheduled: Optional[float] = None,
+        attempt: int = 0
+    ) -> None:
+        """Submit a backup of a service to the BackupExecutor.
+
+        :param ServiceBackupConfig config: The config of the service.
+        :param Optional[float] scheduled: The scheduled time of the backup.
+        :param int attempt: The number of retries of the backup so far.
+        """
+
+        if self.executor.submit(
+            config.service_id,
+            scheduled,
+            self.run_backup,
+            config.service_id,
+            attempt
+        ) is None:
+            logger.warning(
+                "Previous backup of %s is still running. Skipping backup.",
+                config.name
+            )
+
+    def current_service(self, service_id: str, job: str) -> Optional[Service]:
+        """Get the latest version of a service before running a job.
+
+        :param str service_id: The ID of the service.
+        :param str job: The kind of the job for log messages.
+
+        :return: The service or None if it's gone or owned by another
+            agent.
+        :rtype: Optional[Service]
+        """
+
+        # Use the latest known version of the service. The watcher cache
+        # is kept up-to-date by Docker events and in polling mode the
+        # services are listed every SCHED_INTERVAL seconds, so there's
+        # no need to query the Docker API again.
+        if self.watcher is not None:
+            service = self.watcher.get(service_id)
+        else:
+            service = self.latest.get(service_id)
+
+        if service is None:
+            logger.error("Service %s removed before %s.", service_id, job)
+            return None
+
+        if self.coordinator is not None and \
+                not self.coordinator.owns(service_id):
+            logger.info(
+                "Service %s moved to another agent. Skipping %s.",
+                service.name,
+                job
+            )
+            return None
+
+        return service
+
+    def run_backup(self, service_id: str, attempt: int = 0) -> None:
         """Take a new backup of a service.
 
-        :param Service service: The service to backup,
+        This method is run in a BackupExecutor worker thread.
+
+        :param str service_id: The ID of the service to backup.
+        :param int attempt: The number of retries of the backup so far.
         """
 
-        # Reload the service to make sure backup labels are up-to-date.
-        tmp = None
-        try:
-            tmp = self.docker_client.services.get(service.id)
-        except NotFound:
-            logger.error("Service %s removed before backup.", service.name)
+        service = self.current_service(service_id, "backup")
+        if service is None:
             return
 
         # Backup the service if it should still be backed up.
-        if ResticUtils.service_backup(tmp):
-            logger.info("Backing up %s", tmp.name)
-            tmp_status = self.backup_func(tmp)
+        config = self.configs.get(service)
+        if config.enabled:
+            logger.info("Backing up %s", service.name)
+            start = time.monotonic()
+            started = time.time()
+            status = self.backup_func(service, config)
+
+            if self.spreader is not None:
+                self.spreader.record(service.id, time.monotonic() - start)
+
+            if self.history is not None:
+                self.history.record(
+                    service.name,
+                    service.id,
+                    None,
+                    started,
+                    "done" if status else "failed"
+                )
 
             with self.internal_status_lock:
-                self.internal_status[tmp.id] = tmp_status
+                self.internal_status[service.id] = bool(status)
+                if status:
+                    self.last_success[service.id] = time.time()
 
-    def schedule_backups(self) -> None:
-        """Schedule backups based on Service labels."""
+            if self.retry_policy is not None and \
+                    self.retry_policy.should_retry(status, attempt):
+                self.schedule_retry(config, attempt + 1)
 
-        for s in self.docker_client.services.list():
-            if not ResticUtils.service_backup(s):
-                continue
+    def schedule_retry(
+        self,
+        config: ServiceBackupConfig,
+        attempt: int
+    ) -> None:
+        """Schedule a retry of a failed backup.
+
+        The retry replaces the next regular backup of the service in the
+        queue. It isn't scheduled if it wouldn't run before the next
+        regular backup, which is scheduled again after the retry. The
+        next regular backup runs at the offset chosen by the LoadSpreader
+        from the start of its cron slot.
+
+        :param ServiceBackupConfig config: The config of the service.
+        :param int attempt: The number of the retry starting from 1.
+        """
+
+        ts = time.time() + self.retry_policy.delay(attempt - 1)
+        next_run = None
+        if config.run_at is not None:
+            next_run = croniter(
+                config.run_at,
+                datetime.now().astimezone()
+            ).get_next(float)
+            if self.spreader is not None:
+                next_run += self.spreader.offset(config.service_id)
+
+        if next_run is None or ts >= next_run:
+            logger.info(
+                "Not retrying backup of %s before its next run.",
+                config.name
+            )
+            return
+
+        logger.warning(
+            "Retrying backup of %s on %s (%s/%s).",
+            config.name,
+            datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S"),
+            attempt,
+            self.retry_policy.retries
+        )
+        self.backup_sched.enterabs(
+            ts,
+            BackupScheduler.BACKUP_PRIORITY,
+            self.do_backup,
+            {"config": config, "scheduled": ts, "attempt": attempt},
+            key=config.service_id
+        )
+
+        # The scheduler may be waiting for a later event.
+        self.wakeup.set()
+
+    def scan_services(self) -> None:
+        """Schedule backups for services which have none scheduled.
+
+        Pending backups are rescheduled if the rds.backup.at label of
+        a service has changed and cancelled if the service is gone.
+        """
+
+        services = self.services()
+        self.latest = {s.id: s for s in services}
+        self.configs.retain(self.latest)
+
+        now = time.time()
+        with self.internal_status_lock:
+            self.first_seen = {
+                sid: self.first_seen.get(sid, now) for sid in self.latest
+            }
+
+        for s in services:
+            config = self.configs.get(s)
 
             # Check whether a backup is already scheduled for the service.
-            skip = False
-            for ev in self.backup_sched.queue:
-                if ev.kwargs["service"].id == s.id:
-                    skip = True
+            ev = self.backup_sched.get(s.id)
+            if ev is not None:
+                if ev.kwargs["config"].run_at == config.run_at:
+                    logger.debug("Backup already scheduled for %s.", s.name)
+                    continue
+
+                logger.info("Backup schedule of %s changed.", s.name)
+                self.backup_sched.cancel(s.id)
+
+            self.schedule_service(config)
 
-            if skip:
-                logger.debug("Backup already scheduled for %s.", s.name)
+        for s in services:
+            config = self.configs.get(s)
+            self.schedule_service_maintenance(
+                s.id,
+                s.name,
+                config.maintenance_at or self.maintenance_at
+            )
+
+        # Cancel pending jobs of services which are gone.
+        for key in self.backup_sched.keys():
+            if isinstance(key, tuple):
+                if key[1] not in self.latest:
+                    self.backup_sched.cancel(key)
                 continue
 
-            # Schedule a new backup.
-            run_at = ResticUtils.service_backup_at(s)
-            if run_at is not None:
-                try:
-                    criter = croniter(run_at, datetime.now().astimezone())
-                except CroniterBadCronError as e:
-                    logger.error(e)
-                    continue
+            if key not in self.latest:
+                logger.info("Cancelling backup of removed service %s.", key)
+                self.backup_sched.cancel(key)
+                if self.spreader is not None:
+                    self.spreader.release(key)
 
-                ts = criter.get_next(float)
-                logger.info(
-                    "Scheduling backup for service %s on %s.",
-                    s.name,
-                    datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
-                )
-                self.backup_sched.enterabs(
-                    ts,
-                    BackupScheduler.BACKUP_PRIORITY,
-                    self.do_backup,
-                    [],
-                    {"service": s}
-                )
-            else:
-                logger.warning(
-                    "Cron expression '%s' for service %s is invalid.",
-                    run_at,
-                    s.name
-                )
+    def schedule_service(self, config: ServiceBackupConfig) -> None:
+        """Schedule the next backup of a service.
+
+        Services with an invalid cron expression are not scheduled.
+        The error is logged once when the config is parsed.
+
+        :param ServiceBackupConfig config: The config of the service.
+        """
+
+        if config.run_at is None:
+            return
+
+        criter = croniter(config.run_at, datetime.now().astimezone())
+        ts = criter.get_next(float)
+
+        # Spread backups in the same slot without overlapping the next slot.
+        if self.spreader is not None:
+            ts += self.spreader.place(
+                config.service_id,
+                ts,
+                criter.get_next(float) - ts
+            )
+
+        logger.info(
+            "Scheduling backup for service %s on %s.",
+            config.name,
+            datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+        )
+        self.backup_sched.enterabs(
+            ts,
+            BackupScheduler.BACKUP_PRIORITY,
+            self.do_backup,
+            {"config": config, "scheduled": ts},
+            key=config.service_id
+        )
+
+    def timeline(self, hours: float = 24) -> List[Dict[str, Any]]:
+        """Get the planned backups for the next hours.
+
+        The first backup of each service is the one currently scheduled,
+        which may be a retry of a failed backup. Later backups are
+        predicted from the cron expression using the current spreading
+        offset of the service.
+
+        :param float hours: The length of the timeline in hours.
+
+        :return: A list of planned backups sorted by time.
+        :rtype: List[Dict[str, Any]]
+        """
+
+        end = time.time() + hours * 3600
+        ret = []
+
+        for ev in self.backup_sched.events():
+            config = ev.kwargs.get("config")
+            if config is None or ev.time > end:
+                continue
+
+            offset = 0.0
+            duration = None
+            if self.spreader is not None:
+                offset = self.spreader.offset(config.service_id)
+                duration = self.spreader.duration(config.service_id) or None
+
+            # A retry replaces the backup in the next cron slot until it
+            # has run, so the regular backups continue after it.
+            attempt = ev.kwargs.get("attempt", 0)
+            start = ev.time if attempt else ev.time - offset
+            criter = croniter(
+                config.run_at,
+                datetime.fromtimestamp(start).astimezone()
+            )
+            ts = ev.time
+            while ts <= end:
+                ret.append({
+                    "service": config.name,
+                    "id": config.service_id,
+                    "time": ts,
+                    "slot": None if attempt else ts - offset,
+                    "duration": duration,
+                    "attempt": attempt
+                })
+                attempt = 0
+                ts = criter.get_next(float) + offset
+
+        return sorted(ret, key=lambda x: x["time"])
+
+    def schedule_service_maintenance(
+        self,
+        service_id: str,
+        name: str,
+        run_at: Optional[str]
+    ) -> None:
+        """Schedule the next maintenance job of a service.
+
+        A pending job is kept if its cron expression hasn't changed.
+
+        :param str service_id: The ID of the service.
+        :param str name: The name of the service.
+        :param Optional[str] run_at: The cron expression of the job or
+            None to cancel pending jobs.
+        """
+
+        key = ("maintenance", service_id)
+        ev = self.backup_sched.get(key)
+
+        if self.maintenance_func is None or run_at is None:
+            if ev is not None:
+                self.backup_sched.cancel(key)
+            return
+
+        if ev is not None and ev.kwargs["run_at"] == run_at:
+            return
+
+        ts = croniter(run_at, datetime.now().astimezone()).get_next(float)
+        logger.info(
+            "Scheduling maintenance for service %s on %s.",
+            name,
+            datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+        )
+        self.backup_sched.enterabs(
+            ts,
+            BackupScheduler.MAINTENANCE_PRIORITY,
+            self.do_maintenance,
+            {
+                "service_id": service_id,
+                "name": name,
+                "run_at": run_at,
+                "scheduled": ts
+            },
+            key=key
+        )
+
+    def do_maintenance(
+        self,
+        service_id: str,
+        name: str,
+        run_at: str,
+        scheduled: float
+    ) -> None:
+        """Submit a maintenance job to the maintenance executor.
+
+        Maintenance jobs run one at a time in their own executor so
+        that they never take a worker from backups.
+
+        :param str service_id: The ID of the service.
+        :param str name: The name of the service.
+        :param str run_at: The cron expression of the job.
+        :param float scheduled: The scheduled time of the job.
+        """
+
+        if self.maintenance_executor.submit(
+            "maintenance-{}".format(service_id),
+            scheduled,
+            self.run_maintenance,
+            service_id,
+            scheduled
+        ) is None:
+            logger.warning(
+                "Previous maintenance of %s is still running.",
+                name
+            )
+
+        self.schedule_service_maintenance(service_id, name, run_at)
+
+    def run_maintenance(self, service_id: str, scheduled: float) -> None:
+        """Run a maintenance job of a service.
+
+        This method is run in a BackupExecutor worker thread.
+
+        :param str service_id: The ID of the service.
+        :param float scheduled: The scheduled time of the job.
+        """
+
+        service = self.current_service(service_id, "maintenance")
+        if service is None:
+            return
+
+        config = self.configs.get(service)
+        if config.enabled:
+            logger.info("Running maintenance of %s.", service.name)
+            if not self.maintenance_func(service, config, scheduled):
+                logger.error("Maintenance of %s failed.", service.name)
+
+    def schedule_backups(self) -> None:
+        """Schedule backups based on Service labels."""
+
+        self.scan_services()
 
         # Schedule new backups periodically.
         self.backup_sched.enter(
@@ -138,9 +642,98 @@ class BackupScheduler:
             self.schedule_backups
         )
 
+    def restore_status(self) -> None:
+        """Restore the backup status of services from the history."""
+
+        try:
+            jobs = self.history.latest_jobs()
+            last_success = self.history.last_success()
+        except sqlite3.Error as e:
+            logger.error("Failed to restore the backup status: %s", e)
+            return
+
+        with self.internal_status_lock:
+            for job in jobs:
+                sid = job["service_id"]
+                self.internal_status.setdefault(sid, job["result"] == "done")
+                if job["service"] in last_success:
+                    self.last_success.setdefault(
+                        sid,
+                        last_success[job["service"]]
+                    )
+
+        logger.info("Restored the backup status of %s services.", len(jobs))
+
+    def last_runs(
+        self,
+        limit: int = 20,
+        service: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Get the latest backup runs from the history.
+
+        :param int limit: The maximum number of runs to return.
+        :param Optional[str] service: Only return runs of this service.
+
+        :return: A list of runs, latest first. The list is empty if
+            no history is kept.
+        :rtype: List[Dict[str, Any]]
+        """
+
+        if self.history is None:
+            return []
+
+        return self.history.last_runs(limit, service)
+
+    def since_last_success(self) -> Dict[str, float]:
+        """Get the time since the last successful backup of each service.
+
+        :return: A dict of service name -> seconds.
+        :rtype: Dict[str, float]
+        """
+
+        now = time.time()
+        if self.history is not None:
+            last = self.history.last_success()
+        else:
+            with self.internal_status_lock:
+                last = {
+                    self.latest[sid].name: ts
+                    for sid, ts in self.last_success.items()
+                    if sid in self.latest
+                }
+
+        return {name: now - ts for name, ts in last.items()}
+
+    def write_status(self) -> None:
+        """Write the status file and schedule the next write."""
+
+        try:
+            self.status_file.write(self.health())
+        except OSError as e:
+            logger.error("Failed to write the status file: %s", e)
+
+        self.backup_sched.enter(
+            BackupScheduler.STATUS_INTERVAL,
+            BackupScheduler.STATUS_PRIORITY,
+            self.write_status
+        )
+
     def run(self) -> None:
         """Run the backup scheduler."""
 
         logger.info("Starting the backup scheduling thread.")
+        if self.history is not None:
+            self.restore_status()
         self.schedule_backups()
-        self.backup_sched.run()
+        if self.status_file is not None:
+            self.write_status()
+
+        while True:
+            delay = self.backup_sched.run()
+
+            # Rescan services immediately if notify() was called.
+            if self.wakeup.wait(delay):
+                self.wakeup.clear()
+                if self.rescan.is_set():
+                    self.rescan.clear()
+                    self.scan_services()
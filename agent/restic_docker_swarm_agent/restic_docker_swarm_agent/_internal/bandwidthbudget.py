@@ -0,0 +1,217 @@
+"""Sharing of upload bandwidth between restic processes."""
+
+import re
+import itertools
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+class BandwidthBudget:  # pylint: disable=too-many-instance-attributes
+    """Split a global upload bandwidth cap between restic processes.
+
+    The cap can depend on the time of day. Restic can't change the
+    limit of a running process, so the share of each process is
+    computed when it starts from the part of the current cap which
+    isn't allocated to running processes. That part is split evenly
+    between the new process and the running ones, so a process which
+    uploads alone gets the whole cap. A process waits instead of
+    starting with less than its share of the cap when the maximum
+    number of processes upload at the same time.
+    """
+
+    IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+    POLL_INTERVAL = 60
+
+    def __init__(
+        self,
+        limit: Optional[int] = None,
+        schedule: Optional[List[Tuple[int, int, int]]] = None,
+        nice: Optional[int] = None,
+        ionice: Optional[str] = None,
+        slots: int = 1
+    ):
+        """Initialize a BandwidthBudget.
+
+        :param Optional[int] limit: The upload cap in KiB/s used outside
+            the scheduled windows. None or 0 means unlimited.
+        :param Optional[List[Tuple[int, int, int]]] schedule: A list of
+            time-of-day windows as returned by parse_schedule().
+        :param Optional[int] nice: The niceness of restic processes.
+        :param Optional[str] ionice: The I/O scheduling class of restic
+            processes: 'realtime', 'best-effort' or 'idle'.
+        :param int slots: The maximum number of restic processes which
+            upload at the same time. A process never starts with less
+            than the cap divided by this.
+        """
+
+        self.limit = limit
+        self.schedule = schedule or []
+        self.nice = nice
+        self.ionice = ionice
+        self.slots = max(1, slots)
+
+        self.active = {}
+        self.counter = itertools.count()
+        self.waits = 0
+        self.cond = threading.Condition()
+
+    @staticmethod
+    def parse_schedule(spec: str) -> List[Tuple[int, int, int]]:
+        """Parse a bandwidth schedule string.
+
+        The expected format is a comma separated list of windows
+
+        HH:MM-HH:MM=KIB
+
+        where KIB is the upload cap in KiB/s during the window and 0
+        means unlimited. A window may wrap around midnight.
+
+        :param str spec: The schedule string to parse.
+
+        :return: A list of (start minute, end minute, KiB/s) tuples.
+        :rtype: List[Tuple[int, int, int]]
+
+        :raises ValueError: If the schedule string is invalid.
+        """
+
+        ret = []
+        for part in [x.strip() for x in spec.split(",") if x.strip()]:
+            match = re.fullmatch(
+                r"(\d\d?):(\d\d)-(\d\d?):(\d\d)=(\d+)",
+                part
+            )
+            if match is None:
+                raise ValueError(
+                    "Invalid bandwidth schedule '{}'. Expected: "
+                    "'HH:MM-HH:MM=KIB[,...]'.".format(part)
+                )
+
+            h1, m1, h2, m2, kib = [int(x) for x in match.groups()]
+            if h1 > 23 or m1 > 59 or m2 > 59 or h2 * 60 + m2 > 24 * 60:
+                raise ValueError("Invalid time in '{}'.".format(part))
+
+            ret.append((h1 * 60 + m1, h2 * 60 + m2, kib))
+
+        return ret
+
+    def cap(self, now: Optional[datetime] = None) -> Optional[int]:
+        """Get the upload cap at a time of day.
+
+        :param Optional[datetime] now: The time. Defaults to the current
+            local time.
+
+        :return: The cap in KiB/s or None if uploads are unlimited.
+        :rtype: Optional[int]
+        """
+
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+
+        limit = self.limit
+        for start, end, kib in self.schedule:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                inside = minute >= start or minute < end
+
+            if inside:
+                limit = kib
+                break
+
+        return limit or None
+
+    def prefix(self) -> List[str]:
+        """Get the nice and ionice command prefix for restic processes.
+
+        :return: The command prefix as an argv list.
+        :rtype: List[str]
+        """
+
+        ret = []
+        if self.ionice is not None:
+            ret.extend([
+                "ionice",
+                "-c", str(BandwidthBudget.IONICE_CLASSES[self.ionice])
+            ])
+        if self.nice is not None:
+            ret.extend(["nice", "-n", str(self.nice)])
+
+        return ret
+
+    def share(self, cap: Optional[int]) -> Optional[int]:
+        """Get the share of a new process. The condition must be held.
+
+        :param Optional[int] cap: The current cap in KiB/s.
+
+        :return: The share in KiB/s, None if uploads are unlimited or 0
+            if the process has to wait.
+        :rtype: Optional[int]
+        """
+
+        if cap is None:
+            return None
+
+        remaining = cap - sum(x for x in self.active.values() if x is not None)
+        share = max(remaining, 0) // (len(self.active) + 1)
+        return share if share >= max(cap // self.slots, 1) else 0
+
+    @contextmanager
+    def allocate(self, upload: bool = True) -> Iterator[List[str]]:
+        """Allocate a share of the upload cap for a restic process.
+
+        If the share would be too small, this waits until a running
+        process finishes or the cap changes. The share is released when
+        the context exits, ie. when the process has finished.
+
+        :param bool upload: False if the process doesn't write to the
+            repository. Such processes are neither limited nor counted.
+
+        :return: The restic arguments for limiting the process.
+        :rtype: Iterator[List[str]]
+        """
+
+        if not upload:
+            yield []
+            return
+
+        token = next(self.counter)
+
+        with self.cond:
+            share = self.share(self.cap())
+            if share == 0:
+                self.waits += 1
+            while share == 0:
+                self.cond.wait(BandwidthBudget.POLL_INTERVAL)
+                share = self.share(self.cap())
+
+            self.active[token] = share
+
+        try:
+            yield [] if share is None else ["--limit-upload", str(share)]
+        finally:
+            with self.cond:
+                del self.active[token]
+                self.cond.notify_all()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Get the current bandwidth allocation.
+
+        :return: A dict with the current cap, the number of running
+            processes, the allocated bandwidth in KiB/s and the number of
+            times a process waited for its share.
+        :rtype: Dict[str, Any]
+        """
+
+        cap = self.cap()
+        with self.cond:
+            return {
+                "cap": cap,
+                "processes": len(self.active),
+                "allocated": sum(
+                    x for x in self.active.values() if x is not None
+                ),
+                "waits": self.waits
+            }
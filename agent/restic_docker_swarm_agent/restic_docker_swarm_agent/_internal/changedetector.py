@@ -0,0 +1,190 @@
+"""Change detection of backup directories."""
+
+import os
+import time
+import hashlib
+import logging
+from typing import List, Optional, Tuple
+
+from restic_docker_swarm_agent._internal.statefile import StateFile
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeDetector:
+    """Detect whether a backup directory changed since the last backup.
+
+    The fingerprint of a directory is a digest of the path, inode,
+    mode, size, modification time and change time of every file and
+    directory in the tree. Fingerprints are stored per repository after
+    successful backups and are keyed by the full repository address.
+    Services sharing a repository are additionally keyed by their
+    snapshot tag.
+    """
+
+    FILENAME = "fingerprints.json"
+
+    def __init__(self, state_dir: Optional[str]):
+        """Initialize a ChangeDetector.
+
+        :param Optional[str] state_dir: The directory where the fingerprints
+            are stored. If this is None, they are only kept in memory.
+        """
+
+        path = None
+        if state_dir is not None:
+            path = os.path.join(state_dir, ChangeDetector.FILENAME)
+
+        self.state = StateFile(path)
+
+    @staticmethod
+    def fingerprint(path: str) -> str:
+        """Compute the fingerprint of a directory tree.
+
+        Symlinks are not followed. Entries which disappear while the
+        tree is walked are ignored.
+
+        :param str path: The root of the directory tree.
+
+        :return: The fingerprint as a hex string.
+        :rtype: str
+
+        :raises OSError: If the root directory can't be read.
+        """
+
+        digest = hashlib.sha256()
+        st = os.lstat(path)
+        digest.update("{} {} {} {} {}\n".format(
+            st.st_ino,
+            st.st_mode,
+            st.st_size,
+            st.st_mtime_ns,
+            st.st_ctime_ns
+        ).encode("utf-8"))
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                full = os.path.join(root, name)
+                try:
+                    st = os.lstat(full)
+                except FileNotFoundError:
+                    continue
+
+                digest.update("{} {} {} {} {} {}\n".format(
+                    os.path.relpath(full, path),
+                    st.st_ino,
+                    st.st_mode,
+                    st.st_size,
+                    st.st_mtime_ns,
+                    st.st_ctime_ns
+                ).encode("utf-8", "surrogateescape"))
+
+        return digest.hexdigest()
+
+    @classmethod
+    def fingerprint_paths(cls, paths: List[str]) -> str:
+        """Compute a combined fingerprint of multiple directory trees.
+
+        The fingerprint of a single directory is the same as the one
+        returned by fingerprint().
+
+        :param List[str] paths: The roots of the directory trees.
+
+        :return: The fingerprint as a hex string.
+        :rtype: str
+
+        :raises OSError: If a root directory can't be read.
+        """
+
+        if len(paths) == 1:
+            return cls.fingerprint(paths[0])
+
+        digest = hashlib.sha256()
+        for path in sorted(paths):
+            digest.update("{} {}\n".format(
+                path,
+                cls.fingerprint(path)
+            ).encode("utf-8", "surrogateescape"))
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(host: str, repo: str, tag: Optional[str] = None) -> str:
+        """Get the key of a fingerprint in the state file.
+
+        :param str host: The SFTP host.
+        :param str repo: The repository path.
+        :param Optional[str] tag: The snapshot tag of a service sharing
+            the repository.
+
+        :return: The key.
+        :rtype: str
+        """
+
+        key = ResticUtils.full_repo(host, repo)
+        return key if tag is None else "{}#{}".format(key, tag)
+
+    def check(
+        self,
+        host: str,
+        repo: str,
+        paths: List[str],
+        full_interval: Optional[float] = None,
+        tag: Optional[str] = None
+    ) -> Tuple[bool, Optional[str]]:
+        """Check whether a repository needs to be backed up.
+
+        :param str host: The SFTP host.
+        :param str repo: The repository path.
+        :param List[str] paths: The directories which are backed up to the
+            repository.
+        :param Optional[float] full_interval: Force a backup if the last
+            backup is older than this many seconds.
+        :param Optional[str] tag: The snapshot tag of a service sharing
+            the repository.
+
+        :return: A tuple of a bool which is True if the directory changed
+            or a backup is forced and the current fingerprint. The
+            fingerprint is None if it couldn't be computed.
+        :rtype: Tuple[bool, Optional[str]]
+        """
+
+        try:
+            fingerprint = self.fingerprint_paths(paths)
+        except OSError as e:
+            logger.warning("Failed to fingerprint %s: %s", repo, e)
+            return True, None
+
+        last = self.state.get(self.key(host, repo, tag))
+        if last is None or last.get("fingerprint") != fingerprint:
+            return True, fingerprint
+
+        if full_interval is not None and \
+                time.time() - last.get("backed_up", 0) >= full_interval:
+            logger.info("Forcing a periodic full backup of %s.", repo)
+            return True, fingerprint
+
+        return False, fingerprint
+
+    def record(
+        self,
+        host: str,
+        repo: str,
+        fingerprint: str,
+        tag: Optional[str] = None
+    ) -> None:
+        """Store the fingerprint of a successfully backed up repository.
+
+        :param str host: The SFTP host.
+        :param str repo: The repository path.
+        :param str fingerprint: The fingerprint computed before the backup.
+        :param Optional[str] tag: The snapshot tag of a service sharing
+            the repository.
+        """
+
+        self.state.set(
+            self.key(host, repo, tag),
+            {"fingerprint": fingerprint, "backed_up": time.time()}
+        )
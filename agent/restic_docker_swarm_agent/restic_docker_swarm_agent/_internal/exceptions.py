@@ -13,5 +13,13 @@ class SwarmException(Exception):
     """Exception class for errors in managing a Docker Swarm."""
 
 
+class HookException(SwarmException):
+    """Exception class for hook commands which fail or time out."""
+
+
+class ConfigException(SwarmException):
+    """Exception class for swarm states which need an administrator."""
+
+
 class MissingDependencyException(Exception):
     """Error class for indicating missing dependencies."""
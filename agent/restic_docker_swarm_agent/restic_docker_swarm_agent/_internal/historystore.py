@@ -0,0 +1,233 @@
+"""Persistent history of backup runs."""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryStore:
+    """A bounded history of backup runs stored in SQLite.
+
+    A run is recorded for each repository of a backup job and one for
+    the whole job with the repository set to None. Only the latest
+    'retention' runs of each service and repository are kept and runs
+    older than 'max_age' seconds are dropped. The database is opened
+    on first use.
+    """
+
+    FILENAME = "history.sqlite3"
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS runs ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " service TEXT NOT NULL,"
+        " service_id TEXT,"
+        " repo TEXT,"
+        " started REAL NOT NULL,"
+        " finished REAL NOT NULL,"
+        " result TEXT NOT NULL,"
+        " summary TEXT)",
+        "CREATE INDEX IF NOT EXISTS runs_key "
+        "ON runs (service, repo, id)",
+        "CREATE INDEX IF NOT EXISTS runs_finished ON runs (finished)"
+    )
+
+    def __init__(
+        self,
+        state_dir: Optional[str],
+        retention: int = 100,
+        max_age: Optional[float] = None
+    ):
+        """Initialize a HistoryStore.
+
+        :param Optional[str] state_dir: The directory of the database. If
+            this is None, the history is only kept in memory.
+        :param int retention: The number of runs to keep per service
+            and repository.
+        :param Optional[float] max_age: Drop runs older than this many
+            seconds. None keeps runs until they exceed the retention.
+        """
+
+        self.path = ":memory:"
+        if state_dir is not None:
+            self.path = os.path.join(state_dir, HistoryStore.FILENAME)
+
+        self.retention = retention
+        self.max_age = max_age
+        self.db = None
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        """Open the database if it's not open yet. The lock must be held.
+
+        :return: The database connection.
+        :rtype: sqlite3.Connection
+        """
+
+        if self.db is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.row_factory = sqlite3.Row
+            self.db.execute("PRAGMA journal_mode=WAL")
+            with self.db:
+                for stmt in HistoryStore.SCHEMA:
+                    self.db.execute(stmt)
+
+        return self.db
+
+    def record(
+        self,
+        service: str,
+        service_id: Optional[str],
+        repo: Optional[str],
+        started: float,
+        result: str,
+        *,
+        summary: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """Record a finished run and drop runs beyond the retention.
+
+        Errors are logged and otherwise ignored.
+
+        :param str service: The name of the service.
+        :param Optional[str] service_id: The ID of the service.
+        :param Optional[str] repo: The repository or None for a whole job.
+        :param float started: The start time of the run as a timestamp.
+        :param str result: The result of the run, eg. 'done' or 'failed'.
+        :param Optional[Dict[str, Any]] summary: The restic summary message.
+        """
+
+        now = time.time()
+
+        try:
+            with self.lock:
+                db = self.connect()
+                with db:
+                    db.execute(
+                        "INSERT INTO runs (service, service_id, repo, "
+                        "started, finished, result, summary) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            service,
+                            service_id,
+                            repo,
+                            started,
+                            now,
+                            result,
+                            None if summary is None else json.dumps(summary)
+                        )
+                    )
+                    db.execute(
+                        "DELETE FROM runs WHERE service = ? AND repo IS ? "
+                        "AND id NOT IN (SELECT id FROM runs WHERE "
+                        "service = ? AND repo IS ? ORDER BY id DESC "
+                        "LIMIT ?)",
+                        (service, repo, service, repo, self.retention)
+                    )
+                    if self.max_age:
+                        db.execute(
+                            "DELETE FROM runs WHERE finished < ?",
+                            (now - self.max_age,)
+                        )
+        except sqlite3.Error as e:
+            logger.error("Failed to record backup history: %s", e)
+
+    @staticmethod
+    def as_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        """Convert a database row into a dict.
+
+        :param sqlite3.Row row: The row.
+
+        :return: The run as a dict.
+        :rtype: Dict[str, Any]
+        """
+
+        ret = dict(zip(row.keys(), row))
+        del ret["id"]
+        if ret["summary"] is not None:
+            ret["summary"] = json.loads(ret["summary"])
+
+        return ret
+
+    def last_runs(
+        self,
+        limit: int = 20,
+        service: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Get the latest runs.
+
+        :param int limit: The maximum number of runs to return.
+        :param Optional[str] service: Only return runs of this service.
+
+        :return: A list of runs as dicts, latest first.
+        :rtype: List[Dict[str, Any]]
+        """
+
+        query = "SELECT * FROM runs"
+        params = []
+        if service is not None:
+            query += " WHERE service = ?"
+            params.append(service)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+
+        with self.lock:
+            rows = self.connect().execute(query, params).fetchall()
+
+        return [self.as_dict(x) for x in rows]
+
+    def last_success(self) -> Dict[str, float]:
+        """Get the time of the latest successful job of each service.
+
+        :return: A dict of service name -> timestamp.
+        :rtype: Dict[str, float]
+        """
+
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT service, MAX(finished) FROM runs "
+                "WHERE repo IS NULL AND result = 'done' GROUP BY service"
+            ).fetchall()
+
+        return {x[0]: x[1] for x in rows}
+
+    def latest_jobs(self) -> List[Dict[str, Any]]:
+        """Get the latest job of each service ID.
+
+        This is used for restoring the backup status on startup.
+
+        :return: A list of runs as dicts.
+        :rtype: List[Dict[str, Any]]
+        """
+
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT * FROM runs WHERE id IN (SELECT MAX(id) FROM runs "
+                "WHERE repo IS NULL AND service_id IS NOT NULL "
+                "GROUP BY service_id)"
+            ).fetchall()
+
+        return [self.as_dict(x) for x in rows]
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Get statistics about the history.
+
+        :return: A dict with the number of stored runs and services.
+        :rtype: Dict[str, Any]
+        """
+
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT COUNT(*), COUNT(DISTINCT service) FROM runs"
+            ).fetchone()
+
+        return {"runs": row[0], "services": row[1], "path": self.path}
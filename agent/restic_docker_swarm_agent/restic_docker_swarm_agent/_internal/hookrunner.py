@@ -0,0 +1,350 @@
+"""Running backup hooks in service tasks."""
+
+import codecs
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+from docker.errors import APIError
+from docker.models.services import Service
+from docker.client import DockerClient
+
+from restic_docker_swarm_agent._internal.exceptions import \
+    SwarmException, HookException, ConfigException
+from restic_docker_swarm_agent._internal import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class HookRunner:
+    """Run hook commands in the tasks of a service.
+
+    Hooks can be run in a single task, in all tasks in parallel or in
+    a single task which preferably runs on the same node as the agent.
+    Output is logged line by line as it arrives or passed on as a stream.
+    Docker has no API for stopping an exec, so a hook which times out is
+    abandoned and it may keep running in the container.
+    """
+
+    MODES = ("single", "all", "local")
+
+    def __init__(
+        self,
+        docker_client: DockerClient,
+        timeout: Optional[float] = None
+    ):
+        """Initialize a HookRunner.
+
+        :param DockerClient docker_client: The DockerClient to use.
+        :param Optional[float] timeout: The default hook timeout in
+            seconds. None or 0 means no timeout.
+        """
+
+        self.docker_client = docker_client
+        self.timeout = timeout
+        self.local_node = None
+        self.lock = threading.Lock()
+
+    def node_id(self) -> Optional[str]:
+        """Get the swarm node ID of the node the agent runs on.
+
+        :return: The node ID or None if it can't be determined.
+        :rtype: Optional[str]
+        """
+
+        with self.lock:
+            if self.local_node is None:
+                try:
+                    with metrics.DOCKER_API_DURATION.time(call="info"):
+                        info = self.docker_client.info()
+                    self.local_node = (info.get("Swarm") or {}).get("NodeID")
+                except APIError as e:
+                    logger.warning("Failed to get the local node ID: %s", e)
+
+            return self.local_node
+
+    def select_tasks(self, service: Service, mode: str) -> List[dict]:
+        """Select the tasks of a service to run a hook in.
+
+        :param Service service: The service.
+        :param str mode: The hook mode: 'single', 'all' or 'local'.
+
+        :return: A list of task dicts.
+        :rtype: List[dict]
+
+        :raises ConfigException: If the service has no running tasks.
+        """
+
+        with metrics.DOCKER_API_DURATION.time(call="services.tasks"):
+            tasks = service.tasks(filters={"desired-state": "Running"})
+
+        tasks = [
+            t for t in tasks
+            if (t.get("Status") or {}).get("ContainerStatus", {})
+            .get("ContainerID")
+        ]
+        if len(tasks) == 0:
+            raise ConfigException(
+                "No running tasks in service {}. Unable to run command."
+                .format(service.name)
+            )
+
+        if mode == "all":
+            return tasks
+
+        if mode == "local":
+            node = self.node_id()
+            local = [t for t in tasks if t.get("NodeID") == node]
+            if local:
+                return local[:1]
+
+            logger.info(
+                "Service %s has no tasks on the local node.",
+                service.name
+            )
+
+        if len(tasks) > 1:
+            logger.info(
+                "Service %s has multiple tasks. Will only run "
+                "the requested command in one of them.",
+                service.name
+            )
+
+        return tasks[:1]
+
+    @staticmethod
+    def lines(chunks: Iterable[bytes]) -> Iterator[str]:
+        """Split a stream of output chunks into lines.
+
+        :param Iterable[bytes] chunks: The output chunks.
+
+        :return: An iterator of lines without line endings.
+        :rtype: Iterator[str]
+        """
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        buf = ""
+
+        for chunk in chunks:
+            buf += decoder.decode(chunk)
+            *complete, buf = buf.split("\n")
+            for line in complete:
+                yield line.rstrip("\r")
+
+        buf += decoder.decode(b"", final=True)
+        if buf:
+            yield buf.rstrip("\r")
+
+    def exec_task(
+        self,
+        service: Service,
+        task: dict,
+        cmd: str,
+        timeout: Optional[float],
+        sink: Optional[Callable[[bytes], None]] = None
+    ) -> None:
+        """Run a command in a single task and handle its output.
+
+        :param Service service: The service of the task.
+        :param dict task: The task dict.
+        :param str cmd: The command to run.
+        :param Optional[float] timeout: The timeout in seconds.
+        :param Optional[Callable[[bytes], None]] sink: A function which
+            is called with each chunk of stdout. Stderr is logged. If this
+            is None, both stdout and stderr are logged.
+
+        :raises HookException: If the command fails or times out.
+        :raises SwarmException: If the command can't be executed.
+        """
+
+        cid = task["Status"]["ContainerStatus"]["ContainerID"]
+        name = "{}.{}".format(service.name, task.get("Slot") or cid[:12])
+        api = self.docker_client.api
+
+        try:
+            exec_id = api.exec_create(cid, cmd)["Id"]
+            stream = api.exec_start(
+                exec_id,
+                stream=True,
+                demux=sink is not None
+            )
+        except APIError as e:
+            raise SwarmException(
+                "Failed to execute command in {}: {}".format(name, e)
+            ) from e
+
+        self.consume_output(name, stream, timeout, sink)
+
+        try:
+            exit_code = api.exec_inspect(exec_id).get("ExitCode")
+        except APIError as e:
+            raise SwarmException(
+                "Failed to inspect command in {}: {}".format(name, e)
+            ) from e
+
+        if exit_code != 0:
+            raise HookException(
+                "Command in {} failed with exit code {}."
+                .format(name, exit_code)
+            )
+
+    def consume_output(
+        self,
+        name: str,
+        stream: Iterator[Any],
+        timeout: Optional[float],
+        sink: Optional[Callable[[bytes], None]] = None
+    ) -> None:
+        """Consume the output of an exec until it exits or times out.
+
+        The output is read in a separate thread because a blocking read
+        from the exec stream can't be interrupted. On timeout the thread
+        is left to finish when the exec does but its output is dropped.
+
+        :param str name: The name of the task used in log messages.
+        :param Iterator[Any] stream: The output stream of the exec. It
+            yields (stdout, stderr) tuples if sink is given and chunks of
+            output otherwise.
+        :param Optional[float] timeout: The timeout in seconds.
+        :param Optional[Callable[[bytes], None]] sink: A function which
+            is called with each chunk of stdout.
+
+        :raises HookException: If the output can't be handled or the
+            timeout expires.
+        """
+
+        expired = threading.Event()
+        errors = []
+
+        def read():
+            try:
+                if sink is None:
+                    for line in self.lines(stream):
+                        if expired.is_set():
+                            return
+                        logger.info("Output from %s: %s", name, line)
+                    return
+
+                for out, err in stream:
+                    if expired.is_set():
+                        return
+                    if err:
+                        for line in err.decode("utf-8", "replace") \
+                                .splitlines():
+                            logger.info("Output from %s: %s", name, line)
+                    if out:
+                        sink(out)
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(e)
+
+        reader = threading.Thread(
+            target=read,
+            name="hook-{}".format(name),
+            daemon=True
+        )
+        reader.start()
+        reader.join(timeout or None)
+
+        if reader.is_alive():
+            expired.set()
+            raise HookException(
+                "Command in {} timed out after {}s.".format(name, timeout)
+            )
+
+        if errors:
+            raise HookException(
+                "Failed to handle output from {}: {}".format(name, errors[0])
+            ) from errors[0]
+
+    def stream(
+        self,
+        service: Service,
+        cmd: str,
+        sink: Callable[[bytes], None],
+        mode: str = "single",
+        timeout: Optional[float] = None
+    ) -> None:
+        """Run a command in one task of a service and pass on its stdout.
+
+        The sink is called in another thread. It may block, in which case
+        reading from the exec stops until it returns.
+
+        :param Service service: The Service to run the command in.
+        :param str cmd: The command to run.
+        :param Callable[[bytes], None] sink: A function which is called
+            with each chunk of stdout.
+        :param str mode: The hook mode. 'all' is treated like 'single'
+            since the output of a single task is streamed.
+        :param Optional[float] timeout: The timeout in seconds. Defaults
+            to the timeout of the HookRunner.
+
+        :raises HookException: If the command fails or times out.
+        :raises ConfigException: If the service has no running tasks.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        logger.info("Streaming from service %s: %s", service.name, cmd)
+        task = self.select_tasks(
+            service,
+            "single" if mode == "all" else mode
+        )[0]
+        self.exec_task(service, task, cmd, timeout, sink)
+
+    def run(
+        self,
+        service: Service,
+        cmd: str,
+        mode: str = "single",
+        timeout: Optional[float] = None
+    ) -> None:
+        """Run a command in the tasks of a service.
+
+        :param Service service: The Service to run the command in.
+        :param str cmd: The command to run.
+        :param str mode: The hook mode: 'single', 'all' or 'local'.
+        :param Optional[float] timeout: The timeout in seconds. Defaults
+            to the timeout of the HookRunner.
+
+        :raises HookException: If the command fails in any task.
+        :raises SwarmException: If the command can't be executed in a
+            task or the service has no running tasks.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        logger.info("Running in service %s (%s): %s", service.name, mode, cmd)
+        tasks = self.select_tasks(service, mode)
+
+        if len(tasks) == 1:
+            self.exec_task(service, tasks[0], cmd, timeout)
+            return
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+            futures = [
+                pool.submit(self.exec_task, service, t, cmd, timeout)
+                for t in tasks
+            ]
+            for f in futures:
+                try:
+                    f.result()
+                except SwarmException as e:
+                    logger.error(e)
+                    errors.append(e)
+
+        # Only report a hook failure if the command ran in all tasks.
+        if errors:
+            cls = SwarmException
+            if all(isinstance(e, HookException) for e in errors):
+                cls = HookException
+            raise cls(
+                "Command failed in {} of {} tasks of {}.".format(
+                    len(errors),
+                    len(tasks),
+                    service.name
+                )
+            )
@@ -0,0 +1,199 @@
+"""Spreading of backups which are scheduled at the same time."""
+
+import os
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from restic_docker_swarm_agent._internal.statefile import StateFile
+
+
+class LoadSpreader:
+    """Spread backups scheduled in the same cron slot over a time window.
+
+    By default each service gets a deterministic offset within the
+    window based on a hash of its ID. In cost-aware mode the offset is
+    chosen to minimize the overlap with other backups of the same slot
+    based on the historical backup durations of the services.
+    """
+
+    FILENAME = "durations.json"
+    SMOOTHING = 0.3
+
+    def __init__(
+        self,
+        window: float,
+        cost_aware: bool = False,
+        state_dir: Optional[str] = None
+    ):
+        """Initialize a LoadSpreader.
+
+        :param float window: The length of the spreading window in seconds.
+        :param bool cost_aware: Place backups based on their durations.
+        :param Optional[str] state_dir: The directory where the backup
+            durations are stored. If this is None, they are only kept
+            in memory.
+        """
+
+        self.window = window
+        self.cost_aware = cost_aware
+
+        path = None
+        if state_dir is not None:
+            path = os.path.join(state_dir, LoadSpreader.FILENAME)
+        self.durations = StateFile(path)
+
+        self.slots = {}
+        self.placements = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def jitter(key: str, window: float) -> float:
+        """Get the deterministic offset of a key within a window.
+
+        :param str key: The key, eg. a service ID.
+        :param float window: The length of the window in seconds.
+
+        :return: The offset in seconds.
+        :rtype: float
+        """
+
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return window * int(digest[:8], 16) / 0x100000000
+
+    def duration(self, key: str) -> float:
+        """Get the estimated backup duration of a key.
+
+        :param str key: The key, eg. a service ID.
+
+        :return: The duration in seconds or 0 if it's unknown.
+        :rtype: float
+        """
+
+        return self.durations.get(key, 0.0)
+
+    def record(self, key: str, duration: float) -> None:
+        """Record the duration of a finished backup.
+
+        The estimate is an exponentially weighted moving average.
+
+        :param str key: The key, eg. a service ID.
+        :param float duration: The duration of the backup in seconds.
+        """
+
+        last = self.durations.get(key)
+        if last is not None:
+            duration = last + LoadSpreader.SMOOTHING * (duration - last)
+        self.durations.set(key, duration)
+
+    def place(self, key: str, slot: float, limit: float) -> float:
+        """Choose the offset of a backup from the start of its cron slot.
+
+        Any previous placement of the key is released first.
+
+        :param str key: The key, eg. a service ID.
+        :param float slot: The cron slot as a timestamp.
+        :param float limit: The maximum offset, eg. the time until the next
+            cron slot of the service.
+
+        :return: The offset in seconds.
+        :rtype: float
+        """
+
+        window = max(0.0, min(self.window, limit))
+        preferred = self.jitter(key, window)
+        duration = self.duration(key) if self.cost_aware else 0.0
+
+        with self.lock:
+            self._release(key)
+            others = list(self.slots.get(slot, {}).values())
+
+            offset = preferred
+            if duration > 0 and others:
+                candidates = [preferred, 0.0]
+                candidates.extend(end for _, end in others if end < window)
+                offset = min(
+                    candidates,
+                    key=lambda c: (
+                        self.overlap(c, c + duration, others),
+                        abs(c - preferred)
+                    )
+                )
+
+            self.slots.setdefault(slot, {})[key] = (offset, offset + duration)
+            self.placements[key] = (slot, offset)
+
+        return offset
+
+    @staticmethod
+    def overlap(
+        start: float,
+        end: float,
+        others: List[Tuple[float, float]]
+    ) -> float:
+        """Get the total overlap of an interval with other intervals.
+
+        :param float start: The start of the interval.
+        :param float end: The end of the interval.
+        :param List[Tuple[float, float]] others: The other intervals.
+
+        :return: The total overlap in seconds.
+        :rtype: float
+        """
+
+        return sum(
+            max(0.0, min(end, e) - max(start, s)) for s, e in others
+        )
+
+    def offset(self, key: str) -> float:
+        """Get the current offset of a key.
+
+        :param str key: The key, eg. a service ID.
+
+        :return: The offset in seconds or 0 if the key isn't placed.
+        :rtype: float
+        """
+
+        with self.lock:
+            return self.placements.get(key, (None, 0.0))[1]
+
+    def release(self, key: str) -> None:
+        """Release the placement of a key.
+
+        :param str key: The key, eg. a service ID.
+        """
+
+        with self.lock:
+            self._release(key)
+
+    def _release(self, key: str) -> None:
+        """Release the placement of a key. The lock must be held.
+
+        :param str key: The key, eg. a service ID.
+        """
+
+        placement = self.placements.pop(key, None)
+        if placement is None:
+            return
+
+        slot = self.slots.get(placement[0], {})
+        slot.pop(key, None)
+        if not slot:
+            self.slots.pop(placement[0], None)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Get statistics about the spreading.
+
+        :return: A dict with the window, the number of placed backups
+            and the number of distinct cron slots.
+        :rtype: Dict[str, Any]
+        """
+
+        with self.lock:
+            return {
+                "window": self.window,
+                "cost_aware": self.cost_aware,
+                "placed": len(self.placements),
+                "slots": len(self.slots)
+            }
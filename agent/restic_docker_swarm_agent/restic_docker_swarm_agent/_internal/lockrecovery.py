@@ -0,0 +1,360 @@
+"""Detection and removal of stale restic locks."""
+
+import os
+import re
+import json
+import time
+import socket
+import logging
+import threading
+import subprocess
+from typing import Any, Callable, Dict, Optional, Set
+
+from docker.client import DockerClient
+from docker.errors import APIError, NotFound
+
+from restic_docker_swarm_agent._internal.statefile import StateFile
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+from restic_docker_swarm_agent._internal import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LockRecovery:
+    """Remove locks left behind by dead runs of the agent.
+
+    Each run of the agent is recorded in a journal with its hostname,
+    its container ID and the node it runs on. Restic only records the
+    hostname in a lock, so a lock is only attributed to a container if
+    the hostname is the short container ID, which is the default in
+    Docker. A lock is stale if it was created by a process of this
+    agent container which isn't running anymore or by a previous agent
+    container on the same node which has exited or been removed. Locks
+    of other hosts are never removed. Commands in repositories which
+    are still locked fail, and the backup is retried by the scheduler.
+    """
+
+    FILENAME = "runs.json"
+    MAX_RUNS = 20
+    CONTAINER_ID = re.compile(r"(?:/containers/|/docker[-/])([0-9a-f]{64})")
+
+    def __init__(self, docker_client: DockerClient, state_dir: Optional[str]):
+        """Initialize a LockRecovery.
+
+        :param DockerClient docker_client: The DockerClient to use.
+        :param Optional[str] state_dir: The directory of the run journal.
+            If this is None, the journal is only kept in memory and only
+            locks of this container can be recognized.
+        """
+
+        path = None
+        if state_dir is not None:
+            path = os.path.join(state_dir, LockRecovery.FILENAME)
+
+        self.docker_client = docker_client
+        self.journal = StateFile(path)
+        self.current = {
+            "host": socket.gethostname(),
+            "container": self.container_id(),
+            "node": None
+        }
+        self.lock = threading.Lock()
+        self.counters = {"locked": 0, "retries": 0, "removed": 0}
+
+    @classmethod
+    def container_id(cls) -> Optional[str]:
+        """Get the ID of the Docker container of the agent.
+
+        The ID is read from the mounts of the container, which include
+        the hostname file of the container, or from its cgroups.
+
+        :return: The full container ID or None if it can't be found.
+        :rtype: Optional[str]
+        """
+
+        for path in ("/proc/self/mountinfo", "/proc/self/cgroup"):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    match = cls.CONTAINER_ID.search(f.read())
+            except OSError:
+                continue
+
+            if match is not None:
+                return match.group(1)
+
+        return None
+
+    @staticmethod
+    def unique_host(run: Dict[str, Any]) -> bool:
+        """Check whether the hostname of a run identifies its container.
+
+        :param Dict[str, Any] run: The run as recorded in the journal.
+
+        :return: True if the hostname is the short container ID.
+        :rtype: bool
+        """
+
+        container = run.get("container")
+        return container is not None and container[:12] == run.get("host")
+
+    def register(self, node_id: Optional[str]) -> None:
+        """Record the current run in the journal.
+
+        :param Optional[str] node_id: The swarm node ID of the agent.
+        """
+
+        self.current = {
+            "host": socket.gethostname(),
+            "container": self.current["container"],
+            "pid": os.getpid(),
+            "node": node_id,
+            "started": time.time()
+        }
+        if not self.unique_host(self.current):
+            logger.warning(
+                "The hostname %s isn't the container ID of the agent. "
+                "Stale locks won't be removed.",
+                self.current["host"]
+            )
+
+        runs = self.journal.get("runs", [])
+        runs.append(self.current)
+        try:
+            self.journal.set("runs", runs[-LockRecovery.MAX_RUNS:])
+        except OSError as e:
+            logger.error("Failed to write the run journal: %s", e)
+
+    @staticmethod
+    def pid_alive(pid: int) -> bool:
+        """Check whether a process is running in this container.
+
+        :param int pid: The process ID.
+
+        :return: True if the process exists.
+        :rtype: bool
+        """
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+        return True
+
+    def container_alive(self, container: str) -> bool:
+        """Check whether a previous agent container is still running.
+
+        :param str container: The ID of the container from the journal.
+
+        :return: True if the container is running or its state is unknown.
+        :rtype: bool
+        """
+
+        try:
+            with metrics.DOCKER_API_DURATION.time(call="containers.inspect"):
+                attrs = self.docker_client.api.inspect_container(container)
+        except NotFound:
+            return False
+        except APIError as e:
+            logger.warning("Failed to inspect container %s: %s", container, e)
+            return True
+
+        return bool((attrs.get("State") or {}).get("Running"))
+
+    def is_stale(self, lock: Dict[str, Any]) -> bool:
+        """Check whether a lock was left behind by a dead agent run.
+
+        :param Dict[str, Any] lock: The lock as printed by 'restic cat lock'.
+
+        :return: True if the lock can be removed safely.
+        :rtype: bool
+        """
+
+        host = lock.get("hostname")
+        pid = lock.get("pid")
+
+        # Containers with an overridden hostname may share it.
+        if host == self.current["host"]:
+            return self.unique_host(self.current) and \
+                isinstance(pid, int) and not self.pid_alive(pid)
+
+        # Containers on other nodes can't be inspected from here.
+        runs = [
+            x for x in self.journal.get("runs", []) if x.get("host") == host
+        ]
+        if not runs or self.current["node"] is None or not all(
+            self.unique_host(x) and x.get("node") == self.current["node"]
+            for x in runs
+        ):
+            return False
+
+        return not any(
+            self.container_alive(x) for x in {y["container"] for y in runs}
+        )
+
+    @staticmethod
+    def list_locks(
+        repo: str,
+        run_restic: Callable[..., subprocess.CompletedProcess]
+    ) -> Set[str]:
+        """List the lock IDs of a repository.
+
+        :param str repo: The repository.
+        :param Callable[..., subprocess.CompletedProcess] run_restic: The
+            function used for running restic without retries.
+
+        :return: The IDs of the locks.
+        :rtype: Set[str]
+
+        :raises subprocess.CalledProcessError: If restic fails.
+        """
+
+        proc = run_restic(
+            repo,
+            False,
+            "--no-lock", "list", "locks",
+            capture=True
+        )
+        return set(proc.stdout.split())
+
+    def read_locks(
+        self,
+        repo: str,
+        run_restic: Callable[..., subprocess.CompletedProcess]
+    ) -> Dict[str, Dict[str, Any]]:
+        """Read the locks of a repository.
+
+        :param str repo: The repository.
+        :param Callable[..., subprocess.CompletedProcess] run_restic: The
+            function used for running restic without retries.
+
+        :return: A dict of lock ID -> lock as printed by 'restic cat lock'.
+        :rtype: Dict[str, Dict[str, Any]]
+
+        :raises subprocess.CalledProcessError: If restic fails.
+        :raises ValueError: If a lock can't be parsed.
+        """
+
+        ret = {}
+        for lock_id in self.list_locks(repo, run_restic):
+            proc = run_restic(
+                repo,
+                False,
+                "--no-lock", "cat", "lock", lock_id,
+                capture=True
+            )
+            ret[lock_id] = json.loads(proc.stdout)
+
+        return ret
+
+    def recover(
+        self,
+        repo: str,
+        run_restic: Callable[..., subprocess.CompletedProcess]
+    ) -> bool:
+        """Remove the locks of a repository if they're all stale.
+
+        Restic can only remove all locks at once, so nothing is removed
+        if any lock is held by a live process or another host. The lock
+        IDs are listed again right before the removal, and nothing is
+        removed if they have changed since the locks were checked.
+
+        :param str repo: The repository.
+        :param Callable[..., subprocess.CompletedProcess] run_restic: The
+            function used for running restic without retries.
+
+        :return: True if the repository isn't locked anymore.
+        :rtype: bool
+        """
+
+        with self.lock:
+            self.counters["locked"] += 1
+
+        try:
+            locks = self.read_locks(repo, run_restic)
+        except (subprocess.CalledProcessError, ValueError) as e:
+            logger.error("Failed to read the locks of %s: %s", repo, e)
+            return False
+
+        # The lock may have been released in the meantime.
+        if not locks:
+            return True
+
+        owners = ", ".join(
+            "PID {} on {}".format(x.get("pid"), x.get("hostname"))
+            for x in locks.values()
+        )
+        if not all(self.is_stale(x) for x in locks.values()):
+            logger.info("Repo %s is locked by %s.", repo, owners)
+            return False
+
+        logger.warning(
+            "Removing stale locks of %s left by %s.",
+            repo,
+            owners
+        )
+        try:
+            if self.list_locks(repo, run_restic) != set(locks):
+                logger.info("The locks of %s changed. Not removing.", repo)
+                return False
+
+            run_restic(repo, True, "unlock", "--remove-all")
+        except subprocess.CalledProcessError as e:
+            logger.error("Restic returned error code: %s", e.returncode)
+            return False
+
+        with self.lock:
+            self.counters["removed"] += len(locks)
+
+        return True
+
+    def retry(
+        self,
+        repo: str,
+        func: Callable[[], Any],
+        run_restic: Callable[..., subprocess.CompletedProcess]
+    ) -> Any:
+        """Call a function which runs restic and retry once if it's locked.
+
+        The function is only retried immediately if the stale locks of
+        the repository were removed. Otherwise the error is raised, so
+        that the backup is retried by the scheduler instead of blocking
+        a worker and the repository while waiting for the lock.
+
+        :param str repo: The repository.
+        :param Callable[[], Any] func: The function to call.
+        :param Callable[..., subprocess.CompletedProcess] run_restic: The
+            function used for running restic without retries.
+
+        :return: The return value of func.
+        :rtype: Any
+
+        :raises subprocess.CalledProcessError: If func fails for another
+            reason or the repository is still locked.
+        """
+
+        try:
+            return func()
+        except subprocess.CalledProcessError as e:
+            if not ResticUtils.is_lock_error(e.stderr) or \
+                    not self.recover(repo, run_restic):
+                raise
+
+        with self.lock:
+            self.counters["retries"] += 1
+
+        logger.info("Retrying the command in %s without stale locks.", repo)
+        return func()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Get the lock recovery counters.
+
+        :return: The counters as a dict.
+        :rtype: Dict[str, int]
+        """
+
+        with self.lock:
+            return self.counters.copy()
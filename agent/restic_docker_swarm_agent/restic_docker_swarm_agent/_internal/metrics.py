@@ -0,0 +1,369 @@
+"""Prometheus metrics in the text exposition format."""
+
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+
+class MetricsRegistry:
+    """A collection of metrics which can be rendered as text."""
+
+    def __init__(self):
+        """Initialize a MetricsRegistry."""
+
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric: "Metric") -> None:
+        """Add a metric to the registry.
+
+        :param Metric metric: The metric to add.
+        """
+
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format.
+
+        :return: The metrics as a string.
+        :rtype: str
+        """
+
+        with self.lock:
+            metrics = list(self.metrics)
+
+        lines = []
+        for m in metrics:
+            lines.extend(m.render())
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+class Metric:
+    """Base class for metrics with labels."""
+
+    TYPE = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: MetricsRegistry = REGISTRY
+    ):
+        """Initialize a Metric.
+
+        :param str name: The name of the metric.
+        :param str documentation: A help text for the metric.
+        :param Sequence[str] labelnames: The names of the metric labels.
+        :param MetricsRegistry registry: The registry to add the metric to.
+        """
+
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+        registry.register(self)
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        """Build a value key from label values.
+
+        :param Dict[str, str] labels: The label values.
+
+        :return: The label values in the order of labelnames.
+        :rtype: Tuple[str, ...]
+
+        :raises ValueError: If the labels don't match labelnames.
+        """
+
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                "Invalid labels for metric {}: {}".format(
+                    self.name,
+                    ", ".join(sorted(labels))
+                )
+            )
+
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    @staticmethod
+    def format_labels(pairs: Sequence[Tuple[str, str]]) -> str:
+        """Format label name-value pairs.
+
+        :param Sequence[Tuple[str, str]] pairs: The label pairs.
+
+        :return: The formatted labels including braces or an empty string.
+        :rtype: str
+        """
+
+        if not pairs:
+            return ""
+
+        escaped = [
+            '{}="{}"'.format(
+                n,
+                v.replace("\\", "\\\\").replace("\n", "\\n").replace(
+                    '"', '\\"'
+                )
+            )
+            for n, v in pairs
+        ]
+        return "{" + ",".join(escaped) + "}"
+
+    def samples(self) -> List[Tuple[str, Sequence[Tuple[str, str]], float]]:
+        """Get the samples of the metric.
+
+        :return: A list of (suffix, label pairs, value) tuples.
+        :rtype: List[Tuple[str, Sequence[Tuple[str, str]], float]]
+        """
+
+        with self.lock:
+            return [
+                ("", list(zip(self.labelnames, k)), v)
+                for k, v in sorted(self.values.items())
+            ]
+
+    def render(self) -> List[str]:
+        """Render the metric in the Prometheus text exposition format.
+
+        :return: A list of lines.
+        :rtype: List[str]
+        """
+
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.TYPE)
+        ]
+        for suffix, pairs, value in self.samples():
+            lines.append(
+                "{}{}{} {}".format(
+                    self.name,
+                    suffix,
+                    self.format_labels(pairs),
+                    repr(float(value))
+                )
+            )
+
+        return lines
+
+
+class Counter(Metric):
+    """A monotonically increasing counter."""
+
+    TYPE = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """Increment the counter.
+
+        :param float amount: The amount to increment by.
+        """
+
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    """A value which can go up and down."""
+
+    TYPE = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        """Set the value of the gauge.
+
+        :param float value: The new value.
+        """
+
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """A histogram of observed values."""
+
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (
+        0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 14400
+    )
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry: MetricsRegistry = REGISTRY
+    ):
+        """Initialize a Histogram.
+
+        :param str name: The name of the metric.
+        :param str documentation: A help text for the metric.
+        :param Sequence[str] labelnames: The names of the metric labels.
+        :param Sequence[float] buckets: The upper bounds of the buckets.
+        :param MetricsRegistry registry: The registry to add the metric to.
+        """
+
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        """Observe a value.
+
+        :param float value: The observed value.
+        """
+
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0.0,
+                    "count": 0
+                }
+
+            data = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data["buckets"][i] += 1
+            data["sum"] += value
+            data["count"] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the duration of a block of code in seconds."""
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self) -> List[Tuple[str, Sequence[Tuple[str, str]], float]]:
+        """Get the samples of the histogram.
+
+        :return: A list of (suffix, label pairs, value) tuples.
+        :rtype: List[Tuple[str, Sequence[Tuple[str, str]], float]]
+        """
+
+        ret = []
+        with self.lock:
+            for k, data in sorted(self.values.items()):
+                pairs = list(zip(self.labelnames, k))
+                for bound, count in zip(self.buckets, data["buckets"]):
+                    le = ("le", repr(float(bound)))
+                    ret.append(("_bucket", pairs + [le], count))
+                le = ("le", "+Inf")
+                ret.append(("_bucket", pairs + [le], data["count"]))
+                ret.append(("_sum", pairs, data["sum"]))
+                ret.append(("_count", pairs, data["count"]))
+
+        return ret
+
+
+BACKUPS = Counter(
+    "rds_backups_total",
+    "Number of service backups by result.",
+    ["service", "result"]
+)
+BACKUP_DURATION = Histogram(
+    "rds_backup_duration_seconds",
+    "Duration of service backups including hooks.",
+    ["service"]
+)
+REPO_BACKUP_DURATION = Histogram(
+    "rds_repo_backup_duration_seconds",
+    "Duration of 'restic backup' per repository.",
+    ["service", "repo"]
+)
+PHASE_DURATION = Histogram(
+    "rds_restic_phase_duration_seconds",
+    "Duration of restic phases (init, backup, forget, prune, check).",
+    ["phase"]
+)
+HOOK_DURATION = Histogram(
+    "rds_hook_duration_seconds",
+    "Duration of pre- and post-backup hooks.",
+    ["service", "hook"]
+)
+SCHEDULE_LAG = Histogram(
+    "rds_schedule_lag_seconds",
+    "Delay between the scheduled and actual start time of jobs.",
+    buckets=(0.1, 1, 5, 10, 30, 60, 300, 900, 3600)
+)
+DOCKER_API_DURATION = Histogram(
+    "rds_docker_api_duration_seconds",
+    "Latency of Docker API calls.",
+    ["call"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+)
+BYTES_ADDED = Counter(
+    "rds_backup_bytes_added_total",
+    "Bytes added to repositories by backups.",
+    ["service", "repo"]
+)
+BYTES_PROCESSED = Counter(
+    "rds_backup_bytes_processed_total",
+    "Bytes processed by backups.",
+    ["service", "repo"]
+)
+FILES = Counter(
+    "rds_backup_files_total",
+    "Files processed by backups by state (new, changed, unmodified).",
+    ["service", "repo", "state"]
+)
+RECLAIMED = Counter(
+    "rds_restic_reclaimed_bytes_total",
+    "Bytes reclaimed by pruning repositories.",
+    ["repo"]
+)
+SKIPPED = Counter(
+    "rds_backup_skipped_total",
+    "Number of repository backups skipped because nothing changed.",
+    ["service", "repo"]
+)
+LAST_SUCCESS = Gauge(
+    "rds_backup_last_success_timestamp_seconds",
+    "Timestamp of the last successful backup of a repository.",
+    ["service", "repo"]
+)
+PROGRESS = Gauge(
+    "rds_backup_progress_ratio",
+    "Progress of the current or last backup of a repository (0-1).",
+    ["service", "repo"]
+)
+THROUGHPUT = Gauge(
+    "rds_backup_bytes_per_second",
+    "Average throughput of the current or last backup of a repository.",
+    ["service", "repo"]
+)
+
+
+def observe_backup_summary(service: str, repo: str, summary: dict) -> None:
+    """Update metrics from a 'restic backup --json' summary message.
+
+    :param str service: The name of the service.
+    :param str repo: The repository.
+    :param dict summary: The decoded summary message.
+    """
+
+    BYTES_ADDED.inc(summary.get("data_added", 0), service=service, repo=repo)
+    BYTES_PROCESSED.inc(
+        summary.get("total_bytes_processed", 0),
+        service=service,
+        repo=repo
+    )
+    for state in ("new", "changed", "unmodified"):
+        FILES.inc(
+            summary.get("files_{}".format(state), 0),
+            service=service,
+            repo=repo,
+            state=state
+        )
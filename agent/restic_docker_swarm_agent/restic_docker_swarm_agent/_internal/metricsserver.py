@@ -0,0 +1,57 @@
+"""HTTP server for exposing Prometheus metrics."""
+
+import logging
+from typing import Tuple
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from restic_docker_swarm_agent._internal.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Request handler which serves the metrics registry on /metrics."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Handle a GET request."""
+
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log requests using the module logger."""
+
+        logger.debug(format, *args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """A threaded HTTP server for Prometheus metrics."""
+
+    daemon_threads = True
+
+    def __init__(self, listen: Tuple[str, int]):
+        """Initialize the MetricsServer.
+
+        :param Tuple[str, int] listen: A tuple of the server address and port.
+        """
+
+        super().__init__(listen, MetricsRequestHandler)
+
+    def run(self) -> None:
+        """Run the server."""
+
+        logger.info(
+            "Serving metrics on http://%s:%s/metrics.",
+            self.server_address[0],
+            self.server_address[1]
+        )
+        self.serve_forever()
@@ -0,0 +1,95 @@
+"""Timing of job phases."""
+
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+
+class PhaseTimer:
+    """Measure the total duration of named phases of a job.
+
+    Phases may be measured concurrently from multiple threads. In that
+    case the phase durations add up to more than the elapsed time.
+    """
+
+    def __init__(
+        self,
+        on_phase: Optional[Callable[[str, float], None]] = None
+    ):
+        """Initialize a PhaseTimer.
+
+        :param Optional[Callable[[str, float], None]] on_phase: A function
+            which is called with the name and duration of every measured
+            phase, eg. for updating metrics.
+        """
+
+        self.durations = OrderedDict()
+        self.on_phase = on_phase
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Measure the duration of a phase.
+
+        If the same phase is measured multiple times, the durations
+        are summed together.
+
+        :param str name: The name of the phase.
+        """
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            with self.lock:
+                self.durations[name] = \
+                    self.durations.get(name, 0.0) + duration
+            if self.on_phase is not None:
+                self.on_phase(name, duration)
+
+    @property
+    def total(self) -> float:
+        """Get the total duration of all phases.
+
+        :return: The total duration in seconds.
+        :rtype: float
+        """
+
+        with self.lock:
+            return sum(self.durations.values())
+
+    @property
+    def elapsed(self) -> float:
+        """Get the time elapsed since the timer was created.
+
+        :return: The elapsed time in seconds.
+        :rtype: float
+        """
+
+        return time.monotonic() - self.started
+
+    def as_dict(self) -> Dict[str, float]:
+        """Get the phase durations as a dict.
+
+        :return: A dict of phase names and durations in seconds.
+        :rtype: Dict[str, float]
+        """
+
+        with self.lock:
+            return dict(self.durations)
+
+    def summary(self) -> str:
+        """Get a human readable summary of the phase durations.
+
+        :return: The summary string.
+        :rtype: str
+        """
+
+        with self.lock:
+            return ", ".join(
+                "{}: {:.2f}s".format(k, v) for k, v in self.durations.items()
+            )
@@ -0,0 +1,187 @@
+"""Live progress of running backups."""
+
+import time
+import logging
+import threading
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+from restic_docker_swarm_agent._internal import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressTracker:
+    """Track the progress of restic backups from their JSON messages.
+
+    The progress of each repository is stored under the name of the
+    service and the repository. Finished backups keep their final
+    state and summary until the next backup of the same repository
+    starts.
+    """
+
+    def __init__(
+        self,
+        update_interval: float = 10,
+        log_interval: float = 60
+    ):
+        """Initialize a ProgressTracker.
+
+        :param float update_interval: The interval in seconds between status
+            messages requested from restic.
+        :param float log_interval: The minimum interval in seconds between
+            progress log messages of a single backup.
+        """
+
+        self.update_interval = update_interval
+        self.log_interval = log_interval
+        self.progress = {}
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """Get a copy of the current progress of all backups.
+
+        :return: A dict of services containing dicts of repositories.
+        :rtype: Dict[str, Dict[str, Dict[str, Any]]]
+        """
+
+        with self.lock:
+            return {
+                s: {r: p.copy() for r, p in repos.items()}
+                for s, repos in self.progress.items()
+            }
+
+    def summary(self, service: str, repo: str) -> Optional[Dict[str, Any]]:
+        """Get the restic summary of the latest backup of a repository.
+
+        :param str service: The name of the service.
+        :param str repo: The repository.
+
+        :return: The summary or None if there's none.
+        :rtype: Optional[Dict[str, Any]]
+        """
+
+        with self.lock:
+            return self.progress.get(service, {}).get(repo, {}).get("summary")
+
+    def start(self, service: str, repo: str) -> None:
+        """Mark the backup of a repository as started.
+
+        :param str service: The name of the service.
+        :param str repo: The repository.
+        """
+
+        now = time.time()
+        with self.lock:
+            self.progress.setdefault(service, {})[repo] = {
+                "state": "running",
+                "started": now,
+                "updated": now,
+                "percent_done": 0.0,
+                "bytes_done": 0,
+                "total_bytes": None,
+                "bytes_per_second": None,
+                "eta": None,
+                "summary": None
+            }
+
+    def update(self, service: str, repo: str, status: Dict[str, Any]) -> None:
+        """Update the progress of a repository from a status message.
+
+        :param str service: The name of the service.
+        :param str repo: The repository.
+        :param Dict[str, Any] status: The decoded restic status message.
+        """
+
+        elapsed = status.get("seconds_elapsed") or 0
+        bytes_done = status.get("bytes_done") or 0
+        rate = bytes_done / elapsed if elapsed > 0 else None
+
+        with self.lock:
+            p = self.progress.setdefault(service, {}).setdefault(repo, {})
+            p.update({
+                "updated": time.time(),
+                "percent_done": status.get("percent_done", 0.0),
+                "bytes_done": bytes_done,
+                "total_bytes": status.get("total_bytes"),
+                "bytes_per_second": rate,
+                "eta": status.get("seconds_remaining")
+            })
+
+        metrics.PROGRESS.set(
+            status.get("percent_done", 0.0),
+            service=service,
+            repo=repo
+        )
+        if rate is not None:
+            metrics.THROUGHPUT.set(rate, service=service, repo=repo)
+
+    def finish(
+        self,
+        service: str,
+        repo: str,
+        state: str,
+        summary: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """Mark the backup of a repository as finished.
+
+        :param str service: The name of the service.
+        :param str repo: The repository.
+        :param str state: The final state, eg. 'done' or 'failed'.
+        :param Optional[Dict[str, Any]] summary: The restic summary message.
+        """
+
+        with self.lock:
+            p = self.progress.setdefault(service, {}).setdefault(repo, {})
+            p.update({"state": state, "updated": time.time()})
+            if summary is not None:
+                p.update({"percent_done": 1.0, "eta": 0, "summary": summary})
+
+        if summary is not None:
+            metrics.PROGRESS.set(1.0, service=service, repo=repo)
+
+    def track(
+        self,
+        service: str,
+        repo: str,
+        messages: Iterable[Dict[str, Any]]
+    ) -> Iterator[Dict[str, Any]]:
+        """Track progress from a stream of restic JSON messages.
+
+        This is a generator which passes all messages through unchanged
+        after updating the progress from status messages.
+
+        :param str service: The name of the service.
+        :param str repo: The repository.
+        :param Iterable[Dict[str, Any]] messages: The restic messages.
+        """
+
+        last_log = time.monotonic()
+        for msg in messages:
+            if msg.get("message_type") == "status":
+                self.update(service, repo, msg)
+
+                if time.monotonic() - last_log >= self.log_interval:
+                    last_log = time.monotonic()
+                    self.log_progress(service, repo)
+
+            yield msg
+
+    def log_progress(self, service: str, repo: str) -> None:
+        """Log the current progress of a repository.
+
+        :param str service: The name of the service.
+        :param str repo: The repository.
+        """
+
+        with self.lock:
+            p = self.progress.get(service, {}).get(repo, {}).copy()
+
+        rate = p.get("bytes_per_second")
+        logger.info(
+            "Backup of %s/%s: %.1f%% done, %s, ETA %s.",
+            service,
+            repo,
+            100 * (p.get("percent_done") or 0),
+            "unknown rate" if rate is None else "{:.0f} B/s".format(rate),
+            "unknown" if p.get("eta") is None else "{}s".format(p["eta"])
+        )
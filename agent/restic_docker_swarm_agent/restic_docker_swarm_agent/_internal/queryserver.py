@@ -1,7 +1,10 @@
 """Query server implementation."""
 
 from typing import Tuple
+import socket
+import struct
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing.connection import Listener, Connection
 
 from restic_docker_swarm_agent._internal.backupscheduler import BackupScheduler
@@ -10,33 +13,90 @@ logger = logging.getLogger(__name__)
 
 
 class QueryServer:
-    """A simple server for listening to status queries."""
-
-    def __init__(self, listen: Tuple[str, int], scheduler: BackupScheduler):
+    """A simple server for listening to status queries.
+
+    Each client connection is handled in a worker thread so that
+    a slow or hung client never blocks other clients. Connections
+    which stay idle for longer than 'timeout' seconds are closed.
+    """
+
+    def __init__(
+        self,
+        listen: Tuple[str, int],
+        scheduler: BackupScheduler,
+        workers: int = 8,
+        timeout: float = 10
+    ):
         """Initialize the QueryServer.
 
         :param Tuple[str, int] listen: A tuple of the server address and port.
         :param BackupScheduler scheduler: A BackupScheduler object.
+        :param int workers: The maximum number of concurrent clients.
+        :param float timeout: Per-connection timeout in seconds.
         """
 
         self.listen = listen
         self.scheduler = scheduler
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def set_timeout(self, conn: Connection) -> None:
+        """Set socket level send and receive timeouts on a connection.
+
+        This makes sure a client which only sends a partial message
+        can't block a worker thread forever.
+
+        :param Connection conn: The connection.
+        """
 
-    def handle_msg(self, listener: Listener, conn: Connection, msg) -> bool:
+        sec = int(self.timeout)
+        usec = int((self.timeout - sec) * 1000000)
+        timeval = struct.pack("ll", sec, usec)
+
+        sock = socket.socket(fileno=conn.fileno())
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeval)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
+        finally:
+            # Detach so that closing the socket doesn't close the connection.
+            sock.detach()
+
+    def handle_msg(
+        self,
+        conn: Connection,
+        msg,
+        client: Tuple[str, int]
+    ) -> bool:
         """Handle a message received from a client.
 
-        :param Listener listener: The server Listener object.
         :param conn Connection: The connection object used for communication.
         :param msg: The message received from the client.
+        :param Tuple[str, int] client: The address of the client.
 
         :return: False if the connection should be closed, True otherwise.
         :rtype: bool
         """
 
-        client = listener.last_accepted
-
         if msg == "status":
             conn.send(self.scheduler.status)
+        elif msg == "stats":
+            conn.send(self.scheduler.stats)
+        elif msg == "progress":
+            conn.send(self.scheduler.query_stats("progress"))
+        elif msg == "maintenance":
+            conn.send(self.scheduler.query_stats("maintenance"))
+        elif msg == "timeline":
+            conn.send(self.scheduler.timeline())
+        elif isinstance(msg, tuple) and len(msg) == 2 and \
+                msg[0] == "timeline" and isinstance(msg[1], (int, float)):
+            conn.send(self.scheduler.timeline(msg[1]))
+        elif msg == "history":
+            conn.send(self.scheduler.last_runs())
+        elif isinstance(msg, tuple) and 2 <= len(msg) <= 3 and \
+                msg[0] == "history" and isinstance(msg[1], int):
+            conn.send(self.scheduler.last_runs(*msg[1:]))
+        elif msg == "last_success":
+            conn.send(self.scheduler.since_last_success())
         elif msg == "close":
             conn.close()
             logger.debug("Closed: %s:%s", client[0], client[1])
@@ -44,6 +104,32 @@ class QueryServer:
 
         return True
 
+    def handle_conn(self, conn: Connection, client: Tuple[str, int]) -> None:
+        """Handle a client connection until it's closed or times out.
+
+        :param Connection conn: The connection object.
+        :param Tuple[str, int] client: The address of the client.
+        """
+
+        try:
+            self.set_timeout(conn)
+            while True:
+                if not conn.poll(self.timeout):
+                    logger.debug("Timed out: %s:%s", client[0], client[1])
+                    break
+
+                if not self.handle_msg(conn, conn.recv(), client):
+                    break
+        except (EOFError, OSError) as e:
+            logger.debug(
+                "Disconnected: %s:%s (%s)",
+                client[0],
+                client[1],
+                e
+            )
+        finally:
+            conn.close()
+
     def run(self) -> None:
         """Run the server."""
 
@@ -55,11 +141,12 @@ class QueryServer:
         listener = Listener(self.listen)
 
         while True:
-            conn = listener.accept()
+            try:
+                conn = listener.accept()
+            except OSError as e:
+                logger.warning("Failed to accept a connection: %s", e)
+                continue
+
             client = listener.last_accepted
             logger.debug("Accepted: %s:%s", client[0], client[1])
-
-            while True:
-                msg = conn.recv()
-                if not self.handle_msg(listener, conn, msg):
-                    break
+            self.pool.submit(self.handle_conn, conn, client)
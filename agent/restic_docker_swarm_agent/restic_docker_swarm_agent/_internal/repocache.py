@@ -0,0 +1,75 @@
+"""A cache of known restic repositories."""
+
+import os
+import time
+from typing import Optional
+
+from restic_docker_swarm_agent._internal.statefile import StateFile
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+
+
+class RepoCache:
+    """A persistent cache of initialized restic repositories.
+
+    Repositories are keyed by their full address, ie. the SFTP
+    host and the repository path, and the cached value contains
+    the repository ID.
+    """
+
+    FILENAME = "repos.json"
+
+    def __init__(self, state_dir: Optional[str]):
+        """Initialize a RepoCache.
+
+        :param Optional[str] state_dir: The directory where the cache file
+            is stored. If this is None, the cache is only kept in memory.
+        """
+
+        path = None
+        if state_dir is not None:
+            path = os.path.join(state_dir, RepoCache.FILENAME)
+
+        self.state = StateFile(path)
+
+    def contains(self, host: str, repo: str) -> bool:
+        """Check whether a repository is known to exist.
+
+        :param str host: The SFTP host.
+        :param str repo: The repository path.
+
+        :return: True if the repository is cached, False otherwise.
+        :rtype: bool
+        """
+
+        return self.state.get(ResticUtils.full_repo(host, repo)) is not None
+
+    def add(self, host: str, repo: str, repo_id: Optional[str]) -> None:
+        """Add a repository to the cache.
+
+        :param str host: The SFTP host.
+        :param str repo: The repository path.
+        :param Optional[str] repo_id: The ID of the repository if known.
+        """
+
+        self.state.set(
+            ResticUtils.full_repo(host, repo),
+            {"id": repo_id, "host": host, "added": time.time()}
+        )
+
+    def invalidate(self, host: str, repo: Optional[str] = None) -> None:
+        """Remove a repository or all repositories of a host from the cache.
+
+        :param str host: The SFTP host.
+        :param Optional[str] repo: The repository path. If this is None,
+            all repositories of the host are removed from the cache.
+        """
+
+        if repo is None:
+            # Entries written by older versions don't record the host.
+            prefix = ResticUtils.full_repo(host, "")
+            self.state.pop_if(
+                lambda k, v: v.get("host", host) == host and
+                k.startswith(prefix)
+            )
+        else:
+            self.state.pop(ResticUtils.full_repo(host, repo))
@@ -0,0 +1,128 @@
+"""Concurrency limits for SFTP hosts and restic repositories."""
+
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+
+class RepoLocks:
+    """Per-host concurrency limits and per-repository locks.
+
+    A job holds the lock of every repository it writes to. This
+    guarantees that the same restic repository is never written to by
+    two jobs at the same time. A host slot is only held while restic
+    runs, so that hooks of other jobs don't count against the limit of
+    the host. Repository locks are always acquired before the host slot
+    so that a job never waits for a repository while holding a slot.
+    """
+
+    def __init__(self, max_per_host: int):
+        """Initialize RepoLocks.
+
+        :param int max_per_host: The maximum number of concurrent jobs
+            per SFTP host.
+        """
+
+        self.max_per_host = max_per_host
+        self.host_sems = {}
+        self.repo_locks = {}
+        self.lock = threading.Lock()
+
+    def host_sem(self, host: str) -> threading.BoundedSemaphore:
+        """Get the semaphore of an SFTP host.
+
+        :param str host: The SFTP host.
+
+        :return: The semaphore of the host.
+        :rtype: threading.BoundedSemaphore
+        """
+
+        with self.lock:
+            if host not in self.host_sems:
+                self.host_sems[host] = threading.BoundedSemaphore(
+                    self.max_per_host
+                )
+            return self.host_sems[host]
+
+    def repo_lock(self, host: str, repo: str) -> threading.Lock:
+        """Get the lock of a repository.
+
+        :param str host: The SFTP host.
+        :param str repo: The repository path.
+
+        :return: The lock of the repository.
+        :rtype: threading.Lock
+        """
+
+        with self.lock:
+            key = (host, repo)
+            if key not in self.repo_locks:
+                self.repo_locks[key] = threading.Lock()
+            return self.repo_locks[key]
+
+    @contextmanager
+    def hold_host(self, host: str) -> Iterator[None]:
+        """Hold a slot of an SFTP host.
+
+        :param str host: The SFTP host.
+        """
+
+        with self.host_sem(host):
+            yield
+
+    @contextmanager
+    def hold_repos(self, host: str, repos: Iterable[str]) -> Iterator[None]:
+        """Hold the locks of a set of repositories.
+
+        Repository locks are always acquired in sorted order to prevent
+        deadlocks between jobs which share repositories.
+
+        :param str host: The SFTP host.
+        :param Iterable[str] repos: The repositories to lock.
+        """
+
+        locks = [self.repo_lock(host, r) for r in sorted(set(repos))]
+
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @contextmanager
+    def hold(self, host: str, repos: Iterable[str]) -> Iterator[None]:
+        """Hold the locks of a set of repositories and a host slot.
+
+        :param str host: The SFTP host.
+        :param Iterable[str] repos: The repositories to lock.
+        """
+
+        with self.hold_repos(host, repos), self.hold_host(host):
+            yield
+
+    def is_locked(self, host: str, repo: str) -> bool:
+        """Check whether a repository is currently locked.
+
+        :param str host: The SFTP host.
+        :param str repo: The repository path.
+
+        :return: True if the repository is locked, False otherwise.
+        :rtype: bool
+        """
+
+        return self.repo_lock(host, repo).locked()
+
+    @property
+    def stats(self) -> Dict[str, List[Tuple[str, str]]]:
+        """Get the currently locked repositories.
+
+        :return: A dict with a list of locked (host, repo) tuples.
+        :rtype: Dict[str, List[Tuple[str, str]]]
+        """
+
+        with self.lock:
+            locked = [k for k, v in self.repo_locks.items() if v.locked()]
+
+        return {"locked_repos": locked}
@@ -0,0 +1,235 @@
+"""Scheduled maintenance of restic repositories."""
+
+import json
+import time
+import logging
+import threading
+import subprocess
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from docker.models.services import Service
+
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+from restic_docker_swarm_agent._internal.repolocks import RepoLocks
+from restic_docker_swarm_agent._internal.servicebackupconfig import \
+    ServiceBackupConfig
+from restic_docker_swarm_agent._internal import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RepoMaintainer:  # pylint: disable=too-many-instance-attributes
+    """Run prune and check in the repositories of services.
+
+    Maintenance tasks are run by maintenance jobs separately from
+    backups. The result of the latest job of each repository, including
+    its duration and the space reclaimed by prune, is kept for status
+    queries.
+    """
+
+    def __init__(
+        self,
+        run_restic: Callable[..., subprocess.CompletedProcess],
+        repo_locks: RepoLocks,
+        ssh_host: str,
+        tasks: Optional[List[str]] = None,
+        default_schedule: bool = False
+    ):
+        """Initialize a RepoMaintainer.
+
+        :param Callable[..., subprocess.CompletedProcess] run_restic: The
+            function used for running restic, ie. ResticWrapper.run_restic.
+        :param RepoLocks repo_locks: The RepoLocks shared with backups.
+        :param str ssh_host: The SSH host of the repositories.
+        :param Optional[List[str]] tasks: The default maintenance tasks.
+            Defaults to prune only.
+        :param bool default_schedule: True if services without their own
+            maintenance schedule are maintained on a default schedule.
+        """
+
+        self.run_restic = run_restic
+        self.repo_locks = repo_locks
+        self.ssh_host = ssh_host
+        self.tasks = tuple(tasks or ["prune"])
+        self.default_schedule = default_schedule
+
+        self.results = {}
+        self.pruned = set()
+        self.lock = threading.Lock()
+
+    def forgotten(self, repo: str) -> None:
+        """Mark a repository as needing a prune after a forget.
+
+        :param str repo: The repository.
+        """
+
+        with self.lock:
+            self.pruned.discard(repo)
+
+    def tasks_of(self, config: ServiceBackupConfig) -> Tuple[str, ...]:
+        """Get the maintenance tasks of a service.
+
+        :param ServiceBackupConfig config: The parsed config of the service.
+
+        :return: The tasks.
+        :rtype: Tuple[str, ...]
+        """
+
+        return config.maintenance or self.tasks
+
+    def defers_prune(self, config: ServiceBackupConfig) -> bool:
+        """Check whether maintenance jobs prune the repos of a service.
+
+        :param ServiceBackupConfig config: The parsed config of the service.
+
+        :return: True if pruning is left to maintenance jobs.
+        :rtype: bool
+        """
+
+        scheduled = self.default_schedule or \
+            config.maintenance_at is not None
+
+        return scheduled and "prune" in self.tasks_of(config)
+
+    def repo_size(self, repo: str) -> Optional[int]:
+        """Get the size of the data stored in a repository.
+
+        :param str repo: The repository.
+
+        :return: The size in bytes or None if it can't be determined.
+        :rtype: Optional[int]
+        """
+
+        try:
+            proc = self.run_restic(
+                repo,
+                False,
+                "stats", "--json", "--mode", "raw-data",
+                capture=True
+            )
+            return int(json.loads(proc.stdout)["total_size"])
+        except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+            logger.warning("Failed to get the size of %s: %s", repo, e)
+            return None
+
+    def run_maintenance_task(self, repo: str, task: str) -> Dict[str, Any]:
+        """Run a single maintenance task in a repository.
+
+        Prune is skipped if nothing was forgotten since the last prune.
+
+        :param str repo: The repository.
+        :param str task: The task as returned by parse_maintenance_tasks().
+
+        :return: A dict with the task, its result, duration and the
+            number of bytes reclaimed by prune.
+        :rtype: Dict[str, Any]
+        """
+
+        ret = {"task": task, "result": "done", "duration": 0.0}
+        before = None
+
+        if task == "prune":
+            with self.lock:
+                if repo in self.pruned:
+                    ret["result"] = "skipped"
+                    return ret
+            before = self.repo_size(repo)
+
+        logger.info("Running maintenance task %s in repo %s.", task, repo)
+        start = time.monotonic()
+        try:
+            with metrics.PHASE_DURATION.time(phase=task.partition("=")[0]):
+                self.run_restic(
+                    repo,
+                    True,
+                    *ResticUtils.maintenance_args(task)
+                )
+        except subprocess.CalledProcessError as e:
+            if ResticUtils.is_missing_repo_error(e.stderr):
+                ret["result"] = "skipped"
+            else:
+                logger.error("Restic returned error code: %s", e.returncode)
+                ret["result"] = "failed"
+        ret["duration"] = time.monotonic() - start
+
+        if task == "prune" and ret["result"] == "done":
+            with self.lock:
+                self.pruned.add(repo)
+
+            after = self.repo_size(repo)
+            if None not in (before, after):
+                ret["reclaimed"] = max(0, before - after)
+                metrics.RECLAIMED.inc(ret["reclaimed"], repo=repo)
+
+        return ret
+
+    def maintain(
+        self,
+        service: Service,
+        config: ServiceBackupConfig,
+        since: float
+    ) -> bool:
+        """Run the maintenance tasks of a service in its repositories.
+
+        The repositories are locked like during backups so maintenance
+        never runs in a repository which is being backed up. Shared
+        repositories which were already maintained after 'since' by
+        another service are skipped.
+
+        :param Service service: The service.
+        :param ServiceBackupConfig config: The parsed config of the service.
+        :param float since: The scheduled time of the maintenance job.
+
+        :return: True on success, False on failure.
+        :rtype: bool
+        """
+
+        ret = True
+        for repo in config.repositories():
+            with self.lock:
+                last = self.results.get(repo)
+            if last is not None and last["started"] >= since:
+                logger.debug("Repo %s is already maintained.", repo)
+                continue
+
+            started = time.time()
+            with self.repo_locks.hold(self.ssh_host, [repo]):
+                tasks = [
+                    self.run_maintenance_task(repo, t)
+                    for t in self.tasks_of(config)
+                ]
+
+            result = {
+                "service": service.name,
+                "started": started,
+                "duration": time.time() - started,
+                "tasks": tasks,
+                "reclaimed": sum(x.get("reclaimed", 0) for x in tasks),
+                "result": "failed" if any(
+                    x["result"] == "failed" for x in tasks
+                ) else "done"
+            }
+            logger.info(
+                "Maintenance of repo %s %s in %.2fs, %s bytes reclaimed.",
+                repo,
+                result["result"],
+                result["duration"],
+                result["reclaimed"]
+            )
+            with self.lock:
+                self.results[repo] = result
+
+            ret = ret and result["result"] == "done"
+
+        return ret
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get the result of the latest maintenance job of each repository.
+
+        :return: A dict of repository -> result.
+        :rtype: Dict[str, Dict[str, Any]]
+        """
+
+        with self.lock:
+            return {k: v.copy() for k, v in self.results.items()}
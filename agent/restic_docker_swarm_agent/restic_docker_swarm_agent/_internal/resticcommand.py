@@ -0,0 +1,75 @@
+"""Reusable restic command lines."""
+
+import threading
+from typing import List, Optional
+
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+
+
+class ResticCommandBuilder:  # pylint: disable=too-few-public-methods
+    """Build restic commands as argv lists for one SFTP host.
+
+    The SSH options and restic arguments are split into separate
+    arguments once when the builder is created. The base command of
+    each repository is built on first use and reused after that, so
+    running restic doesn't require re-building or re-quoting anything.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: Optional[int],
+        ssh_opts: Optional[List[str]] = None,
+        restic_args: Optional[List[str]] = None,
+        expand: bool = False
+    ):
+        """Initialize a ResticCommandBuilder.
+
+        :param str host: The SSH host.
+        :param Optional[int] port: The SSH port number.
+        :param Optional[List[str]] ssh_opts: SSH option strings which are
+            split into arguments like a shell would split them.
+        :param Optional[List[str]] restic_args: Restic argument strings which
+            are split into arguments like a shell would split them.
+        :param bool expand: Expand environment variables in the SSH options
+            and restic arguments.
+        """
+
+        self.host = host
+        self.port = port
+        self.ssh_opts = ResticUtils.split_args(ssh_opts, expand)
+        self.restic_args = ResticUtils.split_args(restic_args, expand)
+
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def command(
+        self,
+        repo: str,
+        extra_ssh_opts: Optional[List[str]] = None
+    ) -> List[str]:
+        """Get the base restic command of a repository.
+
+        :param str repo: The restic repository path.
+        :param Optional[List[str]] extra_ssh_opts: Additional SSH arguments,
+            eg. the options of a multiplexed master connection.
+
+        :return: A new argv list which the caller can extend.
+        :rtype: List[str]
+        """
+
+        key = (repo, tuple(extra_ssh_opts or ()))
+
+        with self.lock:
+            cmd = self.cache.get(key)
+            if cmd is None:
+                cmd = ResticUtils.restic_cmd(
+                    self.host,
+                    self.port,
+                    repo,
+                    self.ssh_opts + list(key[1]),
+                    self.restic_args
+                )
+                self.cache[key] = cmd
+
+        return list(cmd)
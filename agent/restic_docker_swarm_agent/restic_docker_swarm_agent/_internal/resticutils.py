@@ -1,13 +1,31 @@
 """Utility methods for controlling restic."""
 
+import os
+import re
+import json
+import shlex
 from typing import List, Optional, Set, Dict, Union
 
 from docker.models.services import Service
 
 
-class ResticUtils:
+class ResticUtils:  # pylint: disable=too-many-public-methods
     """Utility methods for controlling restic."""
 
+    WRITE_COMMANDS = frozenset([
+        "backup",
+        "copy",
+        "forget",
+        "init",
+        "key",
+        "migrate",
+        "prune",
+        "rebuild-index",
+        "repair",
+        "rewrite",
+        "tag"
+    ])
+
     @classmethod
     def full_repo(cls, host: str, repo: str) -> str:
         """Get the full address of a restic repository.
@@ -67,14 +85,15 @@ class ResticUtils:
         :param List[str] ssh_opts: A list of SSH options.
         :param List[str] restic_args: Arguments passed to restic.
 
-        :return: A command template as a list of strings.
+        :return: The command as an argv list.
         :rtype: List[str]
         """
 
-        ssh_cmd = " ".join(cls.ssh_cmd(host, port, ssh_opts))
         ret = [
             "restic",
-            "-o", "sftp.command='{}'".format(ssh_cmd),
+            "-o", "sftp.command={}".format(
+                cls.cmd_str(cls.ssh_cmd(host, port, ssh_opts))
+            ),
             "-r", cls.full_repo(host, repo)
         ]
 
@@ -83,6 +102,44 @@ class ResticUtils:
 
         return ret
 
+    @staticmethod
+    def split_args(
+        args: Optional[List[str]],
+        expand: bool = False
+    ) -> List[str]:
+        """Split option strings into a list of arguments.
+
+        Each string is split like a shell would split it, so an option
+        such as '-o UserKnownHostsFile=/a/b' results in two arguments.
+
+        :param Optional[List[str]] args: A list of option strings.
+        :param bool expand: Expand environment variables in the arguments.
+
+        :return: A list of arguments.
+        :rtype: List[str]
+        """
+
+        ret = []
+        for arg in args or []:
+            ret.extend(shlex.split(arg))
+
+        if expand:
+            ret = [os.path.expandvars(x) for x in ret]
+
+        return ret
+
+    @staticmethod
+    def cmd_str(cmd: List[str]) -> str:
+        """Join an argv list into a properly quoted command string.
+
+        :param List[str] cmd: The command as an argv list.
+
+        :return: The command string.
+        :rtype: str
+        """
+
+        return " ".join(shlex.quote(x) for x in cmd)
+
     @staticmethod
     def parse_forget_policy(spec: str) -> Dict[str, Union[str, int, set]]:
         """Parse a forget policy string.
@@ -155,7 +212,8 @@ class ResticUtils:
             else:
                 # If not, add the key as an argument directly.
                 if isinstance(policy[key], bool):
-                    args.append("--{}".format(key))
+                    if policy[key]:
+                        args.append("--{}".format(key))
                 else:
                     args.append(
                         "--{}={}".format(
@@ -166,6 +224,211 @@ class ResticUtils:
 
         return args
 
+    @staticmethod
+    def parse_maintenance_tasks(spec: str) -> List[str]:
+        """Parse a comma separated list of maintenance tasks.
+
+        The tasks are 'prune', 'check' and 'check-data=SUBSET', where
+        SUBSET is passed to 'restic check --read-data-subset', eg. '1/5',
+        '10%' or '500M'.
+
+        :param str spec: The list of tasks.
+
+        :return: The tasks in the given order.
+        :rtype: List[str]
+
+        :raises ValueError: If a task is invalid.
+        """
+
+        tasks = [x.strip() for x in spec.split(",")]
+        tasks = [x for x in tasks if x]
+        if not tasks:
+            raise ValueError("No maintenance tasks given.")
+
+        for task in tasks:
+            if task in ("prune", "check"):
+                continue
+
+            name, _, subset = task.partition("=")
+            if name != "check-data" or not re.fullmatch(
+                r"\d+/\d+|\d+(\.\d+)?%|\d+[KMGT]?",
+                subset
+            ):
+                raise ValueError(
+                    "Invalid maintenance task '{}'. Expected 'prune', "
+                    "'check' or 'check-data=SUBSET'.".format(task)
+                )
+
+        return tasks
+
+    @staticmethod
+    def maintenance_args(task: str) -> List[str]:
+        """Build restic arguments for a maintenance task.
+
+        :param str task: A task as returned by parse_maintenance_tasks().
+
+        :return: A list of command line arguments.
+        :rtype: List[str]
+        """
+
+        if task.startswith("check-data="):
+            return ["check", "--read-data-subset={}".format(
+                task[len("check-data="):]
+            )]
+
+        return [task]
+
+    @classmethod
+    def writes_repo(cls, args: List[str]) -> bool:
+        """Check whether a restic command uploads data to the repository.
+
+        :param List[str] args: The arguments of restic after the default
+            arguments, eg. ['--no-lock', 'list', 'locks'].
+
+        :return: True if the command writes to the repository.
+        :rtype: bool
+        """
+
+        command = next((x for x in args if not x.startswith("-")), None)
+        return command in cls.WRITE_COMMANDS
+
+    @staticmethod
+    def is_missing_repo_error(stderr: Optional[str]) -> bool:
+        """Check whether restic failed because a repository doesn't exist.
+
+        :param Optional[str] stderr: The stderr output of restic.
+
+        :return: True if the repository doesn't exist, False otherwise.
+        :rtype: bool
+        """
+
+        if not stderr:
+            return False
+
+        return re.search(
+            r"repository does not exist|"
+            r"Is there a repository at the following location\?",
+            stderr
+        ) is not None
+
+    @staticmethod
+    def is_lock_error(stderr: Optional[str]) -> bool:
+        """Check whether restic failed because a repository is locked.
+
+        :param Optional[str] stderr: The stderr output of restic.
+
+        :return: True if the repository is locked, False otherwise.
+        :rtype: bool
+        """
+
+        if not stderr:
+            return False
+
+        return re.search(
+            r"repository is already locked|"
+            r"unable to create lock in backend",
+            stderr
+        ) is not None
+
+    @classmethod
+    def classify_error(cls, stderr: Optional[str]) -> str:
+        """Classify the reason of a restic failure.
+
+        Every message of an SFTP repository mentions SSH or SFTP, eg. in
+        the repository URL or the 'subprocess ssh:' prefix of the output
+        of SSH, so only actual transport failures are network errors.
+
+        :param Optional[str] stderr: The stderr output of restic.
+
+        :return: 'network' for failed SSH and SFTP connections, 'locked'
+            for locked repositories, 'repository' for corrupted
+            repositories and wrong passwords, 'config' for denied
+            permissions and rejected host keys or 'other'.
+        :rtype: str
+        """
+
+        if not stderr:
+            return "other"
+
+        if cls.is_lock_error(stderr):
+            return "locked"
+
+        if re.search(
+            r"ciphertext verification failed|wrong password|"
+            r"checksum|repository contains errors|invalid data",
+            stderr,
+            re.IGNORECASE
+        ) is not None:
+            return "repository"
+
+        if re.search(
+            r"ssh: connect to host|"
+            r"connection (refused|reset|timed out|closed|lost)|"
+            r"could not resolve hostname|no route to host|"
+            r"network is unreachable|broken pipe|i/o timeout",
+            stderr,
+            re.IGNORECASE
+        ) is not None:
+            return "network"
+
+        if re.search(
+            r"permission denied|host key verification failed",
+            stderr,
+            re.IGNORECASE
+        ) is not None:
+            return "config"
+
+        return "other"
+
+    @staticmethod
+    def parse_repo_id(output: Optional[str]) -> Optional[str]:
+        """Parse a repository ID from 'restic cat config' or 'restic init'.
+
+        :param Optional[str] output: The stdout output of restic.
+
+        :return: The repository ID or None if it's not found.
+        :rtype: Optional[str]
+        """
+
+        if not output:
+            return None
+
+        match = re.search(r"created restic repository (\w+)", output)
+        if match is not None:
+            return match.group(1)
+
+        try:
+            return json.loads(output).get("id")
+        except (ValueError, AttributeError):
+            return None
+
+    @staticmethod
+    def parse_duration(spec: str) -> int:
+        """Parse a duration string, eg. '1d12h' or '3600'.
+
+        The supported units are s, m, h, d and w. A plain number
+        is interpreted as seconds.
+
+        :param str spec: The duration string to parse.
+
+        :return: The duration in seconds.
+        :rtype: int
+
+        :raises ValueError: If the duration string is invalid.
+        """
+
+        spec = spec.strip()
+        if spec.isdigit():
+            return int(spec)
+
+        units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+        if not re.fullmatch(r"(\d+[smhdw])+", spec):
+            raise ValueError("Invalid duration: '{}'.".format(spec))
+
+        return sum(
+            int(n) * units[u] for n, u in re.findall(r"(\d+)([smhdw])", spec)
+        )
+
     @staticmethod
     def service_backup(s: Service) -> bool:
         """Get the value of the rds.backup label for a Service."""
@@ -183,6 +446,72 @@ class ResticUtils:
         repos = set() if not tmp else {x.strip() for x in tmp.split(",")}
         return {x for x in repos if x}
 
+    @staticmethod
+    def service_backup_volumes(s: Service) -> Set[str]:
+        """Get the values of the rds.backup.volumes label for a Service."""
+        tmp = s.attrs.get("Spec").get("Labels").get("rds.backup.volumes")
+        volumes = set() if not tmp else {x.strip() for x in tmp.split(",")}
+        return {x for x in volumes if x}
+
+    @staticmethod
+    def service_backup_full_interval(s: Service) -> Optional[str]:
+        """Get the value of the rds.backup.full-interval label."""
+        return s.attrs.get("Spec").get("Labels").get(
+            "rds.backup.full-interval"
+        )
+
+    @staticmethod
+    def service_backup_shared_repo(s: Service) -> Optional[str]:
+        """Get the value of the rds.backup.shared-repo label."""
+        return s.attrs.get("Spec").get("Labels").get(
+            "rds.backup.shared-repo"
+        )
+
+    @staticmethod
+    def service_backup_maintenance_at(s: Service) -> Optional[str]:
+        """Get the value of the rds.backup.maintenance-at label."""
+        return s.attrs.get("Spec").get("Labels").get(
+            "rds.backup.maintenance-at"
+        )
+
+    @staticmethod
+    def service_backup_maintenance(s: Service) -> Optional[str]:
+        """Get the value of the rds.backup.maintenance label."""
+        return s.attrs.get("Spec").get("Labels").get(
+            "rds.backup.maintenance"
+        )
+
+    @staticmethod
+    def service_backup_hook_mode(s: Service) -> Optional[str]:
+        """Get the value of the rds.backup.hook-mode label."""
+        return s.attrs.get("Spec").get("Labels").get("rds.backup.hook-mode")
+
+    @staticmethod
+    def service_backup_hook_timeout(s: Service) -> Optional[str]:
+        """Get the value of the rds.backup.hook-timeout label."""
+        return s.attrs.get("Spec").get("Labels").get(
+            "rds.backup.hook-timeout"
+        )
+
+    @staticmethod
+    def service_backup_stream(s: Service) -> Optional[str]:
+        """Get the value of the rds.backup.stream label for a Service."""
+        return s.attrs.get("Spec").get("Labels").get("rds.backup.stream")
+
+    @staticmethod
+    def service_backup_stream_repo(s: Service) -> Optional[str]:
+        """Get the value of the rds.backup.stream-repo label."""
+        return s.attrs.get("Spec").get("Labels").get(
+            "rds.backup.stream-repo"
+        )
+
+    @staticmethod
+    def service_backup_stream_filename(s: Service) -> Optional[str]:
+        """Get the value of the rds.backup.stream-filename label."""
+        return s.attrs.get("Spec").get("Labels").get(
+            "rds.backup.stream-filename"
+        )
+
     @staticmethod
     def service_backup_pre_hook(s: Service) -> Optional[str]:
         """Get the value of the rds.backup.pre-hook label for a Service."""
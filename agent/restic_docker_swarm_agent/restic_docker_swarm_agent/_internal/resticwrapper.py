@@ -1,143 +1,362 @@
 """A wrapper class for running restic."""
 
 import os
+import json
+import time
+import tempfile
 import subprocess
 import logging
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 from docker.models.services import Service
 from docker.client import DockerClient
 
 from restic_docker_swarm_agent._internal.exceptions import \
-    SwarmException, ResticException
+    SwarmException, ResticException, ConfigException
 from restic_docker_swarm_agent._internal.resticutils import \
     ResticUtils
+from restic_docker_swarm_agent._internal.resticcommand import \
+    ResticCommandBuilder
+from restic_docker_swarm_agent._internal.repolocks import RepoLocks
+from restic_docker_swarm_agent._internal.phasetimer import PhaseTimer
+from restic_docker_swarm_agent._internal.stdinfeeder import StdinFeeder
+from restic_docker_swarm_agent._internal.repocache import RepoCache
+from restic_docker_swarm_agent._internal.changedetector import \
+    ChangeDetector
+from restic_docker_swarm_agent._internal.bandwidthbudget import \
+    BandwidthBudget
+from restic_docker_swarm_agent._internal.servicebackupconfig import \
+    ServiceBackupConfig
+from restic_docker_swarm_agent._internal.hookrunner import HookRunner
+from restic_docker_swarm_agent._internal.volumeresolver import \
+    VolumeResolver
+from restic_docker_swarm_agent._internal.historystore import HistoryStore
+from restic_docker_swarm_agent._internal.repomaintainer import \
+    RepoMaintainer
+from restic_docker_swarm_agent._internal.lockrecovery import LockRecovery
+from restic_docker_swarm_agent._internal.retrypolicy import BackupResult
+from restic_docker_swarm_agent._internal.sshmaster import SSHMasterPool
+from restic_docker_swarm_agent._internal.progresstracker import \
+    ProgressTracker
+from restic_docker_swarm_agent._internal import metrics
 
 logger = logging.getLogger(__name__)
 
 
-class ResticWrapper:
+class ResticWrapper:  # pylint: disable=too-many-instance-attributes
     """A wrapper class for running restic."""
 
-    def __init__(
+    def __init__(  # pylint: disable=too-many-locals
         self,
         docker_client: DockerClient,
         ssh_host: str,
         backup_base: str,
         forget_policy: str,
+        *,
         restic_args: str = None,
         ssh_opts: str = None,
-        ssh_port: int = None
+        ssh_port: int = None,
+        repo_locks: RepoLocks = None,
+        default_maintenance: bool = False,
+        repo_cache: RepoCache = None,
+        ssh_masters: SSHMasterPool = None,
+        progress: ProgressTracker = None,
+        shell_expand: bool = False,
+        change_detector: ChangeDetector = None,
+        budget: BandwidthBudget = None,
+        repo_concurrency: int = 1,
+        hooks: HookRunner = None,
+        history: HistoryStore = None,
+        volumes: VolumeResolver = None,
+        maintenance_tasks: Optional[List[str]] = None,
+        lock_recovery: LockRecovery = None
     ):
         self.docker_client = docker_client
+        self.history = history
+        self.volumes = volumes or VolumeResolver(docker_client)
+        self.lock_recovery = lock_recovery or LockRecovery(docker_client, None)
+        self.hooks = hooks or HookRunner(docker_client)
+        self.repo_locks = repo_locks or RepoLocks(1)
+        self.repo_cache = repo_cache or RepoCache(None)
+        self.change_detector = change_detector
+        self.budget = budget or BandwidthBudget()
+        self.repo_concurrency = repo_concurrency
 
         self.ssh_host = ssh_host
-        self.restic_args = restic_args
-        self.ssh_opts = ssh_opts
         self.ssh_port = ssh_port
+        self.commands = ResticCommandBuilder(
+            ssh_host,
+            ssh_port,
+            ssh_opts,
+            restic_args,
+            shell_expand
+        )
+        self.ssh_masters = ssh_masters
+        self.progress = progress or ProgressTracker()
 
         self.backup_base = backup_base
         self.forget_policy = ResticUtils.parse_forget_policy(forget_policy)
 
+        self.maintainer = RepoMaintainer(
+            self.run_restic,
+            self.repo_locks,
+            ssh_host,
+            maintenance_tasks,
+            default_maintenance
+        )
+
     def get_restic_cmd(self, repo: str) -> List[str]:
         """Build a restic command.
 
         :param str repo: The repository to use in the command.
+
+        :return: The command as an argv list.
+        :rtype: List[str]
         """
 
-        return ResticUtils.restic_cmd(
-            self.ssh_host,
-            self.ssh_port,
-            repo,
-            self.ssh_opts,
-            self.restic_args
-        )
+        master_opts = None
+
+        # Reuse a multiplexed SSH master connection if one is available.
+        if self.ssh_masters is not None:
+            master = self.ssh_masters.master(
+                self.ssh_host,
+                self.ssh_port,
+                self.commands.ssh_opts
+            )
+            if master.ensure():
+                master_opts = master.ssh_opts()
 
-    def run_in_service(self, service: Service, cmd: str):
-        """Run a command in all tasks of a service.
+        return self.commands.command(repo, master_opts)
+
+    def run_in_service(
+        self,
+        service: Service,
+        cmd: str,
+        config: Optional[ServiceBackupConfig] = None
+    ):
+        """Run a hook command in the tasks of a service.
 
         :param Service service: The Service to run the command in.
         :param str cmd: The command to run.
+        :param Optional[ServiceBackupConfig] config: The parsed config of
+            the service which defines the hook mode and timeout. If this
+            is None, the command is run in a single task with the default
+            timeout.
 
-        :raises Exception: If 'docker exec' fails.
-        :raises Exception: If the service has no running tasks.
+        :raises SwarmException: If the command fails or times out.
+        :raises SwarmException: If the service has no running tasks.
         """
 
-        logger.info("Running in service %s: %s", service.name, cmd)
-        tasks = service.tasks(filters={"desired-state": "Running"})
-
-        if len(tasks) > 1:
-            logger.info(
-                "Service %s has multiple tasks. Will only run "
-                "the requested command in one of them.",
-                service.name
-            )
-        elif len(tasks) == 0:
-            raise SwarmException(
-                "No running tasks in service {}. Unable to run command."
-                .format(service.name)
+        if config is None:
+            self.hooks.run(service, cmd)
+        else:
+            self.hooks.run(
+                service,
+                cmd,
+                config.hook_mode,
+                config.hook_timeout
             )
 
-        cid = tasks[0].get("Status").get("ContainerStatus").get("ContainerID")
-        container = self.docker_client.containers.get(cid)
-        ret = container.exec_run(cmd)
+    def run_restic(
+        self,
+        repo: str,
+        output: bool,
+        *args,
+        capture: bool = False
+    ) -> subprocess.CompletedProcess:
+        """Run a restic command and retry it if the repository is locked.
 
-        output = ret.output.decode("utf-8")
-        if output != "" and not output.isspace():
-            logger.info("Output from container:\n\n%s\n", output)
+        Stale locks of dead agent runs are removed before retrying. The
+        arguments are the same as for run_restic_once().
 
-        if ret.exit_code != 0:
-            raise SwarmException("Failed to execute command.")
+        :param str repo: The repository to work on.
+        :param bool output: Print output of subprocess.
+        :param bool capture: Capture stdout instead of printing it.
+
+        :raises subprocess.CalledProcessError: If restic fails.
+        """
+
+        return self.lock_recovery.retry(
+            repo,
+            lambda: self.run_restic_once(repo, output, *args, capture=capture),
+            self.run_restic_once
+        )
 
-    def run_restic(self, repo: str, output: bool, *args):
+    def run_restic_once(
+        self,
+        repo: str,
+        output: bool,
+        *args,
+        capture: bool = False
+    ) -> subprocess.CompletedProcess:
         """A thin wrapper for running restic commands.
 
         All varargs are passed to the restic command after
         the default arguments. The restic command is run using
-        subprocess.run(). The return value of subprocess.run()
-        is returned by this method.
+        subprocess.run() without a shell. The return value of
+        subprocess.run() is returned by this method. Stderr is always captured
+        so that errors can be inspected by the caller.
 
         :param str repo: The repository to work on.
         :param bool output: Print output of subprocess. If the current
                             logging level is logging.DEBUG, this argument
                             is ignored and output is always printed.
+        :param bool capture: Capture stdout instead of printing it.
+
+        :raises subprocess.CalledProcessError: If restic fails.
         """
         output = output or logger.getEffectiveLevel() <= logging.DEBUG
 
-        cmd = self.get_restic_cmd(repo)
-        cmd.extend(args)
+        stdout = None if output else subprocess.DEVNULL
+        if capture:
+            stdout = subprocess.PIPE
+
+        # Commands which write to the repo take a share of the bandwidth.
+        with self.budget.allocate(ResticUtils.writes_repo(args)) as limits:
+            cmd = self.budget.prefix() + self.get_restic_cmd(repo) + limits
+            cmd.extend(args)
 
-        if not output:
-            return subprocess.run(
-                " ".join(cmd),
-                check=True,
-                shell=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
+            if output:
+                logger.info("Exec: %s", ResticUtils.cmd_str(cmd))
+
+            proc = subprocess.run(
+                cmd,
+                check=False,
+                stdout=stdout,
+                stderr=subprocess.PIPE,
+                universal_newlines=True
             )
 
-        logger.info("Exec: %s", " ".join(cmd))
-        return subprocess.run(
-            " ".join(cmd),
-            check=True,
-            shell=True
-        )
+        if output:
+            for out in (proc.stdout, proc.stderr):
+                if out and not out.isspace():
+                    logger.info("Output from restic:\n\n%s\n", out.rstrip())
+
+        proc.check_returncode()
+        return proc
+
+    def stream_restic(
+        self,
+        repo: str,
+        *args,
+        feed: Optional[Callable[[Callable[[bytes], Any]], None]] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """Run restic with --json and yield messages as they arrive.
+
+        All varargs are passed to the restic command after the default
+        arguments. Output lines are decoded one by one without buffering
+        the whole output. Lines which are not JSON are logged.
+
+        If feed is given, it's called in a separate thread with a function
+        which writes to the stdin of restic. Stdin is closed when feed
+        returns. If feed raises an exception, restic is killed before
+        stdin is closed so that it doesn't save a partial snapshot.
+
+        :param str repo: The repository to work on.
+        :param feed: An optional function which writes the stdin of restic.
+
+        :raises subprocess.CalledProcessError: If restic fails. This is
+            raised after all messages have been yielded.
+        :raises SwarmException: If feed fails. This is raised instead of
+            the error of restic, which was killed, unless feed failed
+            because restic exited.
+        """
+
+        # Restic only prints status messages every 60 seconds by default
+        # when stdout is not a terminal.
+        env = os.environ.copy()
+        env["RESTIC_PROGRESS_FPS"] = str(1.0 / self.progress.update_interval)
+
+        with self.budget.allocate() as limits, \
+                tempfile.TemporaryFile(mode="w+") as err_file:
+            cmd = self.budget.prefix() + self.get_restic_cmd(repo) + limits
+            cmd.append("--json")
+            cmd.extend(args)
+            logger.info("Exec: %s", ResticUtils.cmd_str(cmd))
+
+            with subprocess.Popen(
+                cmd,
+                stdin=None if feed is None else subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=err_file,
+                universal_newlines=True,
+                env=env
+            ) as proc:
+                feeder = None
+                if feed is not None:
+                    feeder = StdinFeeder(proc, feed)
+                    feeder.start()
+
+                try:
+                    for line in proc.stdout:
+                        try:
+                            msg = json.loads(line)
+                        except ValueError:
+                            logger.info(
+                                "Output from restic: %s",
+                                line.rstrip()
+                            )
+                            continue
+
+                        if isinstance(msg, dict):
+                            yield msg
+                except GeneratorExit:
+                    proc.terminate()
+                    raise
+
+                returncode = proc.wait()
+                if feeder is not None:
+                    feeder.join()
+
+            err_file.seek(0)
+            stderr = err_file.read()
+
+        if stderr and not stderr.isspace():
+            logger.info("Output from restic:\n\n%s\n", stderr.rstrip())
+
+        # Restic was killed if feed failed, unless writing to it failed.
+        error = None if feeder is None else feeder.error
+        if error is not None and not isinstance(error.__cause__, OSError):
+            raise error
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode,
+                cmd,
+                stderr=stderr
+            )
+
+        if error is not None:
+            raise error
 
     def init_repo(self, repo: str):
         """Initialize a restic repository if it doesn't exist.
 
+        The repository cache is checked first and restic is only
+        run if the repository isn't found in the cache.
+
         :param str repo: The respository to initialize.
 
         :raises Exception: If initialization fails.
         """
 
+        if self.repo_cache.contains(self.ssh_host, repo):
+            logger.debug("Restic repo %s found in the repo cache.", repo)
+            return
+
         repo_full_path = ResticUtils.full_repo(self.ssh_host, repo)
 
         # Check whether the repo already exists.
         logger.debug("Checking whether the repo %s exists.", repo_full_path)
         try:
-            self.run_restic(repo, False, "cat", "config")
+            proc = self.run_restic(repo, False, "cat", "config", capture=True)
             logger.debug("Restic repo already exists.")
+            self.repo_cache.add(
+                self.ssh_host,
+                repo,
+                ResticUtils.parse_repo_id(proc.stdout)
+            )
             return
         except subprocess.CalledProcessError:
             logger.debug("Restic repo doesn't exist.")
@@ -145,104 +364,604 @@ class ResticWrapper:
         # Initilize the repo if it doesn't exist.
         logger.debug("Creating repo %s.", repo_full_path)
         try:
-            self.run_restic(repo, True, "init")
+            proc = self.run_restic(repo, True, "init", capture=True)
         except subprocess.CalledProcessError as e:
             raise ResticException("'restic init' failed.") from e
 
-    def forget(self, service: Service):
-        """Forget old snapshots from service according to the forget policy.
+        self.repo_cache.add(
+            self.ssh_host,
+            repo,
+            ResticUtils.parse_repo_id(proc.stdout)
+        )
 
-        :param Service service: The service who's backups to forget.
+    def forget(
+        self,
+        repo: str,
+        tag: Optional[str] = None,
+        defer_prune: bool = False
+    ) -> bool:
+        """Forget old snapshots from a repo according to the forget policy.
+
+        If a tag is given, only snapshots with the tag are forgotten and
+        the policy is applied separately to each group of snapshots with
+        the same paths and tags. Failures are only logged, since the
+        snapshots are forgotten after the next backup anyway.
+
+        :param str repo: The repository to forget snapshots from.
+        :param Optional[str] tag: The snapshot tag of a service sharing
+            the repository.
+        :param bool defer_prune: Leave pruning to a maintenance job.
+
+        :return: True on success, False on failure.
         """
-        repos = ResticUtils.service_backup_repos(service)
 
-        for r in repos:
-            logger.info(
-                "Forgetting old backups of service %s from repo %s.",
-                service.name,
-                r
-            )
+        logger.info("Forgetting old backups from repo %s.", repo)
 
-            args = ResticUtils.forget_policy_as_args(self.forget_policy)
+        policy = self.forget_policy.copy()
+        if defer_prune:
+            policy["prune"] = False
 
-            # Forget old snapshots.
-            try:
-                self.run_restic(r, True, "forget", *args)
-            except subprocess.CalledProcessError as e:
-                logger.error("Restic returned error code: %s", e.returncode)
+        args = ResticUtils.forget_policy_as_args(policy)
+        if tag is not None:
+            args.extend(["--tag", tag, "--group-by", "paths,tags"])
 
-    def backup(self, service: Service) -> bool:
+        try:
+            self.run_restic(repo, True, "forget", *args)
+        except subprocess.CalledProcessError as e:
+            logger.error("Restic returned error code: %s", e.returncode)
+            return False
+
+        self.maintainer.forgotten(repo)
+        return True
+
+    def backup(
+        self,
+        service: Service,
+        config: Optional[ServiceBackupConfig] = None
+    ) -> BackupResult:
         """Backup files with restic and run pre-hooks and post-hooks.
 
         :param Service service: The service to backup.
+        :param Optional[ServiceBackupConfig] config: The parsed config of
+            the service. It's parsed from the service labels if not given.
 
-        :return: True on success, False on failure.
+        :return: A BackupResult which is truthy on success and lists the
+            kinds of errors on failure.
+        :rtype: BackupResult
         """
 
-        repos = ResticUtils.service_backup_repos(service)
-        pre_hook = ResticUtils.service_backup_pre_hook(service)
-        post_hook = ResticUtils.service_backup_post_hook(service)
+        config = config or ServiceBackupConfig.from_service(service)
+        result = BackupResult()
 
-        if len(repos) == 0:
+        if len(config.repositories()) == 0:
             logger.error(
                 "No repositories defined for service %s.",
                 service.name
             )
-            return False
+            result.fail("config")
+            return result
 
-        # Run pre-backup hook.
-        if pre_hook is not None:
-            logger.info("Running pre-backup hook.")
-            try:
-                self.run_in_service(service, pre_hook)
-            except SwarmException as e:
-                logger.error(e)
-                return False
+        # Make sure no other job writes to the same repositories.
+        with self.repo_locks.hold_repos(
+            self.ssh_host,
+            config.repositories()
+        ):
+            self.backup_repos(service, config, result)
 
-        ret = True
-        for r in repos:
-            if os.path.isabs(r):
-                logger.error(
-                    "Absolute repository path %s in service %s. Skipping!",
-                    r,
-                    service.name
-                )
-                ret = False
-                continue
+        metrics.BACKUPS.inc(
+            service=service.name,
+            result="success" if result else "failure"
+        )
+        return result
+
+    @staticmethod
+    def observe_phase(service: Service, phase: str, duration: float) -> None:
+        """Update the phase duration metrics.
+
+        :param Service service: The service which is backed up.
+        :param str phase: The name of the phase.
+        :param float duration: The duration of the phase in seconds.
+        """
+
+        if phase.endswith("-hook"):
+            metrics.HOOK_DURATION.observe(
+                duration,
+                service=service.name,
+                hook=phase[:-len("-hook")]
+            )
+        else:
+            metrics.PHASE_DURATION.observe(duration, phase=phase)
 
-            # Initialize the repository.
-            logger.info("Initializing repo %s.", r)
+    def restic_backup(
+        self,
+        service: Service,
+        repo: str,
+        paths: Optional[List[str]] = None,
+        tags: Optional[List[str]] = None,
+        stdin: Optional[Tuple[str, Callable]] = None
+    ) -> Optional[dict]:
+        """Take a snapshot of a repository and track its progress.
+
+        :param Service service: The service which is backed up.
+        :param str repo: The repository to backup.
+        :param Optional[List[str]] paths: The local paths to backup.
+            Defaults to the repository path in the backup base.
+        :param Optional[List[str]] tags: Tags to add to the snapshot.
+        :param Optional[Tuple[str, Callable]] stdin: A tuple of a file name
+            and a feed function as accepted by stream_restic(). If this is
+            given, the output of the feed function is backed up as a file
+            with the given name instead of the paths.
+
+        :return: The restic summary message or None if it's missing.
+        :rtype: Optional[dict]
+
+        :raises subprocess.CalledProcessError: If restic fails.
+        :raises SwarmException: If the feed function fails.
+        """
+
+        summary = None
+        self.progress.start(service.name, repo)
+
+        args = ["backup"]
+        for tag in tags or []:
+            args.extend(["--tag", tag])
+
+        feed = None
+        if stdin is None:
+            args.extend(paths or [os.path.join(self.backup_base, repo)])
+        else:
+            args.extend(["--stdin", "--stdin-filename", stdin[0]])
+            feed = stdin[1]
+
+        messages = self.progress.track(
+            service.name,
+            repo,
+            self.stream_restic(repo, *args, feed=feed)
+        )
+        try:
+            for msg in messages:
+                if msg.get("message_type") == "summary":
+                    summary = msg
+                elif msg.get("message_type") == "error":
+                    logger.warning(
+                        "Restic error in %s: %s",
+                        repo,
+                        msg.get("error")
+                    )
+        except (subprocess.CalledProcessError, SwarmException):
+            self.progress.finish(service.name, repo, "failed")
+            raise
+
+        self.progress.finish(service.name, repo, "done", summary)
+        return summary
+
+    @staticmethod
+    def log_summary(
+        service: Service,
+        repo: str,
+        summary: Optional[dict]
+    ) -> None:
+        """Log a 'restic backup --json' summary and update metrics.
+
+        :param Service service: The service which was backed up.
+        :param str repo: The repository which was backed up.
+        :param Optional[dict] summary: The restic summary message.
+        """
+
+        metrics.LAST_SUCCESS.set(time.time(), service=service.name, repo=repo)
+
+        if summary is None:
+            logger.warning("No backup summary from restic for %s.", repo)
+            return
+
+        metrics.observe_backup_summary(service.name, repo, summary)
+        logger.info(
+            "Snapshot %s of %s saved: %s new, %s changed files, "
+            "%s bytes added.",
+            summary.get("snapshot_id"),
+            repo,
+            summary.get("files_new"),
+            summary.get("files_changed"),
+            summary.get("data_added")
+        )
+
+    def repo_changed(
+        self,
+        repo: str,
+        full_interval: Optional[int],
+        paths: Optional[List[str]] = None,
+        tag: Optional[str] = None
+    ) -> Tuple[bool, Optional[str]]:
+        """Check whether a repository needs to be backed up.
+
+        Repositories are always backed up if change detection is
+        disabled or if the repository isn't in the repository cache.
+
+        :param str repo: The repository to check.
+        :param Optional[int] full_interval: Force a backup if the last
+            backup is older than this many seconds.
+        :param Optional[List[str]] paths: The local paths backed up to
+            the repository. Defaults to the repository path in the
+            backup base.
+        :param Optional[str] tag: The snapshot tag of a service sharing
+            the repository.
+
+        :return: A tuple of a bool which is True if the repository needs
+            to be backed up and the current fingerprint of the repository.
+        :rtype: Tuple[bool, Optional[str]]
+        """
+
+        if self.change_detector is None:
+            return True, None
+
+        changed, fingerprint = self.change_detector.check(
+            self.ssh_host,
+            repo,
+            paths or [os.path.join(self.backup_base, repo)],
+            full_interval,
+            tag
+        )
+
+        # The repository may have been removed from the SFTP host.
+        if not self.repo_cache.contains(self.ssh_host, repo):
+            changed = True
+
+        return changed, fingerprint
+
+    def local_paths(
+        self,
+        service: Service,
+        paths: List[str],
+        config: Optional[ServiceBackupConfig] = None
+    ) -> List[str]:
+        """Get the paths in the agent container to backup.
+
+        Volumes of the service are resolved to their local mountpoints
+        and other paths are relative to the backup base.
+
+        :param Service service: The service which is backed up.
+        :param List[str] paths: The backup paths of a repository.
+        :param Optional[ServiceBackupConfig] config: The parsed config of
+            the service.
+
+        :return: A list of local paths.
+        :rtype: List[str]
+
+        :raises SwarmException: If a volume can't be resolved.
+        """
+
+        volumes = frozenset() if config is None else config.volumes
+
+        return [
+            self.volumes.resolve(service, x) if x in volumes
+            else os.path.join(self.backup_base, x)
+            for x in paths
+        ]
+
+    def backup_repo(
+        self,
+        service: Service,
+        repo: str,
+        timer: PhaseTimer,
+        result: BackupResult,
+        config: Optional[ServiceBackupConfig] = None
+    ) -> str:
+        """Initialize a repository and take a snapshot into it.
+
+        If change detection is enabled and nothing changed since the
+        last backup, restic isn't run at all.
+
+        :param Service service: The service which is backed up.
+        :param str repo: The repository to backup.
+        :param PhaseTimer timer: The PhaseTimer of the backup job.
+        :param BackupResult result: The BackupResult of the backup job.
+        :param Optional[ServiceBackupConfig] config: The parsed config of
+            the service. If this is None, the repository path is backed
+            up without tags and without a full backup interval.
+
+        :return: 'done' on success, 'skipped' if nothing changed
+            and 'failed' on failure.
+        :rtype: str
+        """
+
+        if config is None:
+            paths, tag, full_interval = [repo], None, None
+        else:
+            paths = config.targets()[repo]
+            tag, full_interval = config.repo_tag(repo), config.full_interval
+
+        try:
+            for path in [repo] + paths:
+                if os.path.isabs(path):
+                    raise ValueError(
+                        "Absolute repository path {}.".format(path)
+                    )
+
+            with timer.phase("resolve"):
+                paths = self.local_paths(service, paths, config)
+        except (SwarmException, ValueError) as e:
+            logger.error("%s Skipping!", e)
+            return result.fail(e)
+
+        with timer.phase("detect"):
+            changed, fingerprint = self.repo_changed(
+                repo,
+                full_interval,
+                paths,
+                tag
+            )
+
+        if not changed:
+            logger.info("Nothing changed in %s. Skipping backup.", repo)
+            metrics.SKIPPED.inc(service=service.name, repo=repo)
+            self.progress.finish(service.name, repo, "skipped")
+            return "skipped"
+
+        # A cached repository may have been removed from the SFTP host.
+        # In that case the cache is invalidated and the backup is retried
+        # once after initializing the repository.
+        for attempt in range(2):
+            logger.info("Initializing repo %s.", repo)
             try:
-                self.init_repo(r)
+                with timer.phase("init"):
+                    self.init_repo(repo)
             except ResticException as e:
                 logger.error("Failed to init restic repo: %s", str(e))
-                ret = False
-                continue
+                return result.fail(e)
 
-            # Take backup.
-            logger.info("Taking backup of %s.", r)
+            logger.info("Taking backup of %s.", repo)
             try:
-                self.run_restic(
-                    r,
-                    True,
-                    "backup",
-                    os.path.join(self.backup_base, r)
-                )
+                with timer.phase("backup"), \
+                        metrics.REPO_BACKUP_DURATION.time(
+                            service=service.name,
+                            repo=repo
+                        ):
+                    summary = self.lock_recovery.retry(
+                        repo,
+                        lambda: self.restic_backup(
+                            service,
+                            repo,
+                            paths,
+                            [] if config is None
+                            else config.snapshot_tags(repo)
+                        ),
+                        self.run_restic_once
+                    )
+                self.log_summary(service, repo, summary)
+                if fingerprint is not None:
+                    self.change_detector.record(
+                        self.ssh_host,
+                        repo,
+                        fingerprint,
+                        tag
+                    )
+                return "done"
             except subprocess.CalledProcessError as e:
-                logger.error("Restic returned error code: %s", e.returncode)
-                ret = False
-                continue
+                if attempt > 0 or not ResticUtils.is_missing_repo_error(
+                    e.stderr
+                ):
+                    logger.error(
+                        "Restic returned error code: %s",
+                        e.returncode
+                    )
+                    return result.fail(e)
+
+            logger.warning("Cached repo %s doesn't exist anymore.", repo)
+            self.repo_cache.invalidate(self.ssh_host, repo)
+
+        return result.fail("other")
+
+    def backup_stream(
+        self,
+        service: Service,
+        config: ServiceBackupConfig,
+        timer: PhaseTimer,
+        result: BackupResult
+    ) -> str:
+        """Backup the output of the stream command of a service.
+
+        The stdout of the command is piped to 'restic backup --stdin'
+        without an intermediate file. A snapshot is only saved if the
+        command succeeds.
+
+        :param Service service: The service which is backed up.
+        :param ServiceBackupConfig config: The parsed config of the service.
+        :param PhaseTimer timer: The PhaseTimer of the backup job.
+        :param BackupResult result: The BackupResult of the backup job.
+
+        :return: 'done' on success and 'failed' on failure.
+        :rtype: str
+        """
+
+        repo = config.stream_repo
+        if os.path.isabs(repo):
+            logger.error("Absolute repository path %s. Skipping!", repo)
+            return result.fail("config")
+
+        logger.info("Initializing repo %s.", repo)
+        try:
+            with timer.phase("init"):
+                self.init_repo(repo)
+        except ResticException as e:
+            logger.error("Failed to init restic repo: %s", str(e))
+            return result.fail(e)
+
+        def feed(write):
+            self.hooks.stream(
+                service,
+                config.stream,
+                write,
+                config.hook_mode,
+                config.hook_timeout
+            )
+
+        logger.info("Streaming backup to %s.", repo)
+        try:
+            with timer.phase("stream"), \
+                    metrics.REPO_BACKUP_DURATION.time(
+                        service=service.name,
+                        repo=repo
+                    ):
+                summary = self.lock_recovery.retry(
+                    repo,
+                    lambda: self.restic_backup(
+                        service,
+                        repo,
+                        tags=config.snapshot_tags(repo),
+                        stdin=(config.stream_filename, feed)
+                    ),
+                    self.run_restic_once
+                )
+        except SwarmException as e:
+            logger.error("Stream command failed: %s", e)
+            return result.fail(e)
+        except subprocess.CalledProcessError as e:
+            logger.error("Restic returned error code: %s", e.returncode)
+            if ResticUtils.is_missing_repo_error(e.stderr):
+                self.repo_cache.invalidate(self.ssh_host, repo)
+            return result.fail(e)
+
+        self.log_summary(service, repo, summary)
+        return "done"
+
+    def backup_repos_concurrently(
+        self,
+        service: Service,
+        config: ServiceBackupConfig,
+        timer: PhaseTimer,
+        result: BackupResult
+    ) -> Dict[str, str]:
+        """Backup up to repo_concurrency repositories at the same time.
+
+        A service with a shared repository only has a single repository
+        for its paths. The stream of the service is backed up like any
+        other repository.
+
+        :param Service service: The service to backup.
+        :param ServiceBackupConfig config: The parsed config of the service.
+        :param PhaseTimer timer: The PhaseTimer of the backup job.
+        :param BackupResult result: The BackupResult of the backup job.
+
+        :return: The results of backup_repo() keyed by repository.
+        :rtype: Dict[str, str]
+        """
+
+        def backup_one(repo: str) -> str:
+            started = time.time()
+            if repo == config.stream_repo:
+                ret = self.backup_stream(service, config, timer, result)
+            else:
+                ret = self.backup_repo(service, repo, timer, result, config)
+
+            if self.history is not None:
+                self.history.record(
+                    service.name,
+                    service.id,
+                    repo,
+                    started,
+                    ret,
+                    summary=self.progress.summary(service.name, repo)
+                    if ret == "done" else None
+                )
+
+            return ret
+
+        repos = config.repositories()
+        workers = max(1, min(self.repo_concurrency, len(repos)))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(repos, pool.map(backup_one, repos)))
+
+    def backup_repos(
+        self,
+        service: Service,
+        config: ServiceBackupConfig,
+        result: BackupResult
+    ) -> None:
+        """Backup repositories of a service and run hooks.
+
+        Snapshots of all repositories are taken first, the post-backup
+        hook is run after that and finally old snapshots are forgotten
+        once per repository. Skipped repositories count as successful
+        but nothing is forgotten from them. Up to repo_concurrency
+        repositories are backed up at the same time.
 
-            # Forget old snapshots.
-            self.forget(service)
+        :param Service service: The service to backup.
+        :param ServiceBackupConfig config: The parsed config of the service.
+        :param BackupResult result: The BackupResult where errors of the
+            backup job are recorded.
+        """
+
+        pre_hook = config.pre_hook
+        post_hook = config.post_hook
+        timer = PhaseTimer(
+            lambda phase, d: self.observe_phase(service, phase, d)
+        )
+
+        # Volumes are only backed up on the node where the service runs.
+        try:
+            if config.volumes and not self.volumes.runs_on(
+                service,
+                self.hooks.node_id()
+            ):
+                raise ConfigException(
+                    "Service {} has no running tasks on this node. Unable "
+                    "to backup its volumes.".format(service.name)
+                )
+        except SwarmException as e:
+            logger.error(e)
+            result.fail(e)
+            return
+
+        # Run pre-backup hook.
+        if pre_hook is not None:
+            logger.info("Running pre-backup hook.")
+            try:
+                with timer.phase("pre-hook"):
+                    self.run_in_service(service, pre_hook, config)
+            except SwarmException as e:
+                logger.error(e)
+                result.fail(e)
+                return
+
+        # Only the restic phases count against the limit of the host.
+        with self.repo_locks.hold_host(self.ssh_host):
+            window_start = time.monotonic()
+            results = self.backup_repos_concurrently(
+                service,
+                config,
+                timer,
+                result
+            )
+            window = time.monotonic() - window_start
+
+        backed_up = sorted(r for r in results if results[r] == "done")
 
         # Run post-backup hook.
         if post_hook is not None:
             logger.info("Running post-backup hook.")
             try:
-                self.run_in_service(service, post_hook)
+                with timer.phase("post-hook"):
+                    self.run_in_service(service, post_hook, config)
             except SwarmException as e:
                 logger.error(e)
-                ret = False
+                result.fail(e)
 
-        return ret
+        # Forget old snapshots once per repository.
+        with timer.phase("forget"), \
+                self.repo_locks.hold_host(self.ssh_host):
+            for r in backed_up:
+                self.forget(
+                    r,
+                    config.repo_tag(r),
+                    self.maintainer.defers_prune(config)
+                )
+
+        metrics.BACKUP_DURATION.observe(timer.elapsed, service=service.name)
+        logger.info(
+            "Backup of service %s took %.2fs, repositories %.2fs (%s).",
+            service.name,
+            timer.elapsed,
+            window,
+            timer.summary()
+        )
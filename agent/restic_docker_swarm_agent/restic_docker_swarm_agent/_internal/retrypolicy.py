@@ -0,0 +1,221 @@
+"""Retrying failed backups with exponential backoff."""
+
+import random
+import logging
+import threading
+import subprocess
+from typing import Dict, FrozenSet, Iterable, Set, Union
+
+from docker.errors import DockerException
+
+from restic_docker_swarm_agent._internal.exceptions import \
+    SwarmException, HookException, ConfigException, ResticException
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+
+logger = logging.getLogger(__name__)
+
+
+class BackupResult:
+    """The result of a backup job.
+
+    The kind of each error encountered during the job is recorded, so
+    that the job can be retried if it only failed because of transient
+    errors. A BackupResult is truthy if no errors were recorded.
+    """
+
+    def __init__(self):
+        """Initialize a BackupResult."""
+
+        self.errors = set()
+        self.lock = threading.Lock()
+
+    def __bool__(self) -> bool:
+        with self.lock:
+            return not self.errors
+
+    def __repr__(self) -> str:
+        return "BackupResult({})".format(", ".join(self.kinds))
+
+    @property
+    def kinds(self) -> Set[str]:
+        """Get the kinds of the recorded errors.
+
+        :return: A set of error kinds.
+        :rtype: Set[str]
+        """
+
+        with self.lock:
+            return set(self.errors)
+
+    def fail(self, error: Union[str, BaseException]) -> str:
+        """Record an error.
+
+        :param Union[str, BaseException] error: An error kind or an
+            exception which is classified with RetryPolicy.classify().
+
+        :return: 'failed' for use as the result of a repository.
+        :rtype: str
+        """
+
+        if not isinstance(error, str):
+            error = RetryPolicy.classify(error)
+
+        with self.lock:
+            self.errors.add(error)
+
+        return "failed"
+
+
+class RetryPolicy:
+    """Decide whether and when a failed backup is retried.
+
+    Failures are classified by their cause. Only transient errors,
+    eg. lost SSH connections to the SFTP host or failing Docker API
+    calls, are retried by default. Corrupted repositories, failing
+    hooks and configuration errors need an administrator, so retrying
+    them would only put more load on the hosts.
+    """
+
+    KINDS = (
+        "network",
+        "docker",
+        "locked",
+        "hook",
+        "repository",
+        "config",
+        "other"
+    )
+
+    def __init__(
+        self,
+        retries: int = 3,
+        backoff: float = 60,
+        max_backoff: float = 3600,
+        jitter: float = 0.1,
+        retry_on: Iterable[str] = ("network", "docker", "locked")
+    ):
+        """Initialize a RetryPolicy.
+
+        :param int retries: The maximum number of retries of a backup.
+        :param float backoff: The delay before the first retry in seconds.
+            The delay is doubled for each retry.
+        :param float max_backoff: The maximum delay between retries.
+        :param float jitter: The maximum random deviation of the delay as
+            a fraction of the delay.
+        :param Iterable[str] retry_on: The error kinds which are retried.
+        """
+
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = frozenset(retry_on)
+        self.lock = threading.Lock()
+        self.counters = {"scheduled": 0, "exhausted": 0}
+
+    @classmethod
+    def parse_kinds(cls, spec: str) -> FrozenSet[str]:
+        """Parse a comma separated list of error kinds.
+
+        :param str spec: The list, eg. 'network,docker'.
+
+        :return: The error kinds.
+        :rtype: FrozenSet[str]
+
+        :raises ValueError: If an error kind is unknown.
+        """
+
+        kinds = frozenset(x.strip() for x in spec.split(",") if x.strip())
+        unknown = kinds - set(cls.KINDS)
+        if unknown:
+            raise ValueError(
+                "Unknown error kinds: {}. Expected any of: {}.".format(
+                    ", ".join(sorted(unknown)),
+                    ", ".join(cls.KINDS)
+                )
+            )
+
+        return kinds
+
+    @staticmethod
+    def classify(error: BaseException) -> str:
+        """Classify an error by its cause.
+
+        :param BaseException error: The error.
+
+        :return: One of the error kinds in KINDS.
+        :rtype: str
+        """
+
+        if isinstance(error, ResticException) and \
+                error.__cause__ is not None:
+            error = error.__cause__
+
+        if isinstance(error, HookException):
+            return "hook"
+        if isinstance(error, ConfigException):
+            return "config"
+        if isinstance(error, (SwarmException, DockerException)):
+            return "docker"
+        if isinstance(error, subprocess.CalledProcessError):
+            return ResticUtils.classify_error(error.stderr)
+        if isinstance(error, ValueError):
+            return "config"
+
+        return "other"
+
+    def delay(self, attempt: int) -> float:
+        """Get the delay before a retry.
+
+        :param int attempt: The number of the retry starting from 0.
+
+        :return: The delay in seconds.
+        :rtype: float
+        """
+
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def should_retry(self, result: object, attempt: int) -> bool:
+        """Check whether a failed backup should be retried.
+
+        :param object result: The result of the backup. Results without
+            recorded error kinds are never retried.
+        :param int attempt: The number of retries done so far.
+
+        :return: True if the backup should be retried.
+        :rtype: bool
+        """
+
+        if result:
+            return False
+
+        kinds = getattr(result, "kinds", set())
+        with self.lock:
+            for k in kinds:
+                self.counters[k] = self.counters.get(k, 0) + 1
+
+            # Permanent errors aren't retried even with transient ones.
+            if not kinds or not kinds <= self.retry_on:
+                return False
+
+            if attempt >= self.retries:
+                self.counters["exhausted"] += 1
+                return False
+
+            self.counters["scheduled"] += 1
+
+        return True
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Get the retry counters.
+
+        The counters include the number of failed backups per error kind.
+
+        :return: The counters as a dict.
+        :rtype: Dict[str, int]
+        """
+
+        with self.lock:
+            return self.counters.copy()
@@ -0,0 +1,441 @@
+"""Parsed backup configuration of services."""
+
+import logging
+import threading
+from typing import \
+    Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from croniter import croniter
+from croniter import CroniterBadCronError
+from docker.models.services import Service
+
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+from restic_docker_swarm_agent._internal.hookrunner import HookRunner
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceBackupConfig:  # pylint: disable=too-many-instance-attributes
+    """The immutable backup configuration of a service spec version.
+
+    All backup labels of the service are parsed and validated once
+    when the object is created. Invalid values are replaced by None
+    and the reasons are listed in 'errors'.
+    """
+
+    __slots__ = (
+        "service_id",
+        "name",
+        "version",
+        "enabled",
+        "run_at",
+        "repos",
+        "volumes",
+        "shared_repo",
+        "pre_hook",
+        "post_hook",
+        "hook_mode",
+        "hook_timeout",
+        "stream",
+        "stream_repo",
+        "stream_filename",
+        "full_interval",
+        "maintenance_at",
+        "maintenance",
+        "errors"
+    )
+
+    def __init__(  # pylint: disable=too-many-locals
+        self,
+        service_id: str,
+        name: str,
+        *,
+        version: Optional[int],
+        enabled: bool,
+        run_at: Optional[str],
+        repos: FrozenSet[str],
+        volumes: FrozenSet[str],
+        shared_repo: Optional[str],
+        pre_hook: Optional[str],
+        post_hook: Optional[str],
+        hook_mode: str,
+        hook_timeout: Optional[int],
+        stream: Optional[str],
+        stream_repo: Optional[str],
+        stream_filename: str,
+        full_interval: Optional[int],
+        maintenance_at: Optional[str],
+        maintenance: Optional[Tuple[str, ...]],
+        errors: Tuple[str, ...]
+    ):
+        """Initialize a ServiceBackupConfig.
+
+        Use from_service() to parse the config of a service.
+
+        :param str service_id: The ID of the service.
+        :param str name: The name of the service.
+        :param Optional[int] version: The version index of the service spec.
+        :param bool enabled: True if backups are enabled.
+        :param Optional[str] run_at: The cron expression or None if invalid.
+        :param FrozenSet[str] repos: The repositories of the service.
+        :param FrozenSet[str] volumes: The named volumes of the service
+            which are backed up from the node where they are stored.
+        :param Optional[str] shared_repo: The repository where all paths
+            are backed up at once or None if each path has its own.
+        :param Optional[str] pre_hook: The pre-backup hook command.
+        :param Optional[str] post_hook: The post-backup hook command.
+        :param str hook_mode: The tasks to run hooks in: 'single', 'all'
+            or 'local'.
+        :param Optional[int] hook_timeout: The hook timeout in seconds or
+            None to use the default timeout.
+        :param Optional[str] stream: A command whose output is backed up
+            from stdin or None if nothing is streamed.
+        :param Optional[str] stream_repo: The repository of the stream.
+        :param str stream_filename: The file name of the stream in the
+            snapshot.
+        :param Optional[int] full_interval: The full backup interval.
+        :param Optional[str] maintenance_at: The cron expression of
+            maintenance jobs or None to use the default schedule.
+        :param Optional[Tuple[str, ...]] maintenance: The maintenance tasks
+            or None to use the default tasks.
+        :param Tuple[str, ...] errors: Configuration error messages.
+        """
+
+        self.service_id = service_id
+        self.name = name
+        self.version = version
+        self.enabled = enabled
+        self.run_at = run_at
+        self.repos = repos
+        self.volumes = volumes
+        self.shared_repo = shared_repo
+        self.pre_hook = pre_hook
+        self.post_hook = post_hook
+        self.hook_mode = hook_mode
+        self.hook_timeout = hook_timeout
+        self.stream = stream
+        self.stream_repo = stream_repo
+        self.stream_filename = stream_filename
+        self.full_interval = full_interval
+        self.maintenance_at = maintenance_at
+        self.maintenance = maintenance
+        self.errors = errors
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        # Attributes can only be set once in __init__().
+        if hasattr(self, name):
+            raise AttributeError("ServiceBackupConfig is immutable.")
+        object.__setattr__(self, name, value)
+
+    def __repr__(self) -> str:
+        return "ServiceBackupConfig({})".format(", ".join(
+            "{}={!r}".format(x, getattr(self, x))
+            for x in ServiceBackupConfig.__slots__
+        ))
+
+    @staticmethod
+    def version_of(s: Service) -> Optional[int]:
+        """Get the spec version of a service.
+
+        :param Service s: The service.
+
+        :return: The version index or None if it's unknown.
+        :rtype: Optional[int]
+        """
+
+        return (s.attrs.get("Version") or {}).get("Index")
+
+    def targets(self) -> Dict[str, List[str]]:
+        """Get the paths backed up to each repository.
+
+        Each volume is backed up like a path with the name of the volume.
+
+        :return: A dict of repository -> backup paths.
+        :rtype: Dict[str, List[str]]
+        """
+
+        paths = self.repos | self.volumes
+        if not paths:
+            return {}
+
+        if self.shared_repo is None:
+            return {r: [r] for r in sorted(paths)}
+
+        return {self.shared_repo: sorted(paths)}
+
+    def repositories(self) -> List[str]:
+        """Get all repositories the service is backed up to.
+
+        :return: A sorted list of repositories.
+        :rtype: List[str]
+        """
+
+        ret = set(self.targets())
+        if self.stream is not None:
+            ret.add(self.stream_repo)
+
+        return sorted(ret)
+
+    def service_tag(self) -> str:
+        """Get the tag which marks the snapshots of the service.
+
+        :return: The tag.
+        :rtype: str
+        """
+
+        return "rds-service={}".format(self.name)
+
+    def repo_tag(self, repo: str) -> Optional[str]:
+        """Get the tag which marks the snapshots of the service in a repo.
+
+        Snapshots are only tagged in repositories which other services
+        may share, ie. shared repositories and stream repositories.
+
+        :param str repo: The repository.
+
+        :return: The tag or None if the repository isn't shared.
+        :rtype: Optional[str]
+        """
+
+        if repo in (self.shared_repo, self.stream_repo):
+            return self.service_tag()
+
+        return None
+
+    def snapshot_tags(self, repo: str) -> List[str]:
+        """Get the tags of the snapshots taken of the service in a repo.
+
+        :param str repo: The repository.
+
+        :return: A list of tags.
+        :rtype: List[str]
+        """
+
+        if repo == self.stream_repo:
+            return [
+                self.service_tag(),
+                "rds-stream={}".format(self.stream_filename)
+            ]
+
+        if repo == self.shared_repo:
+            return [self.service_tag()] + [
+                "rds-path={}".format(x) for x in sorted(self.repos)
+            ] + ["rds-volume={}".format(x) for x in sorted(self.volumes)]
+
+        return []
+
+    @staticmethod
+    def check_cron(spec: str) -> str:
+        """Validate a cron expression.
+
+        :param str spec: The cron expression.
+
+        :return: The cron expression.
+        :rtype: str
+
+        :raises ValueError: If the expression is invalid.
+        """
+
+        try:
+            croniter(spec)
+        except (CroniterBadCronError, ValueError, KeyError) as e:
+            raise ValueError(
+                "Invalid cron expression '{}': {}".format(spec, e)
+            ) from e
+
+        return spec
+
+    @staticmethod
+    def parse_label(
+        spec: Optional[str],
+        parser: Callable[[str], Any],
+        errors: List[str]
+    ) -> Any:
+        """Parse the value of a label and collect errors.
+
+        :param Optional[str] spec: The value of the label or None.
+        :param Callable[[str], Any] parser: A function which parses the
+            value and raises ValueError if it's invalid.
+        :param List[str] errors: A list where the error message is added.
+
+        :return: The parsed value or None if the label is missing or
+            invalid.
+        :rtype: Any
+        """
+
+        if spec is None:
+            return None
+
+        try:
+            return parser(spec)
+        except ValueError as e:
+            errors.append(str(e))
+            return None
+
+    @classmethod
+    def from_service(cls, s: Service) -> "ServiceBackupConfig":
+        """Parse the backup configuration of a service.
+
+        :param Service s: The service.
+
+        :return: The parsed configuration.
+        :rtype: ServiceBackupConfig
+        """
+
+        errors = []
+
+        run_at = ResticUtils.service_backup_at(s)
+        if run_at is None:
+            errors.append("Missing rds.backup.at label.")
+        run_at = cls.parse_label(run_at, cls.check_cron, errors)
+
+        full_interval = cls.parse_label(
+            ResticUtils.service_backup_full_interval(s),
+            ResticUtils.parse_duration,
+            errors
+        )
+        maintenance_at = cls.parse_label(
+            ResticUtils.service_backup_maintenance_at(s),
+            cls.check_cron,
+            errors
+        )
+        maintenance = cls.parse_label(
+            ResticUtils.service_backup_maintenance(s),
+            lambda x: tuple(ResticUtils.parse_maintenance_tasks(x)),
+            errors
+        )
+
+        hook_mode = ResticUtils.service_backup_hook_mode(s) or "single"
+        if hook_mode not in HookRunner.MODES:
+            errors.append(
+                "Invalid hook mode '{}'. Expected one of: {}.".format(
+                    hook_mode,
+                    ", ".join(HookRunner.MODES)
+                )
+            )
+            hook_mode = "single"
+
+        hook_timeout = cls.parse_label(
+            ResticUtils.service_backup_hook_timeout(s),
+            ResticUtils.parse_duration,
+            errors
+        )
+
+        repos = frozenset(ResticUtils.service_backup_repos(s))
+        volumes = frozenset(ResticUtils.service_backup_volumes(s))
+        if volumes & repos:
+            errors.append(
+                "Volumes {} are also listed in rds.backup.repos."
+                .format(", ".join(sorted(volumes & repos)))
+            )
+            volumes = volumes - repos
+
+        shared_repo = ResticUtils.service_backup_shared_repo(s)
+        if shared_repo is not None:
+            shared_repo = shared_repo.strip() or None
+
+        stream = ResticUtils.service_backup_stream(s)
+        stream_repo = ResticUtils.service_backup_stream_repo(s) or s.name
+        if stream is not None and \
+                stream_repo in repos | volumes | {shared_repo}:
+            errors.append(
+                "Stream repository {} is also used for paths."
+                .format(stream_repo)
+            )
+            stream = None
+
+        if not repos and not volumes and stream is None:
+            errors.append("No repositories defined.")
+
+        return cls(
+            service_id=s.id,
+            name=s.name,
+            version=cls.version_of(s),
+            enabled=ResticUtils.service_backup(s),
+            run_at=run_at,
+            repos=repos,
+            volumes=volumes,
+            shared_repo=shared_repo,
+            pre_hook=ResticUtils.service_backup_pre_hook(s),
+            post_hook=ResticUtils.service_backup_post_hook(s),
+            hook_mode=hook_mode,
+            hook_timeout=hook_timeout,
+            stream=stream,
+            stream_repo=stream_repo if stream is not None else None,
+            stream_filename=(
+                ResticUtils.service_backup_stream_filename(s) or "stdin"
+            ),
+            full_interval=full_interval,
+            maintenance_at=maintenance_at,
+            maintenance=maintenance,
+            errors=tuple(errors)
+        )
+
+
+class ServiceConfigCache:
+    """A cache of parsed service configurations.
+
+    The configuration of a service is only parsed again when the
+    version of the service spec changes. Configuration errors are
+    logged once per version.
+    """
+
+    def __init__(self):
+        """Initialize a ServiceConfigCache."""
+
+        self.configs = {}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "parses": 0}
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Get the cache counters.
+
+        :return: The counters as a dict.
+        :rtype: Dict[str, int]
+        """
+
+        with self.lock:
+            stats = self.counters.copy()
+            stats["cached"] = len(self.configs)
+
+        return stats
+
+    def get(self, s: Service) -> ServiceBackupConfig:
+        """Get the parsed configuration of a service.
+
+        :param Service s: The service.
+
+        :return: The parsed configuration.
+        :rtype: ServiceBackupConfig
+        """
+
+        version = ServiceBackupConfig.version_of(s)
+
+        with self.lock:
+            cfg = self.configs.get(s.id)
+            if cfg is not None and version is not None and \
+                    cfg.version == version:
+                self.counters["hits"] += 1
+                return cfg
+
+        cfg = ServiceBackupConfig.from_service(s)
+        for e in cfg.errors:
+            logger.error("Service %s: %s", s.name, e)
+
+        with self.lock:
+            self.configs[s.id] = cfg
+            self.counters["parses"] += 1
+
+        return cfg
+
+    def retain(self, service_ids: Iterable[str]) -> None:
+        """Drop the configurations of all other services.
+
+        :param Iterable[str] service_ids: The IDs of services to keep.
+        """
+
+        keep = set(service_ids)
+        with self.lock:
+            for sid in [x for x in self.configs if x not in keep]:
+                del self.configs[sid]
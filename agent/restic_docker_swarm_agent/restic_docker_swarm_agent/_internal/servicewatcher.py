@@ -0,0 +1,189 @@
+"""Event-driven service discovery."""
+
+import logging
+import time
+import threading
+from typing import Callable, Dict, List, Optional
+
+from docker.errors import DockerException, NotFound
+from docker.models.services import Service
+from docker.client import DockerClient
+from requests.exceptions import RequestException
+
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+from restic_docker_swarm_agent._internal import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceWatcher:
+    """Keep a local cache of backup-labelled services.
+
+    The cache is kept up-to-date by subscribing to the Docker events
+    stream. A full resync using services.list() is only done when
+    the watcher starts, periodically every resync_interval seconds
+    and after the events stream fails.
+    """
+
+    RETRY_INTERVAL = 5
+
+    def __init__(
+        self,
+        docker_client: DockerClient,
+        resync_interval: int,
+        on_change: Optional[Callable[[], None]] = None
+    ):
+        """Initialize a ServiceWatcher.
+
+        :param DockerClient docker_client: The DockerClient to use.
+        :param int resync_interval: Full resync interval in seconds.
+        :param Callable[[], None] on_change: A function to call whenever
+            the service cache changes.
+        """
+
+        self.docker_client = docker_client
+        self.resync_interval = resync_interval
+        self.on_change = on_change
+
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        self.counters = {
+            "events": 0,
+            "resyncs": 0,
+            "api_calls": 0,
+            "api_calls_avoided": 0,
+            "last_resync": None
+        }
+
+    @property
+    def stats(self) -> Dict[str, Optional[float]]:
+        """Get a copy of the discovery counters.
+
+        :return: The counters as a dict.
+        :rtype: Dict[str, Optional[float]]
+        """
+
+        with self.cache_lock:
+            stats = self.counters.copy()
+            stats["cached_services"] = len(self.cache)
+
+        stats["mode"] = "events"
+        return stats
+
+    def services(self) -> List[Service]:
+        """Get all cached backup-labelled services.
+
+        Once the cache is synced, every call replaces one
+        services.list() call and is therefore counted as an avoided API
+        call. The cache is empty before the first resync.
+
+        :return: A list of Service objects.
+        :rtype: List[Service]
+        """
+
+        with self.cache_lock:
+            if self.counters["last_resync"] is not None:
+                self.counters["api_calls_avoided"] += 1
+            return list(self.cache.values())
+
+    def get(self, service_id: str) -> Optional[Service]:
+        """Get a cached service by its ID.
+
+        :param str service_id: The ID of the service.
+
+        Only services found in the cache are counted as avoided API
+        calls.
+
+        :return: The Service or None if it's not in the cache.
+        :rtype: Optional[Service]
+        """
+
+        with self.cache_lock:
+            service = self.cache.get(service_id)
+            if service is not None:
+                self.counters["api_calls_avoided"] += 1
+            return service
+
+    def notify(self) -> None:
+        """Call the on_change callback if one is set."""
+
+        if self.on_change is not None:
+            self.on_change()
+
+    def resync(self) -> None:
+        """Rebuild the service cache from services.list()."""
+
+        with metrics.DOCKER_API_DURATION.time(call="services.list"):
+            services = self.docker_client.services.list()
+
+        with self.cache_lock:
+            self.cache = {
+                s.id: s for s in services if ResticUtils.service_backup(s)
+            }
+            self.counters["api_calls"] += 1
+            self.counters["resyncs"] += 1
+            self.counters["last_resync"] = time.time()
+
+            logger.debug(
+                "Service cache resynced: %s backup services.",
+                len(self.cache)
+            )
+
+        self.notify()
+
+    def handle_event(self, event: dict) -> None:
+        """Update the service cache based on a Docker service event.
+
+        :param dict event: The decoded Docker event.
+        """
+
+        action = event.get("Action")
+        sid = event.get("Actor", {}).get("ID")
+
+        if sid is None or action not in ("create", "update", "remove"):
+            return
+
+        logger.debug("Service event: %s %s", action, sid)
+
+        service = None
+        if action != "remove":
+            try:
+                with metrics.DOCKER_API_DURATION.time(call="services.get"):
+                    service = self.docker_client.services.get(sid)
+            except NotFound:
+                pass
+
+        with self.cache_lock:
+            self.counters["events"] += 1
+            if action != "remove":
+                self.counters["api_calls"] += 1
+
+            if service is not None and ResticUtils.service_backup(service):
+                self.cache[sid] = service
+            else:
+                self.cache.pop(sid, None)
+
+        self.notify()
+
+    def run(self) -> None:
+        """Run the service watcher."""
+
+        logger.info("Starting the service watcher thread.")
+
+        while True:
+            since = int(time.time())
+            try:
+                self.resync()
+
+                # The stream ends at 'until' which triggers a full resync.
+                stream = self.docker_client.events(
+                    decode=True,
+                    since=since,
+                    until=since + self.resync_interval,
+                    filters={"type": "service"}
+                )
+                for event in stream:
+                    self.handle_event(event)
+            except (DockerException, RequestException) as e:
+                logger.error("Docker events stream failed: %s", e)
+                time.sleep(ServiceWatcher.RETRY_INTERVAL)
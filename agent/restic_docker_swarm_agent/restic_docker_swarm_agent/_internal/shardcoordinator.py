@@ -0,0 +1,234 @@
+"""Sharding of services between agent replicas."""
+
+import time
+import socket
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Optional, Set, Tuple
+
+from docker.errors import APIError
+from docker.client import DockerClient
+
+from restic_docker_swarm_agent._internal import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ShardCoordinator:  # pylint: disable=too-many-instance-attributes
+    """Split the services to back up between the replicas of the agent.
+
+    The running tasks of the agent service are the members of the
+    shard ring. Each service is owned by one agent chosen with
+    rendezvous hashing among the agents which run on the same node as
+    a task of the service, or among all agents if there are none. All
+    agents see the same task list, so they agree on the owners without
+    talking to each other.
+
+    A leaving agent only hands over its own services and a joining
+    agent only takes services over. Because of the node preference,
+    however, a joining agent takes over all services on its node which
+    had no agent there, and a service moves whenever its tasks are
+    rescheduled to a node with a different agent.
+    """
+
+    TASK_LABEL = "com.docker.swarm.task.id"
+
+    def __init__(
+        self,
+        docker_client: DockerClient,
+        agent_service: str,
+        task_id: Optional[str] = None,
+        refresh_interval: float = 30
+    ):
+        """Initialize a ShardCoordinator.
+
+        :param DockerClient docker_client: The DockerClient to use.
+        :param str agent_service: The name or ID of the agent service.
+        :param Optional[str] task_id: The task ID of this agent. If this
+            is None, it's read from the labels of the agent container
+            whose ID is the hostname. That only works if the hostname of
+            the container isn't overridden.
+        :param float refresh_interval: The number of seconds after which
+            the task list is fetched again.
+        """
+
+        self.docker_client = docker_client
+        self.agent_service = agent_service
+        self.task_id = task_id
+        self.refresh_interval = refresh_interval
+
+        self.agents = {}
+        self.service_nodes = {}
+        self.refreshed = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def weight(service_id: str, task_id: str) -> int:
+        """Get the rendezvous hashing weight of an agent for a service.
+
+        :param str service_id: The ID of the service.
+        :param str task_id: The task ID of the agent.
+
+        :return: The weight.
+        :rtype: int
+        """
+
+        digest = hashlib.sha256(
+            "{}/{}".format(service_id, task_id).encode("utf-8")
+        ).hexdigest()
+        return int(digest[:16], 16)
+
+    @classmethod
+    def owner(
+        cls,
+        service_id: str,
+        agents: Dict[str, str],
+        nodes: Set[str]
+    ) -> Optional[str]:
+        """Choose the agent which owns a service.
+
+        :param str service_id: The ID of the service.
+        :param Dict[str, str] agents: A dict of agent task ID -> node ID.
+        :param Set[str] nodes: The nodes where the service has tasks.
+
+        :return: The task ID of the owner or None if there are no agents.
+        :rtype: Optional[str]
+        """
+
+        candidates = [t for t, n in agents.items() if n in nodes]
+        if not candidates:
+            candidates = list(agents)
+        if not candidates:
+            return None
+
+        return max(candidates, key=lambda t: cls.weight(service_id, t))
+
+    def own_task_id(self) -> str:
+        """Get the task ID of this agent.
+
+        :return: The task ID.
+        :rtype: str
+
+        :raises APIError: If the agent container can't be inspected.
+        :raises KeyError: If the container isn't a swarm task.
+        """
+
+        if self.task_id is None:
+            with metrics.DOCKER_API_DURATION.time(call="containers.inspect"):
+                attrs = self.docker_client.api.inspect_container(
+                    socket.gethostname()
+                )
+            self.task_id = attrs["Config"]["Labels"][
+                ShardCoordinator.TASK_LABEL
+            ]
+            logger.info("Agent task ID is %s.", self.task_id)
+
+        return self.task_id
+
+    def fetch(self) -> Tuple[Dict[str, str], Dict[str, Set[str]]]:
+        """Fetch the running agents and the nodes of all services.
+
+        :return: A tuple of a dict of agent task ID -> node ID and a dict
+            of service ID -> node IDs.
+        :rtype: Tuple[Dict[str, str], Dict[str, Set[str]]]
+
+        :raises APIError: If the Docker API calls fail.
+        """
+
+        with metrics.DOCKER_API_DURATION.time(call="services.inspect"):
+            agent_sid = self.docker_client.api.inspect_service(
+                self.agent_service
+            )["ID"]
+        with metrics.DOCKER_API_DURATION.time(call="tasks.list"):
+            tasks = self.docker_client.api.tasks(
+                filters={"desired-state": "running"}
+            )
+
+        agents = {}
+        service_nodes = {}
+        for t in tasks:
+            if (t.get("Status") or {}).get("State") != "running":
+                continue
+
+            if t.get("ServiceID") == agent_sid:
+                agents[t["ID"]] = t.get("NodeID")
+            else:
+                service_nodes.setdefault(t.get("ServiceID"), set()).add(
+                    t.get("NodeID")
+                )
+
+        return agents, service_nodes
+
+    def refresh(self, force: bool = False) -> None:
+        """Fetch the task list if it's older than refresh_interval.
+
+        If fetching fails, the previous task list is kept.
+
+        :param bool force: Fetch the task list even if it's recent.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.refreshed is not None and \
+                    now - self.refreshed < self.refresh_interval:
+                return
+
+            self.refreshed = now
+            try:
+                task_id = self.own_task_id()
+                agents, service_nodes = self.fetch()
+            except (APIError, KeyError) as e:
+                logger.error("Failed to refresh the shard members: %s", e)
+                return
+
+            # This agent may not be running yet according to the API.
+            agents.setdefault(task_id, None)
+
+            if sorted(agents) != sorted(self.agents):
+                logger.info(
+                    "Shard members changed: %s agents.",
+                    len(agents)
+                )
+
+            self.agents = agents
+            self.service_nodes = service_nodes
+
+    def owns(self, service_id: str) -> bool:
+        """Check whether this agent should back up a service.
+
+        If the members are unknown, all services are owned so that
+        no backups are missed.
+
+        :param str service_id: The ID of the service.
+
+        :return: True if this agent owns the service.
+        :rtype: bool
+        """
+
+        self.refresh()
+
+        with self.lock:
+            if not self.agents:
+                return True
+
+            return self.owner(
+                service_id,
+                self.agents,
+                self.service_nodes.get(service_id, set())
+            ) == self.task_id
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Get statistics about the shard.
+
+        :return: A dict with the task ID of the agent and the members.
+        :rtype: Dict[str, Any]
+        """
+
+        with self.lock:
+            return {
+                "task_id": self.task_id,
+                "agents": len(self.agents),
+                "members": sorted(self.agents)
+            }
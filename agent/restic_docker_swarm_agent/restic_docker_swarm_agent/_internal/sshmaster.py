@@ -0,0 +1,260 @@
+"""Managed multiplexed SSH master connections."""
+
+import os
+import time
+import hashlib
+import logging
+import subprocess
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SSHMaster:
+    """A multiplexed SSH master connection to an SFTP host.
+
+    The master connection is started on demand and it exits
+    automatically after it has been idle for 'persist' seconds.
+    SSH sessions started with the options from ssh_opts() reuse
+    the master connection instead of opening a new connection.
+
+    The master is only checked every CHECK_INTERVAL seconds. If it
+    exits in between, the next session becomes the new master since
+    the sessions use ControlMaster=auto.
+    """
+
+    CHECK_INTERVAL = 30
+
+    def __init__(
+        self,
+        host: str,
+        port: Optional[int],
+        opts: Optional[List[str]],
+        control_dir: str,
+        persist: int
+    ):
+        """Initialize an SSHMaster.
+
+        :param str host: The SSH host.
+        :param Optional[int] port: The SSH port number.
+        :param Optional[List[str]] opts: A list of SSH arguments.
+        :param str control_dir: The directory for the control socket.
+        :param int persist: The idle time of the master in seconds.
+        """
+
+        self.host = host
+        self.port = port
+        self.opts = opts or []
+        self.persist = persist
+
+        # Hash the host to keep the socket path short enough.
+        digest = hashlib.sha1(
+            "{}:{}".format(host, port).encode("utf-8")
+        ).hexdigest()
+        self.control_path = os.path.join(control_dir, "cm-" + digest[:16])
+
+        self.lock = threading.Lock()
+        self.counters = {
+            "alive": False,
+            "started": None,
+            "starts": 0,
+            "failures": 0,
+            "checked": None,
+            "checks": 0,
+            "sessions": 0
+        }
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Get a copy of the master connection counters.
+
+        :return: The counters as a dict.
+        :rtype: Dict[str, Any]
+        """
+
+        with self.lock:
+            return self.counters.copy()
+
+    def ssh_opts(self, master: str = "auto") -> List[str]:
+        """Get the SSH options for using the master connection.
+
+        :param str master: The value of the ControlMaster option.
+
+        :return: A list of SSH options.
+        :rtype: List[str]
+        """
+
+        return [
+            "-o", "ControlMaster={}".format(master),
+            "-o", "ControlPath={}".format(self.control_path),
+            "-o", "ControlPersist={}".format(self.persist)
+        ]
+
+    def ssh(self, *args) -> int:
+        """Run ssh with the master connection options.
+
+        All varargs are passed to ssh before the host.
+
+        :return: The exit code of ssh.
+        :rtype: int
+        """
+
+        cmd = ["ssh"]
+        cmd.extend(args)
+        cmd.extend(self.opts)
+        if self.port is not None:
+            cmd.extend(["-p", str(self.port)])
+        cmd.append(self.host)
+
+        return subprocess.run(
+            cmd,
+            check=False,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        ).returncode
+
+    def check(self) -> bool:
+        """Check whether the master connection is running.
+
+        :return: True if the master is running, False otherwise.
+        :rtype: bool
+        """
+
+        return self.ssh(
+            "-O", "check",
+            "-o", "ControlPath={}".format(self.control_path)
+        ) == 0
+
+    def remove_stale_socket(self) -> None:
+        """Remove the control socket of a master which isn't running.
+
+        ssh refuses to bind a control socket which already exists, so a
+        socket left behind by a crashed master would disable multiplexing.
+        """
+
+        try:
+            os.unlink(self.control_path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(
+                "Failed to remove stale control socket %s: %s",
+                self.control_path,
+                e
+            )
+            return
+
+        logger.info("Removed stale control socket %s.", self.control_path)
+
+    def ensure(self) -> bool:
+        """Make sure the master connection is running.
+
+        A session is counted each time the master is found running.
+
+        :return: True if the master is running, False otherwise.
+        :rtype: bool
+        """
+
+        with self.lock:
+            now = time.time()
+            checked = self.counters["checked"]
+            interval = min(SSHMaster.CHECK_INTERVAL, self.persist)
+            if self.counters["alive"] and checked is not None and \
+                    0 <= now - checked < interval:
+                self.counters["sessions"] += 1
+                return True
+
+            self.counters["checked"] = now
+            self.counters["checks"] += 1
+            if self.check():
+                self.counters["sessions"] += 1
+                self.counters["alive"] = True
+                return True
+
+            logger.info("Starting SSH master connection to %s.", self.host)
+            os.makedirs(os.path.dirname(self.control_path), exist_ok=True)
+            self.remove_stale_socket()
+
+            alive = self.ssh("-M", "-N", "-f", *self.ssh_opts("yes")) == 0
+            self.counters["alive"] = alive
+            if alive:
+                self.counters["starts"] += 1
+                self.counters["sessions"] += 1
+                self.counters["started"] = time.time()
+            else:
+                self.counters["failures"] += 1
+                logger.warning(
+                    "Failed to start SSH master connection to %s.",
+                    self.host
+                )
+
+            return alive
+
+    def stop(self) -> None:
+        """Stop the master connection."""
+
+        with self.lock:
+            self.ssh(
+                "-O", "exit",
+                "-o", "ControlPath={}".format(self.control_path)
+            )
+            self.counters["checked"] = None
+            self.counters["alive"] = False
+
+
+class SSHMasterPool:
+    """A pool of SSH master connections, one per SFTP host."""
+
+    def __init__(self, control_dir: str, persist: int):
+        """Initialize an SSHMasterPool.
+
+        :param str control_dir: The directory for the control sockets.
+        :param int persist: The idle time of the masters in seconds.
+        """
+
+        self.control_dir = control_dir
+        self.persist = persist
+        self.masters = {}
+        self.lock = threading.Lock()
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get the counters of all master connections.
+
+        :return: A dict of counter dicts keyed by host.
+        :rtype: Dict[str, Dict[str, Any]]
+        """
+
+        with self.lock:
+            masters = list(self.masters.values())
+
+        return {m.host: m.stats for m in masters}
+
+    def master(
+        self,
+        host: str,
+        port: Optional[int],
+        opts: Optional[List[str]]
+    ) -> SSHMaster:
+        """Get the SSHMaster of a host.
+
+        :param str host: The SSH host.
+        :param Optional[int] port: The SSH port number.
+        :param Optional[List[str]] opts: A list of SSH options.
+
+        :return: The SSHMaster of the host.
+        :rtype: SSHMaster
+        """
+
+        with self.lock:
+            key = (host, port)
+            if key not in self.masters:
+                self.masters[key] = SSHMaster(
+                    host,
+                    port,
+                    opts,
+                    self.control_dir,
+                    self.persist
+                )
+            return self.masters[key]
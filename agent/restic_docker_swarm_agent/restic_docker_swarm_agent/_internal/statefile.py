@@ -0,0 +1,172 @@
+"""Persistent JSON state files."""
+
+import os
+import json
+import logging
+import tempfile
+import threading
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class StateFile:
+    """A JSON dict persisted to disk.
+
+    The file is always written atomically and reloaded automatically
+    if it's modified by another process, eg. 'rds-run'. If path is
+    None, the state is only kept in memory.
+    """
+
+    def __init__(self, path: Optional[str]):
+        """Initialize a StateFile.
+
+        :param Optional[str] path: The path of the state file.
+        """
+
+        self.path = path
+        self.data = {}
+        self.mtime = None
+        self.lock = threading.RLock()
+
+    def load(self) -> None:
+        """Reload the state from disk if the file has changed."""
+
+        if self.path is None:
+            return
+
+        with self.lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                self.data = {}
+                self.mtime = None
+                return
+
+            if mtime == self.mtime:
+                return
+
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error("Failed to load state file %s: %s", self.path, e)
+                self.data = {}
+
+            self.mtime = mtime
+
+    @staticmethod
+    def write_atomic(path: str, data: str, mode: int = 0o600) -> None:
+        """Write a file atomically by renaming a temporary file.
+
+        :param str path: The path of the file.
+        :param str data: The contents of the file.
+        :param int mode: The permissions of the file.
+        """
+
+        dirname = os.path.dirname(path) or "."
+        os.makedirs(dirname, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.chmod(tmp, mode)
+            os.replace(tmp, path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+    def save(self) -> None:
+        """Write the state to disk atomically."""
+
+        if self.path is None:
+            return
+
+        with self.lock:
+            self.write_atomic(
+                self.path,
+                json.dumps(self.data, indent=2, sort_keys=True)
+            )
+            self.mtime = os.stat(self.path).st_mtime_ns
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get a value from the state.
+
+        :param str key: The key of the value.
+        :param Any default: The value to return if key doesn't exist.
+
+        :return: The value.
+        :rtype: Any
+        """
+
+        with self.lock:
+            self.load()
+            return self.data.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        """Set a value in the state and save the state to disk.
+
+        :param str key: The key of the value.
+        :param Any value: The value. This must be JSON serializable.
+        """
+
+        with self.lock:
+            self.load()
+            self.data[key] = value
+            self.save()
+
+    def pop(self, key: str) -> Any:
+        """Remove a value from the state and save the state to disk.
+
+        :param str key: The key of the value.
+
+        :return: The removed value or None if key didn't exist.
+        :rtype: Any
+        """
+
+        with self.lock:
+            self.load()
+            value = self.data.pop(key, None)
+            self.save()
+
+        return value
+
+    def pop_if(self, predicate: Callable[[str, Any], bool]) -> int:
+        """Remove all values for which a predicate is true.
+
+        The state is saved to disk once after removing the values.
+
+        :param Callable[[str, Any], bool] predicate: A function which is
+            called with each key and value.
+
+        :return: The number of removed values.
+        :rtype: int
+        """
+
+        with self.lock:
+            self.load()
+            keys = [k for k, v in self.data.items() if predicate(k, v)]
+            for k in keys:
+                del self.data[k]
+            self.save()
+
+        return len(keys)
+
+    def copy(self) -> Dict[str, Any]:
+        """Get a copy of the whole state.
+
+        :return: The state as a dict.
+        :rtype: Dict[str, Any]
+        """
+
+        with self.lock:
+            self.load()
+            return self.data.copy()
+
+    def clear(self) -> None:
+        """Remove all values from the state and save the state to disk."""
+
+        with self.lock:
+            self.data = {}
+            self.save()
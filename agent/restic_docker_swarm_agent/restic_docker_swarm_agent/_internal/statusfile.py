@@ -0,0 +1,97 @@
+"""Plain-text health status file."""
+
+import time
+import threading
+from typing import Any, Dict, List, Optional
+
+from restic_docker_swarm_agent._internal.statefile import StateFile
+
+
+class StatusFile:
+    """A health status file which can be checked with shell tools.
+
+    The file is rewritten atomically. It contains one 'key value' pair
+    per line followed by one line per service:
+
+    updated TIMESTAMP
+    services N
+    failed N
+    stale N
+    service NAME STATE LAST_SUCCESS
+
+    STATE is 'ok', 'failed', 'stale' or 'pending' and LAST_SUCCESS is
+    a timestamp or '-' if the service has never been backed up. The
+    'updated' timestamp shows whether the agent itself is still alive.
+    """
+
+    def __init__(self, path: str, stale_after: Optional[float] = None):
+        """Initialize a StatusFile.
+
+        :param str path: The path of the status file.
+        :param Optional[float] stale_after: Mark services as stale if they
+            haven't been backed up successfully for this many seconds.
+            None or 0 disables staleness checks.
+        """
+
+        self.path = path
+        self.stale_after = stale_after
+        self.lock = threading.Lock()
+
+    def state(self, service: Dict[str, Any], now: float) -> str:
+        """Get the health state of a service.
+
+        :param Dict[str, Any] service: A dict as returned by
+            BackupScheduler.health().
+        :param float now: The current time as a timestamp.
+
+        :return: 'ok', 'failed', 'stale' or 'pending'.
+        :rtype: str
+        """
+
+        if service["status"] is False:
+            return "failed"
+
+        since = service["last_success"] or service["since"]
+        if self.stale_after and now - since > self.stale_after:
+            return "stale"
+
+        return "ok" if service["status"] else "pending"
+
+    def render(self, services: List[Dict[str, Any]], now: float) -> str:
+        """Render the contents of the status file.
+
+        :param List[Dict[str, Any]] services: A list of dicts as returned
+            by BackupScheduler.health().
+        :param float now: The current time as a timestamp.
+
+        :return: The contents of the file.
+        :rtype: str
+        """
+
+        states = [(s, self.state(s, now)) for s in services]
+        lines = [
+            "updated {}".format(int(now)),
+            "services {}".format(len(states)),
+            "failed {}".format(sum(1 for _, x in states if x == "failed")),
+            "stale {}".format(sum(1 for _, x in states if x == "stale"))
+        ]
+        for s, state in sorted(states, key=lambda x: x[0]["name"]):
+            lines.append("service {} {} {}".format(
+                s["name"],
+                state,
+                "-" if s["last_success"] is None else int(s["last_success"])
+            ))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, services: List[Dict[str, Any]]) -> None:
+        """Write the status file atomically.
+
+        :param List[Dict[str, Any]] services: A list of dicts as returned
+            by BackupScheduler.health().
+        """
+
+        data = self.render(services, time.time())
+
+        with self.lock:
+            StateFile.write_atomic(self.path, data, 0o644)
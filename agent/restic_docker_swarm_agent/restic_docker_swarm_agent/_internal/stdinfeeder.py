@@ -0,0 +1,51 @@
+"""Feeding the stdin of a restic process from a thread."""
+
+import logging
+import threading
+import subprocess
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class StdinFeeder(threading.Thread):
+    """A thread which writes the stdin of a process.
+
+    Any exception raised by feed is stored in 'error' and the process
+    is killed, so that restic doesn't save a partial snapshot.
+    """
+
+    def __init__(
+        self,
+        proc: subprocess.Popen,
+        feed: Callable[[Callable[[bytes], Any]], None]
+    ):
+        """Initialize a StdinFeeder.
+
+        :param subprocess.Popen proc: The process. Its stdin must be a pipe.
+        :param feed: A function which is called with a function which
+            writes bytes to the stdin of the process.
+        """
+
+        super().__init__(name="restic-stdin", daemon=True)
+        self.proc = proc
+        self.feed = feed
+        self.error = None
+
+    def run(self) -> None:
+        """Feed the process and close its stdin."""
+
+        try:
+            self.feed(self.proc.stdin.buffer.write)
+            self.proc.stdin.close()
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error("Failed to feed restic: %s", e)
+            self.error = e
+            self.proc.kill()
+
+            # The buffered stdin is flushed on close, which fails
+            # because restic is gone.
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
@@ -0,0 +1,225 @@
+"""Resolving named volumes of services to local paths."""
+
+import os
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from docker.client import DockerClient
+from docker.errors import APIError, NotFound
+from docker.models.services import Service
+
+from restic_docker_swarm_agent._internal import metrics
+from restic_docker_swarm_agent._internal.exceptions import \
+    SwarmException, ConfigException
+
+logger = logging.getLogger(__name__)
+
+
+class VolumeResolver:
+    """Resolve the named volumes of services to paths in the agent.
+
+    The mountpoint of a volume on the node is read from the local Docker
+    volume API and mapped into the agent container by replacing the
+    host_root prefix with local_root. Only volumes which exist on the
+    node of the agent and are stored locally can be resolved, so that
+    data is never read over the network. Resolved paths are cached per
+    service spec version and resolved again when the service is updated.
+    """
+
+    STACK_LABEL = "com.docker.stack.namespace"
+    REMOTE_TYPES = ("nfs", "nfs4", "cifs", "smb")
+
+    def __init__(
+        self,
+        docker_client: DockerClient,
+        host_root: str = "/var/lib/docker/volumes",
+        local_root: str = "/volumes"
+    ):
+        """Initialize a VolumeResolver.
+
+        :param DockerClient docker_client: The DockerClient to use.
+        :param str host_root: The volume directory of Docker on the node.
+        :param str local_root: The directory where host_root is mounted
+            in the agent container.
+        """
+
+        self.docker_client = docker_client
+        self.host_root = os.path.normpath(host_root)
+        self.local_root = os.path.normpath(local_root)
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def parse_map(cls, spec: str) -> Tuple[str, str]:
+        """Parse a volume directory mapping of the form HOST:LOCAL.
+
+        :param str spec: The mapping.
+
+        :return: A tuple of the host and local directory.
+        :rtype: Tuple[str, str]
+
+        :raises ValueError: If the mapping is invalid.
+        """
+
+        parts = spec.split(":")
+        if len(parts) != 2 or not all(os.path.isabs(x) for x in parts):
+            raise ValueError("Invalid volume mapping: {}".format(spec))
+
+        return parts[0], parts[1]
+
+    @classmethod
+    def volume_name(cls, service: Service, volume: str) -> str:
+        """Find the name of a volume mounted in a service.
+
+        Volumes of stacks are prefixed with the stack name, so both the
+        plain name and the prefixed name are accepted.
+
+        :param Service service: The service.
+        :param str volume: The name of the volume.
+
+        :return: The full name of the volume.
+        :rtype: str
+
+        :raises ConfigException: If the volume isn't mounted in the service.
+        """
+
+        spec = service.attrs.get("Spec") or {}
+        stack = (spec.get("Labels") or {}).get(cls.STACK_LABEL)
+        names = [volume]
+        if stack is not None:
+            names.append("{}_{}".format(stack, volume))
+
+        mounts = ((spec.get("TaskTemplate") or {}).get("ContainerSpec")
+                  or {}).get("Mounts") or []
+        for m in mounts:
+            if m.get("Type") == "volume" and m.get("Source") in names:
+                return m["Source"]
+
+        raise ConfigException(
+            "Volume {} isn't mounted in service {}.".format(
+                volume,
+                service.name
+            )
+        )
+
+    def is_remote(self, attrs: Dict[str, Any]) -> bool:
+        """Check whether a volume stores its data on another host.
+
+        :param Dict[str, Any] attrs: The attributes of the volume.
+
+        :return: True if the volume isn't stored locally.
+        :rtype: bool
+        """
+
+        if attrs.get("Driver") != "local":
+            return True
+
+        fstype = (attrs.get("Options") or {}).get("type")
+        return fstype in VolumeResolver.REMOTE_TYPES
+
+    def mountpoint(self, name: str) -> str:
+        """Get the path of a local volume in the agent container.
+
+        :param str name: The full name of the volume.
+
+        :return: The path.
+        :rtype: str
+
+        :raises SwarmException: If the volume can't be backed up here.
+        """
+
+        try:
+            with metrics.DOCKER_API_DURATION.time(call="volumes.inspect"):
+                attrs = self.docker_client.api.inspect_volume(name)
+        except NotFound as e:
+            raise ConfigException(
+                "Volume {} doesn't exist on this node.".format(name)
+            ) from e
+        except APIError as e:
+            raise SwarmException(
+                "Failed to inspect volume {}: {}".format(name, e)
+            ) from e
+
+        if self.is_remote(attrs):
+            raise ConfigException(
+                "Volume {} isn't stored on this node.".format(name)
+            )
+
+        path = os.path.normpath(attrs.get("Mountpoint") or "")
+        if os.path.commonpath([path, self.host_root]) != self.host_root:
+            raise ConfigException(
+                "Volume {} is outside of {}.".format(name, self.host_root)
+            )
+
+        return os.path.join(
+            self.local_root,
+            os.path.relpath(path, self.host_root)
+        )
+
+    @staticmethod
+    def runs_on(service: Service, node_id: Optional[str]) -> bool:
+        """Check whether a service has a running task on a node.
+
+        :param Service service: The service.
+        :param Optional[str] node_id: The ID of the node. If this is None,
+            the node is unknown and the check always succeeds.
+
+        :return: True if the service runs on the node.
+        :rtype: bool
+
+        :raises SwarmException: If the tasks can't be listed.
+        """
+
+        if node_id is None:
+            return True
+
+        try:
+            with metrics.DOCKER_API_DURATION.time(call="services.tasks"):
+                tasks = service.tasks(
+                    filters={"desired-state": "Running", "node": node_id}
+                )
+        except APIError as e:
+            raise SwarmException(
+                "Failed to list the tasks of {}: {}".format(service.name, e)
+            ) from e
+
+        return len(tasks) > 0
+
+    def resolve(self, service: Service, volume: str) -> str:
+        """Resolve a volume of a service to a path in the agent container.
+
+        :param Service service: The service.
+        :param str volume: The name of the volume.
+
+        :return: The path.
+        :rtype: str
+
+        :raises SwarmException: If the volume can't be backed up here.
+        """
+
+        version = (service.attrs.get("Version") or {}).get("Index")
+
+        with self.lock:
+            cached = self.cache.get(service.id)
+            if cached is None or cached[0] != version:
+                cached = (version, {})
+                self.cache[service.id] = cached
+            path = cached[1].get(volume)
+
+        # The volume may have been removed and recreated.
+        if path is not None and os.path.isdir(path):
+            return path
+
+        path = self.mountpoint(self.volume_name(service, volume))
+        logger.debug(
+            "Volume %s of %s resolved to %s.",
+            volume,
+            service.name,
+            path
+        )
+
+        with self.lock:
+            cached[1][volume] = path
+
+        return path
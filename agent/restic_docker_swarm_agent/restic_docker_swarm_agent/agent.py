@@ -4,7 +4,9 @@ import os
 import logging
 import argparse
 import shutil
+import tempfile
 import threading
+from typing import Tuple
 
 import docker
 
@@ -14,8 +16,36 @@ from restic_docker_swarm_agent._internal.resticwrapper import \
     ResticWrapper
 from restic_docker_swarm_agent._internal.backupscheduler import \
     BackupScheduler
+from restic_docker_swarm_agent._internal.backupexecutor import \
+    BackupExecutor
+from restic_docker_swarm_agent._internal.loadspreader import LoadSpreader
+from restic_docker_swarm_agent._internal.bandwidthbudget import \
+    BandwidthBudget
+from restic_docker_swarm_agent._internal.repolocks import RepoLocks
+from restic_docker_swarm_agent._internal.repocache import RepoCache
+from restic_docker_swarm_agent._internal.changedetector import \
+    ChangeDetector
+from restic_docker_swarm_agent._internal.hookrunner import HookRunner
+from restic_docker_swarm_agent._internal.sshmaster import SSHMasterPool
+from restic_docker_swarm_agent._internal.statusfile import StatusFile
+from restic_docker_swarm_agent._internal.historystore import HistoryStore
+from restic_docker_swarm_agent._internal.lockrecovery import LockRecovery
+from restic_docker_swarm_agent._internal.retrypolicy import RetryPolicy
+from restic_docker_swarm_agent._internal.shardcoordinator import \
+    ShardCoordinator
+from restic_docker_swarm_agent._internal.volumeresolver import \
+    VolumeResolver
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+from restic_docker_swarm_agent._internal.servicebackupconfig import \
+    ServiceBackupConfig
 from restic_docker_swarm_agent._internal.queryserver import \
     QueryServer
+from restic_docker_swarm_agent._internal.servicewatcher import \
+    ServiceWatcher
+from restic_docker_swarm_agent._internal.metricsserver import \
+    MetricsServer
+from restic_docker_swarm_agent._internal.progresstracker import \
+    ProgressTracker
 
 logging.basicConfig(
     level=logging.INFO,
@@ -38,10 +68,54 @@ def check_dependencies():
         )
 
 
-def entrypoint():
-    """Entrypoint method."""
+def add_retry_args(ap: argparse.ArgumentParser) -> None:
+    """Add the arguments for retrying failed commands and backups.
 
-    check_dependencies()
+    :param argparse.ArgumentParser ap: The parser to add the arguments to.
+    """
+
+    ap.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Number of times a failed backup is retried before its "
+             "next scheduled run."
+    )
+    ap.add_argument(
+        "--retry-backoff",
+        type=ResticUtils.parse_duration,
+        default="1m",
+        help="Delay before the first retry of a failed backup. The delay "
+             "is doubled for each retry."
+    )
+    ap.add_argument(
+        "--retry-max-backoff",
+        type=ResticUtils.parse_duration,
+        default="1h",
+        help="Maximum delay between retries of a failed backup."
+    )
+    ap.add_argument(
+        "--retry-jitter",
+        type=float,
+        default=0.1,
+        help="Maximum random deviation of the retry delay as a fraction "
+             "of the delay."
+    )
+    ap.add_argument(
+        "--retry-on",
+        type=RetryPolicy.parse_kinds,
+        default="network,docker,locked",
+        help="Comma separated kinds of errors which are retried. One of: "
+             "{}.".format(", ".join(RetryPolicy.KINDS))
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse command line arguments.
+
+    :return: The parsed arguments.
+    :rtype: argparse.Namespace
+    """
 
     ap = argparse.ArgumentParser(description="restic-docker-swarm")
 
@@ -99,51 +173,456 @@ def entrypoint():
         required=True,
         help="Address and port of the status query server."
     )
+    ap.add_argument(
+        "--discovery",
+        type=str,
+        choices=["poll", "events"],
+        default="poll",
+        help="Service discovery mode. 'poll' lists all services every "
+             "scheduling pass, 'events' caches services and keeps the "
+             "cache up-to-date using the Docker events stream."
+    )
+    ap.add_argument(
+        "--resync-interval",
+        type=int,
+        default=3600,
+        help="Full service resync interval in seconds in 'events' "
+             "discovery mode."
+    )
+    ap.add_argument(
+        "--max-jobs",
+        type=int,
+        default=4,
+        help="The maximum number of concurrent backup jobs."
+    )
+    ap.add_argument(
+        "--max-jobs-per-host",
+        type=int,
+        default=2,
+        help="The maximum number of concurrent backup jobs which run "
+             "restic on the same SFTP host. Hooks don't count against "
+             "this limit."
+    )
+    ap.add_argument(
+        "--repo-concurrency",
+        type=int,
+        default=1,
+        help="Maximum number of repositories of a single service to back "
+             "up concurrently."
+    )
+    ap.add_argument(
+        "--miss-threshold",
+        type=float,
+        default=60,
+        help="Report backups which start more than this many seconds "
+             "later than scheduled."
+    )
+    ap.add_argument(
+        "--maintenance-at",
+        type=ServiceBackupConfig.check_cron,
+        default=None,
+        help="Run repository maintenance jobs on the given cron schedule "
+             "for services without an rds.backup.maintenance-at label."
+    )
+    ap.add_argument(
+        "--maintenance",
+        type=ResticUtils.parse_maintenance_tasks,
+        default="prune",
+        help="Default maintenance tasks as a comma separated list of "
+             "prune, check and check-data=SUBSET."
+    )
+    ap.add_argument(
+        "--prune-at",
+        type=ServiceBackupConfig.check_cron,
+        default=None,
+        help="Alias for --maintenance-at."
+    )
+    ap.add_argument(
+        "--state-dir",
+        type=str,
+        default=None,
+        help="Directory for persistent agent state. State is only kept "
+             "in memory if this is not set."
+    )
+    ap.add_argument(
+        "--ssh-multiplex",
+        action="store_true",
+        help="Share a multiplexed SSH master connection between all "
+             "restic invocations."
+    )
+    ap.add_argument(
+        "--ssh-control-persist",
+        type=int,
+        default=300,
+        help="Idle time in seconds after which the SSH master "
+             "connection is closed."
+    )
+    ap.add_argument(
+        "--query-workers",
+        type=int,
+        default=8,
+        help="The maximum number of concurrent status query clients."
+    )
+    ap.add_argument(
+        "--query-timeout",
+        type=float,
+        default=10,
+        help="Timeout in seconds for status query connections."
+    )
+    ap.add_argument(
+        "--metrics-listen",
+        type=str,
+        default=None,
+        help="Address and port of the Prometheus metrics endpoint. "
+             "Metrics are disabled if this is not set."
+    )
+    ap.add_argument(
+        "--progress-interval",
+        type=float,
+        default=10,
+        help="Interval in seconds between backup progress updates."
+    )
+    ap.add_argument(
+        "--shell-expand",
+        action="store_true",
+        help="Expand environment variables in SSH options and restic "
+             "arguments. Restic is run without a shell, so variables are "
+             "not expanded by default."
+    )
+    ap.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="Skip backups of repositories which haven't changed since "
+             "their last backup."
+    )
+    ap.add_argument(
+        "--spread-window",
+        type=float,
+        default=0,
+        help="Spread backups scheduled at the same time over a window of "
+             "this many seconds. Disabled by default."
+    )
+    ap.add_argument(
+        "--spread-by-cost",
+        action="store_true",
+        help="Place spread backups based on their previous durations to "
+             "minimize overlap."
+    )
+    ap.add_argument(
+        "--limit-upload",
+        type=int,
+        default=None,
+        help="Total upload bandwidth of all restic processes in KiB/s."
+    )
+    ap.add_argument(
+        "--bandwidth-schedule",
+        type=BandwidthBudget.parse_schedule,
+        default=None,
+        help="Time-of-day upload limits in KiB/s as a comma separated list "
+             "of HH:MM-HH:MM=KIB windows. 0 means unlimited. "
+             "--limit-upload is used outside the windows."
+    )
+    ap.add_argument(
+        "--nice",
+        type=int,
+        default=None,
+        help="Run restic with this niceness."
+    )
+    ap.add_argument(
+        "--ionice",
+        choices=sorted(BandwidthBudget.IONICE_CLASSES),
+        default=None,
+        help="Run restic with this I/O scheduling class."
+    )
+    ap.add_argument(
+        "--hook-timeout",
+        type=float,
+        default=3600,
+        help="Default timeout in seconds for pre-backup and post-backup "
+             "hooks. 0 disables the timeout."
+    )
+    ap.add_argument(
+        "--status-file",
+        type=str,
+        default=None,
+        help="Path of the plain-text status file used by the healthcheck. "
+             "Defaults to 'status' in --state-dir."
+    )
+    ap.add_argument(
+        "--stale-after",
+        type=ResticUtils.parse_duration,
+        default=None,
+        help="Report services which haven't been backed up successfully "
+             "within this duration, eg. '2d', as stale in the status file."
+    )
+    ap.add_argument(
+        "--history-retention",
+        type=int,
+        default=100,
+        help="Number of runs kept in the backup history per service and "
+             "repository."
+    )
+    ap.add_argument(
+        "--history-max-age",
+        type=ResticUtils.parse_duration,
+        default="90d",
+        help="Drop runs older than this duration from the backup history."
+    )
+    ap.add_argument(
+        "--shard-service",
+        type=str,
+        default=None,
+        help="Name of the agent service. If this is set, services are "
+             "split between the running replicas of the agent service."
+    )
+    ap.add_argument(
+        "--shard-task-id",
+        type=str,
+        default=os.environ.get("AGENT_TASK_ID") or None,
+        help="Swarm task ID of this agent. Defaults to AGENT_TASK_ID from "
+             "the environment, which can be set to {{.Task.ID}} in the "
+             "stack file. Otherwise it's read from the labels of the agent "
+             "container."
+    )
+    ap.add_argument(
+        "--shard-refresh",
+        type=float,
+        default=30,
+        help="Interval in seconds for refreshing the agent replica list."
+    )
+    add_retry_args(ap)
+    ap.add_argument(
+        "--volume-map",
+        type=VolumeResolver.parse_map,
+        default="/var/lib/docker/volumes:/volumes",
+        help="The Docker volume directory of the node and the directory "
+             "where it's mounted in the agent as HOST:LOCAL."
+    )
     ap.add_argument(
         "backup_path",
         type=str,
         help="The directory to backup."
     )
+
     args = ap.parse_args()
+    if args.maintenance_at is None:
+        args.maintenance_at = args.prune_at
 
-    # Enable more verbose logs if --verbose was used.
-    if args.verbose:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
+    return args
 
-    # Parse the value of the --listen flag.
-    server_listen = args.listen.split(":")
 
-    if len(server_listen) > 2:
-        raise ValueError("Invalid value for --listen: {}".format(args.listen))
+def parse_listen(listen: str) -> Tuple[str, int]:
+    """Parse an address and port from a string of the form ADDRESS:PORT.
+
+    :param str listen: The string to parse.
+
+    :return: A tuple of the address and port.
+    :rtype: Tuple[str, int]
+
+    :raises ValueError: If the string is invalid.
+    """
+
+    parts = listen.split(":")
+
+    if len(parts) != 2:
+        raise ValueError("Invalid address: {}".format(listen))
 
     try:
-        server_listen = (server_listen[0], int(server_listen[1]))
+        return (parts[0], int(parts[1]))
     except ValueError as e:
-        raise ValueError(
-            "Invalid port for --listen: {}".format(server_listen[1])
-        ) from e
+        raise ValueError("Invalid port: {}".format(parts[1])) from e
 
-    docker_client = docker.from_env()
 
-    rds = ResticWrapper(
+def create_restic_wrapper(
+    args: argparse.Namespace,
+    docker_client: docker.DockerClient
+) -> ResticWrapper:
+    """Create the ResticWrapper configured by the command line arguments.
+
+    :param argparse.Namespace args: The parsed command line arguments.
+    :param docker.DockerClient docker_client: The DockerClient to use.
+
+    :return: The ResticWrapper.
+    :rtype: ResticWrapper
+    """
+
+    ssh_masters = None
+    if args.ssh_multiplex:
+        ssh_masters = SSHMasterPool(
+            os.path.join(args.state_dir or tempfile.gettempdir(), "ssh"),
+            args.ssh_control_persist
+        )
+
+    progress = ProgressTracker(args.progress_interval)
+    budget = BandwidthBudget(
+        args.limit_upload,
+        args.bandwidth_schedule,
+        args.nice,
+        args.ionice,
+        min(args.max_jobs, args.max_jobs_per_host) * args.repo_concurrency
+    )
+
+    return ResticWrapper(
         docker_client,
         args.ssh_host,
         args.backup_base,
         args.forget_policy,
         restic_args=args.restic_arg,
         ssh_opts=args.ssh_option,
-        ssh_port=args.ssh_port
+        ssh_port=args.ssh_port,
+        repo_locks=RepoLocks(args.max_jobs_per_host),
+        default_maintenance=args.maintenance_at is not None,
+        repo_cache=RepoCache(args.state_dir),
+        ssh_masters=ssh_masters,
+        progress=progress,
+        shell_expand=args.shell_expand,
+        change_detector=(
+            ChangeDetector(args.state_dir) if args.skip_unchanged else None
+        ),
+        budget=budget,
+        repo_concurrency=args.repo_concurrency,
+        hooks=HookRunner(docker_client, args.hook_timeout),
+        history=HistoryStore(
+            args.state_dir,
+            args.history_retention,
+            args.history_max_age
+        ),
+        volumes=VolumeResolver(docker_client, *args.volume_map),
+        maintenance_tasks=args.maintenance,
+        lock_recovery=LockRecovery(docker_client, args.state_dir)
     )
 
+
+def register_stats(
+    backupscheduler: BackupScheduler,
+    rds: ResticWrapper
+) -> None:
+    """Register the statistics of the ResticWrapper in the scheduler.
+
+    :param BackupScheduler backupscheduler: The BackupScheduler.
+    :param ResticWrapper rds: The ResticWrapper.
+    """
+
+    backupscheduler.register_stats("progress", rds.progress.snapshot)
+    backupscheduler.register_stats("bandwidth", lambda: rds.budget.stats)
+    backupscheduler.register_stats("history", lambda: rds.history.stats)
+    backupscheduler.register_stats(
+        "maintenance",
+        lambda: rds.maintainer.stats
+    )
+    backupscheduler.register_stats("locks", lambda: rds.lock_recovery.stats)
+    backupscheduler.register_stats(
+        "repo_locks",
+        lambda: rds.repo_locks.stats
+    )
+    if rds.ssh_masters is not None:
+        backupscheduler.register_stats(
+            "ssh_masters",
+            lambda: rds.ssh_masters.stats
+        )
+
+
+def entrypoint():
+    """Entrypoint method."""
+
+    check_dependencies()
+
+    args = parse_args()
+
+    # Enable more verbose logs if --verbose was used.
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    # Parse the value of the --listen flag.
+    server_listen = parse_listen(args.listen)
+
+    docker_client = docker.from_env()
+
+    rds = create_restic_wrapper(args, docker_client)
+    rds.lock_recovery.register(rds.hooks.node_id())
+
+    # Start the ServiceWatcher if event-driven discovery is used.
+    watcher = None
+    if args.discovery == "events":
+        watcher = ServiceWatcher(docker_client, args.resync_interval)
+
     # Start the BackupScheduler.
-    backupscheduler = BackupScheduler(docker_client, rds.backup)
+    executor = BackupExecutor(args.max_jobs, args.miss_threshold)
+    spreader = None
+    if args.spread_window > 0:
+        spreader = LoadSpreader(
+            args.spread_window,
+            args.spread_by_cost,
+            args.state_dir
+        )
+    status_file = None
+    if args.status_file is not None or args.state_dir is not None:
+        status_file = StatusFile(
+            args.status_file or os.path.join(args.state_dir, "status"),
+            args.stale_after
+        )
+    coordinator = None
+    if args.shard_service is not None:
+        coordinator = ShardCoordinator(
+            docker_client,
+            args.shard_service,
+            args.shard_task_id,
+            args.shard_refresh
+        )
+    backupscheduler = BackupScheduler(
+        docker_client,
+        rds.backup,
+        watcher=watcher,
+        executor=executor,
+        spreader=spreader,
+        status_file=status_file,
+        history=rds.history,
+        coordinator=coordinator,
+        maintenance_func=rds.maintainer.maintain,
+        maintenance_at=args.maintenance_at,
+        retry_policy=RetryPolicy(
+            args.retries,
+            args.retry_backoff,
+            args.retry_max_backoff,
+            args.retry_jitter,
+            args.retry_on
+        )
+    )
+    register_stats(backupscheduler, rds)
+    backupscheduler.register_stats(
+        "retries",
+        lambda: backupscheduler.retry_policy.stats
+    )
+    if spreader is not None:
+        backupscheduler.register_stats("spread", lambda: spreader.stats)
+    if coordinator is not None:
+        backupscheduler.register_stats("shard", lambda: coordinator.stats)
+
+    # Start the watcher first, so that no service event is lost between
+    # the first scan of the scheduler and the start of the event stream.
+    if watcher is not None:
+        watcher.on_change = backupscheduler.notify
+        watcher_thread = threading.Thread(target=watcher.run)
+        watcher_thread.start()
+
     sched_thread = threading.Thread(target=backupscheduler.run)
     sched_thread.start()
 
+    # Start the MetricsServer.
+    if args.metrics_listen is not None:
+        metricsserver = MetricsServer(parse_listen(args.metrics_listen))
+        metrics_thread = threading.Thread(target=metricsserver.run)
+        metrics_thread.start()
+
     # Start the QueryServer.
-    queryserver = QueryServer(server_listen, backupscheduler)
+    queryserver = QueryServer(
+        server_listen,
+        backupscheduler,
+        args.query_workers,
+        args.query_timeout
+    )
     queryserver.run()
 
     # We should never get this far since queryserver.run() should never exit.
@@ -14,21 +14,27 @@ The environment variables used by this script are:
   SSH_ID_FILE = SSH private key file for authenticating to the SSH host.
   SSH_KNOWN_HOSTS_FILE = Populated known_hosts file for identifying SSH hosts.
   RESTIC_REPO_PASSWORD_FILE = Restic repository password file.
+  STATE_DIR = Persistent state directory of the agent.
+  SSH_CONTROL_PERSIST = Idle time of multiplexed SSH connections (optional).
 
 """
 
 import os
 import subprocess
-from typing import List
+from typing import List, Optional
 from argparse import ArgumentParser
 
 from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+from restic_docker_swarm_agent._internal.repocache import RepoCache
+from restic_docker_swarm_agent._internal.sshmaster import SSHMaster
 
 
-def get_restic_cmd(repo: str) -> str:
+def get_restic_cmd(repo: str, multiplex: bool = False) -> List[str]:
     """Get the default restic command as a list of strings.
 
     :param str repo: The repository path to use.
+    :param bool multiplex: Use a multiplexed SSH master connection. If the
+        agent is running with --ssh-multiplex, its master is reused.
 
     :return: The default restic command.
     :rtype: List[str]
@@ -44,6 +50,16 @@ def get_restic_cmd(repo: str) -> str:
         "-i", id_file
     ]
 
+    if multiplex:
+        master = SSHMaster(
+            host,
+            port,
+            ssh_opts,
+            os.path.join(os.environ["STATE_DIR"], "ssh"),
+            int(os.environ.get("SSH_CONTROL_PERSIST", "300"))
+        )
+        ssh_opts.extend(master.ssh_opts())
+
     restic_args = [
         "--password-file", os.environ["RESTIC_REPO_PASSWORD_FILE"]
     ]
@@ -57,25 +73,41 @@ def get_restic_cmd(repo: str) -> str:
     )
 
 
-def run_restic(repo: str, argv: List[str]) -> int:
+def run_restic(repo: str, argv: List[str], multiplex: bool = False) -> int:
     """Run restic with a set of arguments.
 
     :param str repo: The repository to use.
     :param List[str] argv: Arguments to restic.
+    :param bool multiplex: Use a multiplexed SSH master connection.
 
     :return: The exit code returned by restic.
     :rtype: int
     """
 
-    cmd = get_restic_cmd(repo)
+    cmd = get_restic_cmd(repo, multiplex)
     cmd.extend(argv)
 
-    print("subprocess: " + " ".join(cmd))
-    return subprocess.run(
-        " ".join(cmd),
-        check=False,
-        shell=True
-    ).returncode
+    print("subprocess: " + ResticUtils.cmd_str(cmd))
+    return subprocess.run(cmd, check=False).returncode
+
+
+def invalidate_repo_cache(repo: Optional[str]) -> None:
+    """Remove a repository or all repositories of SSH_HOST from the cache.
+
+    :param Optional[str] repo: The repository to remove. If this is None,
+        all repositories of SSH_HOST are removed.
+    """
+
+    cache = RepoCache(os.environ["STATE_DIR"])
+    cache.invalidate(os.environ["SSH_HOST"], repo)
+
+    if repo is None:
+        print(
+            "Invalidated all cached repositories of "
+            + os.environ["SSH_HOST"] + "."
+        )
+    else:
+        print("Invalidated cached repository: " + repo)
 
 
 def entrypoint():
@@ -87,9 +119,23 @@ def entrypoint():
         "-r",
         "--repo",
         type=str,
-        required=True,
+        default=None,
         help="The repository path passed to restic."
     )
+    ap.add_argument(
+        "--invalidate-cache",
+        action="store_true",
+        help="Remove the repository from the agent's repository cache. "
+             "If no repository is given, all repositories of SSH_HOST are "
+             "removed."
+    )
+    ap.add_argument(
+        "-m",
+        "--ssh-multiplex",
+        action="store_true",
+        help="Use a multiplexed SSH master connection. The connection "
+             "of the agent is reused if it's running."
+    )
     ap.add_argument(
         "args",
         type=str,
@@ -98,7 +144,14 @@ def entrypoint():
     )
     args = ap.parse_args()
 
-    run_restic(args.repo, args.args)
+    if args.invalidate_cache:
+        invalidate_repo_cache(args.repo)
+        return
+
+    if args.repo is None:
+        ap.error("the following arguments are required: -r/--repo")
+
+    run_restic(args.repo, args.args, args.ssh_multiplex)
 
 
 if __name__ == "__main__":
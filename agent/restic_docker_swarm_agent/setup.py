@@ -6,8 +6,7 @@ setuptools.setup(
     python_requires='>=3.5',
     install_requires=[
         "docker>=4.2",
-        "croniter>=1.0.8",
-        "pause>=0.3"
+        "croniter>=1.0.8"
     ],
     entry_points={
         "console_scripts": [
@@ -0,0 +1,145 @@
+"""Tests for BackupQueue."""
+
+import time
+import unittest
+from typing import List
+
+from restic_docker_swarm_agent._internal.backupqueue import BackupQueue
+
+
+class BackupQueueTest(unittest.TestCase):
+    """Test scheduling, replacing and cancelling events by key."""
+
+    def setUp(self):
+        """Create an empty queue and a list of run events."""
+
+        self.queue = BackupQueue()
+        self.ran = []
+
+    def action(self, name: str) -> None:
+        """Record a run event."""
+
+        self.ran.append(name)
+
+    def enter_past(self, names: List[str]) -> None:
+        """Schedule due events which are run in the given order."""
+
+        now = time.time()
+        for i, name in enumerate(names):
+            self.queue.enterabs(
+                now - 100 + i,
+                10,
+                self.action,
+                {"name": name},
+                key=name
+            )
+
+    def test_order(self):
+        """Due events run by time and then by priority."""
+
+        now = time.time()
+        self.queue.enterabs(now - 1, 10, self.action, {"name": "late"})
+        self.queue.enterabs(now - 2, 15, self.action, {"name": "low"})
+        self.queue.enterabs(now - 2, 5, self.action, {"name": "high"})
+        self.queue.enterabs(now + 100, 1, self.action, {"name": "future"})
+
+        delay = self.queue.run()
+
+        self.assertEqual(self.ran, ["high", "low", "late"])
+        self.assertGreater(delay, 90)
+        self.assertEqual(len(self.queue), 1)
+
+    def test_replace_key(self):
+        """A new event replaces the pending event with the same key."""
+
+        now = time.time()
+        self.queue.enterabs(now - 1, 10, self.action, {"name": "old"}, "s1")
+        ev = self.queue.enterabs(
+            now - 1,
+            10,
+            self.action,
+            {"name": "new"},
+            "s1"
+        )
+
+        self.assertIs(self.queue.get("s1"), ev)
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.events(), [ev])
+
+        self.queue.run()
+
+        self.assertEqual(self.ran, ["new"])
+        self.assertIsNone(self.queue.get("s1"))
+
+    def test_cancel(self):
+        """Cancelled events are never run and leave the index."""
+
+        self.enter_past(["a", "b", "c"])
+
+        self.assertTrue(self.queue.cancel("b"))
+        self.assertFalse(self.queue.cancel("b"))
+        self.assertFalse(self.queue.cancel("missing"))
+        self.assertEqual(self.queue.keys(), {"a", "c"})
+
+        self.queue.run()
+
+        self.assertEqual(self.ran, ["a", "c"])
+        self.assertEqual(self.queue.stats["cancelled"], 0)
+
+    def test_lazy_cancel(self):
+        """Cancelled events stay in the heap until they're dropped."""
+
+        self.enter_past(["a", "b", "c", "d", "e"])
+        self.queue.cancel("a")
+
+        self.assertEqual(self.queue.stats, {
+            "pending": 4,
+            "indexed": 4,
+            "cancelled": 1
+        })
+        self.assertEqual(len(self.queue.heap), 5)
+
+        # The cancelled head is dropped when the next time is looked up.
+        self.assertLess(self.queue.next_time(), time.time())
+        self.assertEqual(self.queue.stats["cancelled"], 0)
+        self.assertEqual(len(self.queue.heap), 4)
+
+    def test_compaction(self):
+        """The heap is compacted once most events are cancelled."""
+
+        names = ["s{}".format(i) for i in range(10)]
+        self.enter_past(names)
+
+        for name in names[5:]:
+            self.queue.cancel(name)
+        self.assertEqual(len(self.queue.heap), 10)
+
+        self.queue.cancel(names[0])
+
+        self.assertEqual(len(self.queue.heap), 4)
+        self.assertEqual(self.queue.stats["cancelled"], 0)
+        self.assertEqual(self.queue.keys(), set(names[1:5]))
+
+        self.queue.run()
+
+        self.assertEqual(self.ran, names[1:5])
+
+    def test_replace_compaction(self):
+        """Replacing the same key repeatedly doesn't grow the heap."""
+
+        for i in range(100):
+            self.queue.enter(100 + i, 10, self.action, {"name": i}, "s1")
+
+        self.assertLessEqual(len(self.queue.heap), 2)
+        self.assertEqual(self.queue.get("s1").kwargs, {"name": 99})
+
+    def test_empty(self):
+        """An empty queue has no next event."""
+
+        self.assertIsNone(self.queue.run())
+        self.assertIsNone(self.queue.next_time())
+        self.assertIsNone(self.queue.pop_due(time.time()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+"""Tests for BandwidthBudget."""
+
+import threading
+import unittest
+from datetime import datetime
+
+from restic_docker_swarm_agent._internal.bandwidthbudget import \
+    BandwidthBudget
+
+
+def at(hour: int, minute: int = 0) -> datetime:
+    """Get a time on an arbitrary day."""
+
+    return datetime(2026, 10, 17, hour, minute)
+
+
+class BandwidthBudgetTest(unittest.TestCase):
+    """Test the schedule and the allocation of the upload cap."""
+
+    def test_parse_schedule(self):
+        """Windows are parsed into minutes of the day."""
+
+        self.assertEqual(
+            BandwidthBudget.parse_schedule("08:00-18:30=512, 22:00-6:00=0"),
+            [(480, 1110, 512), (1320, 360, 0)]
+        )
+        self.assertEqual(
+            BandwidthBudget.parse_schedule("0:00-24:00=1"),
+            [(0, 1440, 1)]
+        )
+        self.assertEqual(BandwidthBudget.parse_schedule(""), [])
+
+    def test_parse_schedule_invalid(self):
+        """Invalid windows are rejected."""
+
+        for spec in [
+            "08:00-18:00",
+            "8-18=512",
+            "24:00-06:00=512",
+            "08:60-18:00=512",
+            "08:00-24:01=512",
+            "08:00-18:00=-1"
+        ]:
+            with self.assertRaises(ValueError, msg=spec):
+                BandwidthBudget.parse_schedule(spec)
+
+    def test_cap(self):
+        """The cap of the current window is used."""
+
+        budget = BandwidthBudget(
+            1000,
+            BandwidthBudget.parse_schedule("08:00-18:00=200,22:00-06:00=0")
+        )
+
+        self.assertEqual(budget.cap(at(7, 59)), 1000)
+        self.assertEqual(budget.cap(at(8)), 200)
+        self.assertEqual(budget.cap(at(17, 59)), 200)
+        self.assertEqual(budget.cap(at(18)), 1000)
+        self.assertIsNone(budget.cap(at(23)))
+        self.assertIsNone(budget.cap(at(3)))
+        self.assertEqual(budget.cap(at(6)), 1000)
+
+    def test_unlimited(self):
+        """Processes aren't limited without a cap."""
+
+        budget = BandwidthBudget()
+
+        with budget.allocate() as first, budget.allocate() as second:
+            self.assertEqual(first, [])
+            self.assertEqual(second, [])
+            self.assertEqual(budget.stats["processes"], 2)
+
+        self.assertEqual(budget.stats["processes"], 0)
+
+    def test_alone(self):
+        """A process which uploads alone gets the whole cap."""
+
+        budget = BandwidthBudget(1000, slots=4)
+
+        with budget.allocate() as limits:
+            self.assertEqual(limits, ["--limit-upload", "1000"])
+            self.assertEqual(budget.stats["allocated"], 1000)
+
+        self.assertEqual(budget.stats["allocated"], 0)
+
+    def test_shares(self):
+        """The remaining cap is split between new and running processes."""
+
+        budget = BandwidthBudget(1000, slots=4)
+
+        self.assertEqual(budget.share(1000), 1000)
+        budget.active = {0: 400}
+        self.assertEqual(budget.share(1000), 300)
+        budget.active = {0: 400, 1: 300}
+        self.assertEqual(budget.share(1000), 0)
+        budget.active = {0: 100, 1: 100}
+        self.assertEqual(budget.share(1000), 266)
+
+    def test_wait(self):
+        """A process waits until its share is available."""
+
+        budget = BandwidthBudget(1000, slots=1)
+        started = threading.Event()
+        limits = []
+
+        def upload():
+            """Allocate a share in another thread."""
+
+            started.set()
+            with budget.allocate() as x:
+                limits.append(x)
+
+        with budget.allocate() as first:
+            self.assertEqual(first, ["--limit-upload", "1000"])
+
+            thread = threading.Thread(target=upload)
+            thread.start()
+            started.wait()
+            thread.join(0.2)
+
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(limits, [])
+
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(limits, [["--limit-upload", "1000"]])
+        self.assertEqual(budget.stats["waits"], 1)
+
+    def test_no_upload(self):
+        """Processes which don't write aren't limited or counted."""
+
+        budget = BandwidthBudget(1000)
+
+        with budget.allocate(), budget.allocate(False) as limits:
+            self.assertEqual(limits, [])
+            self.assertEqual(budget.stats["processes"], 1)
+
+    def test_prefix(self):
+        """The nice and ionice prefix is built from the options."""
+
+        self.assertEqual(BandwidthBudget().prefix(), [])
+        self.assertEqual(
+            BandwidthBudget(nice=10, ionice="idle").prefix(),
+            ["ionice", "-c", "3", "nice", "-n", "10"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+"""Tests for ChangeDetector."""
+
+import os
+import tempfile
+import time
+import unittest
+from typing import Optional
+
+from restic_docker_swarm_agent._internal.changedetector import \
+    ChangeDetector
+
+HOST = "restic@rds-server"
+REPO = "postgres-1"
+
+
+class ChangeDetectorTest(unittest.TestCase):
+    """Test the detection of changed backup directories."""
+
+    def setUp(self):
+        """Create a backup directory with a file and a subdirectory."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "data")
+        os.makedirs(os.path.join(self.path, "sub"))
+        self.write("sub/file", "data")
+        self.detector = ChangeDetector(None)
+
+    def write(self, name: str, data: str) -> None:
+        """Write a file in the backup directory."""
+
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write(data)
+
+    def backup(self, tag: Optional[str] = None) -> None:
+        """Check the backup directory and record it as backed up."""
+
+        _, fingerprint = self.detector.check(HOST, REPO, [self.path], tag=tag)
+        self.detector.record(HOST, REPO, fingerprint, tag)
+
+    def changed(self, **kwargs) -> bool:
+        """Check whether the backup directory changed."""
+
+        return self.detector.check(HOST, REPO, [self.path], **kwargs)[0]
+
+    def test_stable(self):
+        """Fingerprints don't change without changes in the tree."""
+
+        self.assertEqual(
+            ChangeDetector.fingerprint(self.path),
+            ChangeDetector.fingerprint(self.path)
+        )
+        self.assertEqual(
+            ChangeDetector.fingerprint_paths([self.path]),
+            ChangeDetector.fingerprint(self.path)
+        )
+
+    def test_first_backup(self):
+        """Unknown repositories are always backed up."""
+
+        self.assertTrue(self.changed())
+
+        self.backup()
+
+        self.assertFalse(self.changed())
+
+    def test_changes(self):
+        """Modified, added, renamed and removed entries are detected."""
+
+        for change in [
+            lambda: self.write("sub/file", "more data"),
+            lambda: self.write("new", ""),
+            lambda: os.rename(
+                os.path.join(self.path, "new"),
+                os.path.join(self.path, "renamed")
+            ),
+            lambda: os.remove(os.path.join(self.path, "renamed")),
+            lambda: os.chmod(os.path.join(self.path, "sub"), 0o700)
+        ]:
+            self.backup()
+            change()
+            self.assertTrue(self.changed())
+
+    def test_touch(self):
+        """Changed modification times are detected."""
+
+        self.backup()
+        path = os.path.join(self.path, "sub", "file")
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+
+        self.assertTrue(self.changed())
+
+    def test_multiple_paths(self):
+        """Changes in any of multiple directories are detected."""
+
+        other = os.path.join(self.tmp.name, "other")
+        os.mkdir(other)
+        paths = [self.path, other]
+        _, fingerprint = self.detector.check(HOST, REPO, paths)
+        self.detector.record(HOST, REPO, fingerprint)
+
+        self.assertFalse(self.detector.check(HOST, REPO, paths[::-1])[0])
+
+        with open(os.path.join(other, "file"), "w") as f:
+            f.write("data")
+
+        self.assertTrue(self.detector.check(HOST, REPO, paths)[0])
+
+    def test_tags(self):
+        """Services sharing a repository are tracked separately."""
+
+        self.backup("service1")
+
+        self.assertFalse(self.changed(tag="service1"))
+        self.assertTrue(self.changed(tag="service2"))
+        self.assertTrue(self.changed())
+
+    def test_full_interval(self):
+        """A backup is forced once the last one is too old."""
+
+        self.backup()
+
+        self.assertFalse(self.changed(full_interval=3600))
+
+        key = ChangeDetector.key(HOST, REPO)
+        last = self.detector.state.get(key)
+        last["backed_up"] = time.time() - 7200
+        self.detector.state.set(key, last)
+
+        self.assertTrue(self.changed(full_interval=3600))
+
+    def test_missing_directory(self):
+        """Directories which can't be read are backed up anyway."""
+
+        self.path = os.path.join(self.tmp.name, "missing")
+
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(
+                self.detector.check(HOST, REPO, [self.path]),
+                (True, None)
+            )
+
+    def test_persist(self):
+        """Fingerprints are stored in the state directory."""
+
+        self.detector = ChangeDetector(self.tmp.name)
+        self.backup()
+
+        self.detector = ChangeDetector(self.tmp.name)
+
+        self.assertFalse(self.changed())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+"""Tests for LoadSpreader."""
+
+import tempfile
+import unittest
+
+from restic_docker_swarm_agent._internal.loadspreader import LoadSpreader
+
+SLOT = 1792281600.0
+
+
+class LoadSpreaderTest(unittest.TestCase):
+    """Test the placement of backups within their cron slots."""
+
+    def test_deterministic(self):
+        """Offsets depend only on the key and stay within the window."""
+
+        a = LoadSpreader(600)
+        b = LoadSpreader(600)
+        keys = ["service{}".format(i) for i in range(50)]
+
+        offsets = [a.place(k, SLOT, 3600) for k in keys]
+
+        self.assertEqual(offsets, [b.place(k, SLOT, 3600) for k in keys])
+        self.assertTrue(all(0 <= x < 600 for x in offsets))
+        self.assertGreater(len(set(offsets)), 40)
+
+    def test_limit(self):
+        """Offsets never reach the next slot of the service."""
+
+        spreader = LoadSpreader(3600)
+
+        for i in range(50):
+            self.assertLess(spreader.place("s{}".format(i), SLOT, 60), 60)
+
+        self.assertEqual(spreader.place("s0", SLOT, 0), 0.0)
+
+    def test_offset_and_release(self):
+        """The current offset of a key is kept until it's released."""
+
+        spreader = LoadSpreader(600)
+        offset = spreader.place("s1", SLOT, 3600)
+
+        self.assertEqual(spreader.offset("s1"), offset)
+        self.assertEqual(spreader.stats["placed"], 1)
+
+        spreader.release("s1")
+
+        self.assertEqual(spreader.offset("s1"), 0.0)
+        self.assertEqual(spreader.stats["slots"], 0)
+
+    def test_replace(self):
+        """Placing a key again releases its previous placement."""
+
+        spreader = LoadSpreader(600)
+        spreader.place("s1", SLOT, 3600)
+        spreader.place("s1", SLOT + 3600, 3600)
+
+        self.assertEqual(spreader.stats["placed"], 1)
+        self.assertEqual(spreader.stats["slots"], 1)
+
+    def test_durations(self):
+        """Durations are smoothed with a moving average."""
+
+        spreader = LoadSpreader(600)
+        spreader.record("s1", 100)
+        spreader.record("s1", 200)
+
+        self.assertAlmostEqual(
+            spreader.duration("s1"),
+            100 + LoadSpreader.SMOOTHING * 100
+        )
+        self.assertEqual(spreader.duration("s2"), 0.0)
+
+    def test_durations_persist(self):
+        """Durations are stored in the state directory."""
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            LoadSpreader(600, state_dir=state_dir).record("s1", 100)
+
+            spreader = LoadSpreader(600, state_dir=state_dir)
+
+            self.assertEqual(spreader.duration("s1"), 100)
+
+    def test_cost_aware(self):
+        """Backups with known durations are placed without overlapping."""
+
+        spreader = LoadSpreader(3600, cost_aware=True)
+        keys = ["s{}".format(i) for i in range(4)]
+        for k in keys:
+            spreader.record(k, 300)
+
+        intervals = []
+        for k in keys:
+            offset = spreader.place(k, SLOT, 86400)
+            intervals.append((offset, offset + 300))
+
+        for i, (start, end) in enumerate(intervals):
+            others = intervals[:i] + intervals[i + 1:]
+            self.assertEqual(LoadSpreader.overlap(start, end, others), 0.0)
+
+    def test_overlap(self):
+        """The overlap of an interval is summed over all intervals."""
+
+        self.assertEqual(
+            LoadSpreader.overlap(10, 20, [(0, 12), (15, 16), (19, 30)]),
+            4.0
+        )
+        self.assertEqual(LoadSpreader.overlap(10, 20, [(20, 30)]), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+"""Tests for RepoLocks."""
+
+import threading
+import unittest
+
+from restic_docker_swarm_agent._internal.repolocks import RepoLocks
+
+HOST = "restic@rds-server"
+
+
+class RepoLocksTest(unittest.TestCase):
+    """Test the repository locks and host slots."""
+
+    def setUp(self):
+        """Create locks with a single slot per host."""
+
+        self.locks = RepoLocks(1)
+
+    def test_repos(self):
+        """Repositories are locked until the context exits."""
+
+        with self.locks.hold_repos(HOST, ["b", "a", "a"]):
+            self.assertTrue(self.locks.is_locked(HOST, "a"))
+            self.assertTrue(self.locks.is_locked(HOST, "b"))
+            self.assertFalse(self.locks.is_locked(HOST, "c"))
+            self.assertEqual(
+                sorted(self.locks.stats["locked_repos"]),
+                [(HOST, "a"), (HOST, "b")]
+            )
+
+        self.assertEqual(self.locks.stats["locked_repos"], [])
+
+    def test_repos_without_slot(self):
+        """Repository locks don't take a slot of the host."""
+
+        with self.locks.hold_repos(HOST, ["a"]):
+            with self.locks.hold(HOST, ["b"]):
+                self.assertFalse(
+                    self.locks.host_sem(HOST).acquire(blocking=False)
+                )
+
+    def test_slot_after_repos(self):
+        """A job waiting for a repository doesn't hold a host slot."""
+
+        waiting = threading.Event()
+        held = threading.Event()
+
+        def maintain():
+            """Hold a locked repository and a host slot."""
+
+            waiting.set()
+            with self.locks.hold(HOST, ["a"]):
+                held.set()
+
+        with self.locks.hold_repos(HOST, ["a"]):
+            thread = threading.Thread(target=maintain)
+            thread.start()
+            waiting.wait()
+            thread.join(0.2)
+
+            # The backup can still take the only slot for restic.
+            with self.locks.hold_host(HOST):
+                self.assertFalse(held.is_set())
+
+        thread.join(5)
+
+        self.assertTrue(held.is_set())
+
+
+if __name__ == "__main__":
+    unittest.main()
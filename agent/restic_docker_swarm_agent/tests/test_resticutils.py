@@ -0,0 +1,112 @@
+"""Tests for ResticUtils."""
+
+import unittest
+
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+
+REPO = "sftp:restic@rds-server:postgres-1"
+
+
+class ClassifyErrorTest(unittest.TestCase):
+    """Test the classification of restic errors by their stderr."""
+
+    def assertKind(self, kind: str, stderr: str) -> None:
+        """Check the kind of an error."""
+
+        self.assertEqual(ResticUtils.classify_error(stderr), kind, stderr)
+
+    def test_network(self):
+        """SSH and SFTP transport failures are network errors."""
+
+        for stderr in [
+            "subprocess ssh: ssh: connect to host rds-server port 2222: "
+            "Connection refused\n"
+            "Fatal: unable to open repository at {}: unable to start the "
+            "sftp session, error: EOF\n".format(REPO),
+            "subprocess ssh: ssh: Could not resolve hostname rds-server: "
+            "Name does not resolve\n"
+            "Fatal: unable to open repository at {}: unable to start the "
+            "sftp session, error: EOF\n".format(REPO),
+            "subprocess ssh: ssh: connect to host rds-server port 2222: "
+            "No route to host\n",
+            "subprocess ssh: ssh: connect to host rds-server port 2222: "
+            "Operation timed out\n",
+            "subprocess ssh: Connection reset by peer\n"
+            "Save(<data/3b2f1e0a1c>) returned error, retrying after "
+            "552.330144ms: Write: connection lost\n",
+            "subprocess ssh: Connection closed by 10.0.0.5 port 2222\n",
+            "subprocess ssh: client_loop: send disconnect: Broken pipe\n"
+            "Fatal: unable to save snapshot: Write: write |1: broken pipe\n"
+        ]:
+            self.assertKind("network", stderr)
+
+    def test_missing_repo(self):
+        """A missing repository isn't a network error."""
+
+        self.assertKind(
+            "other",
+            "Fatal: unable to open config file: Lstat: file does not "
+            "exist\nIs there a repository at the following location?\n"
+            "{}\n".format(REPO)
+        )
+
+    def test_permission_denied(self):
+        """Denied logins and file permissions are config errors."""
+
+        for stderr in [
+            "subprocess ssh: restic@rds-server: Permission denied "
+            "(publickey).\n"
+            "Fatal: unable to open repository at {}: unable to start the "
+            "sftp session, error: EOF\n".format(REPO),
+            "Fatal: create repository at {} failed: sftp: \"Permission "
+            "denied\" (SSH_FX_PERMISSION_DENIED)\n".format(REPO),
+            "subprocess ssh: Host key verification failed.\n"
+            "Fatal: unable to open repository at {}: unable to start the "
+            "sftp session, error: EOF\n".format(REPO)
+        ]:
+            self.assertKind("config", stderr)
+
+    def test_bad_arguments(self):
+        """Invalid arguments aren't network errors."""
+
+        self.assertKind("other", "unknown flag: --read-data-subet\n")
+        self.assertKind(
+            "other",
+            "Fatal: invalid argument \"1/0\" for \"--read-data-subset\" "
+            "flag: 1/0 is not a valid subset\n"
+        )
+
+    def test_locked(self):
+        """Locked repositories are recognized before other errors."""
+
+        self.assertKind(
+            "locked",
+            "subprocess ssh: Connection closed\n"
+            "Fatal: unable to create lock in backend: repository is "
+            "already locked by PID 12 on 3f1d2c4b5a6e by restic (UID 1000, "
+            "GID 1000)\nlock was created at 2026-10-17 02:00:01 (5m3s ago)"
+            "\nstorage ID 7a2c9e1f\n"
+        )
+
+    def test_repository(self):
+        """Corrupted repositories and wrong passwords are recognized."""
+
+        self.assertKind(
+            "repository",
+            "Fatal: wrong password or no key found\n"
+        )
+        self.assertKind(
+            "repository",
+            "Load(<data/5c2a3e>, 0, 0) returned error, retrying after "
+            "720.7ms: ciphertext verification failed\n"
+        )
+
+    def test_empty(self):
+        """Errors without output aren't classified."""
+
+        self.assertKind("other", "")
+        self.assertEqual(ResticUtils.classify_error(None), "other")
+
+
+if __name__ == "__main__":
+    unittest.main()
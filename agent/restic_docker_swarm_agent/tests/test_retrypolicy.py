@@ -0,0 +1,157 @@
+"""Tests for RetryPolicy and BackupResult."""
+
+import subprocess
+import unittest
+
+from docker.errors import APIError
+
+from restic_docker_swarm_agent._internal.exceptions import \
+    SwarmException, HookException, ConfigException, ResticException
+from restic_docker_swarm_agent._internal.retrypolicy import \
+    BackupResult, RetryPolicy
+
+
+def restic_error(stderr: str) -> ResticException:
+    """Get the exception raised for a failed restic process."""
+
+    try:
+        try:
+            raise subprocess.CalledProcessError(
+                1,
+                ["restic", "backup"],
+                stderr=stderr
+            )
+        except subprocess.CalledProcessError as e:
+            raise ResticException("Restic failed.") from e
+    except ResticException as e:
+        return e
+
+
+def failed(*kinds: str) -> BackupResult:
+    """Get a result with the given error kinds."""
+
+    result = BackupResult()
+    for k in kinds:
+        result.fail(k)
+
+    return result
+
+
+class RetryPolicyTest(unittest.TestCase):
+    """Test the classification of errors and the retry decisions."""
+
+    def test_classify(self):
+        """Errors are classified by their type."""
+
+        for error, kind in [
+            (HookException("Pre hook failed."), "hook"),
+            (ConfigException("Invalid label."), "config"),
+            (SwarmException("No tasks."), "docker"),
+            (APIError("Server error."), "docker"),
+            (ValueError("Invalid duration."), "config"),
+            (ResticException("No cause."), "other"),
+            (OSError("No such file."), "other")
+        ]:
+            self.assertEqual(RetryPolicy.classify(error), kind, error)
+
+    def test_classify_restic(self):
+        """Restic errors are classified by the stderr of their cause."""
+
+        self.assertEqual(
+            RetryPolicy.classify(restic_error(
+                "subprocess ssh: ssh: connect to host rds-server port 2222: "
+                "Connection refused\n"
+            )),
+            "network"
+        )
+        self.assertEqual(
+            RetryPolicy.classify(restic_error(
+                "Fatal: wrong password or no key found\n"
+            )),
+            "repository"
+        )
+
+    def test_delay(self):
+        """The delay doubles for each retry up to the maximum."""
+
+        policy = RetryPolicy(backoff=60, max_backoff=600, jitter=0)
+
+        self.assertEqual(
+            [policy.delay(i) for i in range(6)],
+            [60, 120, 240, 480, 600, 600]
+        )
+
+    def test_jitter(self):
+        """The delay deviates by at most the jitter."""
+
+        policy = RetryPolicy(backoff=100, jitter=0.1)
+
+        for _ in range(100):
+            self.assertTrue(90 <= policy.delay(0) <= 110)
+
+    def test_should_retry(self):
+        """Only transient errors are retried until the retries run out."""
+
+        policy = RetryPolicy(retries=2)
+
+        self.assertTrue(policy.should_retry(failed("network"), 0))
+        self.assertTrue(policy.should_retry(failed("docker", "locked"), 1))
+        self.assertFalse(policy.should_retry(failed("network"), 2))
+
+        self.assertEqual(policy.stats, {
+            "scheduled": 2,
+            "exhausted": 1,
+            "network": 2,
+            "docker": 1,
+            "locked": 1
+        })
+
+    def test_permanent(self):
+        """Permanent errors aren't retried even with transient ones."""
+
+        policy = RetryPolicy()
+
+        self.assertFalse(policy.should_retry(failed("network", "hook"), 0))
+        self.assertFalse(policy.should_retry(failed("repository"), 0))
+        self.assertFalse(policy.should_retry(BackupResult(), 0))
+        self.assertFalse(policy.should_retry(False, 0))
+        self.assertEqual(policy.stats["scheduled"], 0)
+
+    def test_retry_on(self):
+        """The retried error kinds can be configured."""
+
+        policy = RetryPolicy(retry_on=RetryPolicy.parse_kinds("hook, "))
+
+        self.assertTrue(policy.should_retry(failed("hook"), 0))
+        self.assertFalse(policy.should_retry(failed("network"), 0))
+
+    def test_parse_kinds(self):
+        """Unknown error kinds are rejected."""
+
+        self.assertEqual(
+            RetryPolicy.parse_kinds("network,docker"),
+            frozenset(["network", "docker"])
+        )
+        self.assertEqual(RetryPolicy.parse_kinds(""), frozenset())
+        with self.assertRaises(ValueError):
+            RetryPolicy.parse_kinds("network,timeout")
+
+
+class BackupResultTest(unittest.TestCase):
+    """Test the recording of errors."""
+
+    def test_fail(self):
+        """Recorded errors make the result falsy."""
+
+        result = BackupResult()
+        self.assertTrue(result)
+
+        self.assertEqual(result.fail("network"), "failed")
+        self.assertEqual(result.fail(HookException("Failed.")), "failed")
+
+        self.assertFalse(result)
+        self.assertEqual(result.kinds, {"network", "hook"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+"""Tests for ServiceConfigCache."""
+
+import unittest
+from typing import Dict, Optional
+
+from restic_docker_swarm_agent._internal.servicebackupconfig import \
+    ServiceConfigCache
+
+
+class FakeService:  # pylint: disable=too-few-public-methods
+    """A fake docker Service with only an ID, a name and attributes."""
+
+    def __init__(
+        self,
+        service_id: str,
+        labels: Dict[str, str],
+        version: Optional[int]
+    ):
+        """Initialize a FakeService.
+
+        :param str service_id: The service ID.
+        :param Dict[str, str] labels: The service labels.
+        :param Optional[int] version: The spec version or None.
+        """
+
+        self.id = service_id  # pylint: disable=invalid-name
+        self.name = "name-{}".format(service_id)
+        self.attrs = {"Spec": {"Labels": labels}}
+        if version is not None:
+            self.attrs["Version"] = {"Index": version}
+
+
+def labels(repos: str) -> Dict[str, str]:
+    """Get the labels of a service backed up to the given repos."""
+
+    return {
+        "rds.backup": "true",
+        "rds.backup.at": "0 2 * * *",
+        "rds.backup.repos": repos
+    }
+
+
+class ServiceConfigCacheTest(unittest.TestCase):
+    """Test that configurations are only parsed for new spec versions."""
+
+    def setUp(self):
+        """Create an empty cache."""
+
+        self.cache = ServiceConfigCache()
+
+    def test_hit(self):
+        """An unchanged spec version is parsed only once."""
+
+        cfg = self.cache.get(FakeService("s1", labels("/data"), 10))
+
+        self.assertIs(
+            self.cache.get(FakeService("s1", labels("/other"), 10)),
+            cfg
+        )
+        self.assertEqual(cfg.repos, frozenset(["/data"]))
+        self.assertEqual(cfg.version, 10)
+        self.assertEqual(
+            self.cache.stats,
+            {"hits": 1, "parses": 1, "cached": 1}
+        )
+
+    def test_new_version(self):
+        """A new spec version is parsed again."""
+
+        old = self.cache.get(FakeService("s1", labels("/data"), 10))
+        new = self.cache.get(FakeService("s1", labels("/other"), 11))
+
+        self.assertIsNot(new, old)
+        self.assertEqual(new.repos, frozenset(["/other"]))
+        self.assertIs(
+            self.cache.get(FakeService("s1", labels("/other"), 11)),
+            new
+        )
+        self.assertEqual(self.cache.stats["parses"], 2)
+
+    def test_unknown_version(self):
+        """Services without a spec version are always parsed."""
+
+        self.cache.get(FakeService("s1", labels("/data"), None))
+        cfg = self.cache.get(FakeService("s1", labels("/other"), None))
+
+        self.assertEqual(cfg.repos, frozenset(["/other"]))
+        self.assertEqual(self.cache.stats["hits"], 0)
+
+    def test_services(self):
+        """Services are cached by their ID."""
+
+        a = self.cache.get(FakeService("s1", labels("/a"), 10))
+        b = self.cache.get(FakeService("s2", labels("/b"), 10))
+
+        self.assertEqual(a.repos, frozenset(["/a"]))
+        self.assertEqual(b.repos, frozenset(["/b"]))
+        self.assertEqual(self.cache.stats["cached"], 2)
+
+    def test_errors_logged_once(self):
+        """Configuration errors are only logged once per version."""
+
+        service = FakeService("s1", {"rds.backup": "true"}, 10)
+
+        with self.assertLogs(level="ERROR") as logs:
+            cfg = self.cache.get(service)
+        self.assertEqual(len(logs.output), len(cfg.errors))
+        self.assertTrue(cfg.errors)
+
+        # Errors are only logged when a configuration is parsed.
+        self.assertIs(self.cache.get(service), cfg)
+        self.assertEqual(self.cache.stats["parses"], 1)
+
+    def test_retain(self):
+        """Removed services are dropped from the cache."""
+
+        self.cache.get(FakeService("s1", labels("/a"), 10))
+        self.cache.get(FakeService("s2", labels("/b"), 10))
+
+        self.cache.retain(["s2"])
+
+        self.assertEqual(list(self.cache.configs), ["s2"])
+        self.cache.get(FakeService("s1", labels("/a"), 10))
+        self.assertEqual(self.cache.stats["parses"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
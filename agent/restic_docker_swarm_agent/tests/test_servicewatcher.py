@@ -0,0 +1,92 @@
+"""Tests for ServiceWatcher."""
+
+import unittest
+from typing import List
+
+from restic_docker_swarm_agent._internal.servicewatcher import \
+    ServiceWatcher
+
+
+class FakeService:  # pylint: disable=too-few-public-methods
+    """A fake docker Service with only an ID and labels."""
+
+    def __init__(self, service_id: str, backup: bool):
+        """Initialize a FakeService.
+
+        :param str service_id: The service ID.
+        :param bool backup: Whether backups are enabled.
+        """
+
+        self.id = service_id  # pylint: disable=invalid-name
+        self.attrs = {
+            "Spec": {"Labels": {"rds.backup": "true" if backup else "false"}}
+        }
+
+
+class FakeServices:  # pylint: disable=too-few-public-methods
+    """The services collection of a fake DockerClient."""
+
+    def __init__(self):
+        """Initialize FakeServices."""
+
+        self.items = [FakeService("s1", True), FakeService("s2", False)]
+
+    def list(self) -> List[FakeService]:
+        """List the services."""
+
+        return list(self.items)
+
+
+class FakeClient:  # pylint: disable=too-few-public-methods
+    """A fake DockerClient with only a services collection."""
+
+    def __init__(self):
+        """Initialize a FakeClient."""
+
+        self.services = FakeServices()
+
+
+class ServiceWatcherTest(unittest.TestCase):
+    """Test the service cache and its counters."""
+
+    def setUp(self):
+        """Create a watcher which notifies the test."""
+
+        self.changes = 0
+        self.watcher = ServiceWatcher(FakeClient(), 3600, self.changed)
+
+    def changed(self) -> None:
+        """Count a change of the cache."""
+
+        self.changes += 1
+
+    def test_resync(self):
+        """Only services with backups enabled are cached."""
+
+        self.watcher.resync()
+
+        self.assertEqual([s.id for s in self.watcher.services()], ["s1"])
+        self.assertEqual(self.changes, 1)
+        self.assertEqual(self.watcher.stats["api_calls"], 1)
+        self.assertEqual(self.watcher.stats["cached_services"], 1)
+
+    def test_avoided_before_resync(self):
+        """Calls before the first resync aren't served from the cache."""
+
+        self.assertEqual(self.watcher.services(), [])
+        self.assertEqual(self.watcher.stats["api_calls_avoided"], 0)
+
+    def test_avoided(self):
+        """Only calls served from the cache are counted as avoided."""
+
+        self.watcher.resync()
+
+        self.watcher.services()
+        self.assertIsNotNone(self.watcher.get("s1"))
+        self.assertIsNone(self.watcher.get("s2"))
+
+        self.assertEqual(self.watcher.stats["api_calls_avoided"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,282 @@
+"""Tests for ShardCoordinator."""
+
+import socket
+import unittest
+from typing import Any, Dict, List, Optional
+
+from docker.errors import APIError
+
+from restic_docker_swarm_agent._internal.shardcoordinator import \
+    ShardCoordinator
+
+AGENT_SERVICE = "rds-agent"
+AGENT_SID = "agentsid"
+
+
+class FakeAPI:
+    """The low-level API of a fake DockerClient.
+
+    The tasks are given as (task ID, service ID, node ID) tuples.
+    """
+
+    def __init__(self):
+        """Initialize a FakeAPI."""
+
+        self.task_list = []
+        self.fail = False
+
+    def set_tasks(self, tasks: List[tuple], state: str = "running") -> None:
+        """Replace the task list.
+
+        :param List[tuple] tasks: The tasks.
+        :param str state: The state of all tasks.
+        """
+
+        self.task_list = [
+            {
+                "ID": task_id,
+                "ServiceID": service_id,
+                "NodeID": node_id,
+                "Status": {"State": state}
+            } for task_id, service_id, node_id in tasks
+        ]
+
+    def inspect_service(self, service: str) -> Dict[str, Any]:
+        """Inspect the agent service."""
+
+        if self.fail:
+            raise APIError("Service inspection failed.")
+        assert service == AGENT_SERVICE
+
+        return {"ID": AGENT_SID}
+
+    def tasks(self, filters: Optional[Dict[str, str]] = None) -> List[dict]:
+        """List the tasks."""
+
+        if self.fail:
+            raise APIError("Task listing failed.")
+        assert filters == {"desired-state": "running"}
+
+        return list(self.task_list)
+
+    def inspect_container(self, container: str) -> Dict[str, Any]:
+        """Inspect an agent container whose ID is its task ID."""
+
+        return {
+            "Config": {
+                "Labels": {ShardCoordinator.TASK_LABEL: container}
+            }
+        }
+
+
+class FakeClient:  # pylint: disable=too-few-public-methods
+    """A fake DockerClient with only the low-level API."""
+
+    def __init__(self, api: FakeAPI):
+        """Initialize a FakeClient.
+
+        :param FakeAPI api: The low-level API.
+        """
+
+        self.api = api
+
+
+class ShardCoordinatorTest(unittest.TestCase):
+    """Test the assignment of services to agents."""
+
+    SERVICES = ["service{}".format(i) for i in range(100)]
+
+    def setUp(self):
+        """Create a fake client without tasks."""
+
+        self.api = FakeAPI()
+        self.client = FakeClient(self.api)
+
+    def coordinator(self, task_id: Optional[str]) -> ShardCoordinator:
+        """Create a coordinator which refreshes on every call."""
+
+        return ShardCoordinator(self.client, AGENT_SERVICE, task_id, 0)
+
+    def agent_tasks(self, count: int) -> List[tuple]:
+        """Get agent tasks on the nodes node0, node1, ..."""
+
+        return [
+            ("agent{}".format(i), AGENT_SID, "node{}".format(i))
+            for i in range(count)
+        ]
+
+    def owners(self, agents: List[ShardCoordinator]) -> Dict[str, str]:
+        """Get the owner of each service and check that it's unique."""
+
+        ret = {}
+        for s in self.SERVICES:
+            owning = [a.task_id for a in agents if a.owns(s)]
+            self.assertEqual(len(owning), 1, s)
+            ret[s] = owning[0]
+
+        return ret
+
+    def test_fetch(self):
+        """Only running tasks are returned, split into agents and services."""
+
+        self.api.set_tasks(self.agent_tasks(2) + [
+            ("task0", "service0", "node0"),
+            ("task1", "service0", "node1"),
+            ("task2", "service1", "node1")
+        ])
+        self.api.task_list.append({
+            "ID": "task3",
+            "ServiceID": "service2",
+            "NodeID": "node0",
+            "Status": {"State": "starting"}
+        })
+
+        agents, service_nodes = self.coordinator("agent0").fetch()
+
+        self.assertEqual(agents, {"agent0": "node0", "agent1": "node1"})
+        self.assertEqual(service_nodes, {
+            "service0": {"node0", "node1"},
+            "service1": {"node1"}
+        })
+
+    def test_agents_agree(self):
+        """Every service is owned by exactly one agent."""
+
+        self.api.set_tasks(self.agent_tasks(3))
+        agents = [self.coordinator("agent{}".format(i)) for i in range(3)]
+
+        owners = self.owners(agents)
+
+        self.assertEqual(set(owners.values()), {"agent0", "agent1", "agent2"})
+
+    def test_task_id_from_container(self):
+        """The task ID is read from the agent container by default."""
+
+        self.api.set_tasks(self.agent_tasks(1))
+        coordinator = self.coordinator(None)
+        coordinator.refresh()
+
+        self.assertEqual(coordinator.task_id, socket.gethostname())
+        self.assertIn(socket.gethostname(), coordinator.stats["members"])
+
+    def test_node_preference(self):
+        """Services are owned by the agent on the node of their task."""
+
+        tasks = self.agent_tasks(3)
+        for i, s in enumerate(self.SERVICES):
+            tasks.append(("task{}".format(i), s, "node{}".format(i % 3)))
+        self.api.set_tasks(tasks)
+        agents = [self.coordinator("agent{}".format(i)) for i in range(3)]
+
+        owners = self.owners(agents)
+
+        for i, s in enumerate(self.SERVICES):
+            self.assertEqual(owners[s], "agent{}".format(i % 3))
+
+    def test_node_without_agent(self):
+        """Services on nodes without an agent are still owned."""
+
+        self.api.set_tasks(self.agent_tasks(2) + [
+            ("task0", "service0", "node9")
+        ])
+        agents = [self.coordinator("agent{}".format(i)) for i in range(2)]
+
+        owners = self.owners(agents)
+
+        self.assertIn(owners["service0"], {"agent0", "agent1"})
+
+    def test_agent_leaves(self):
+        """Only the services of a leaving agent move."""
+
+        self.api.set_tasks(self.agent_tasks(4))
+        agents = [self.coordinator("agent{}".format(i)) for i in range(4)]
+        before = self.owners(agents)
+
+        self.api.set_tasks(self.agent_tasks(3))
+        after = self.owners(agents[:3])
+
+        for s in self.SERVICES:
+            if before[s] != "agent3":
+                self.assertEqual(before[s], after[s], s)
+            else:
+                self.assertNotEqual(after[s], "agent3", s)
+
+    def test_agent_joins(self):
+        """Only services taken over by a joining agent move."""
+
+        self.api.set_tasks(self.agent_tasks(3))
+        agents = [self.coordinator("agent{}".format(i)) for i in range(4)]
+        before = self.owners(agents[:3])
+
+        self.api.set_tasks(self.agent_tasks(4))
+        after = self.owners(agents)
+
+        moved = [s for s in self.SERVICES if before[s] != after[s]]
+        self.assertTrue(moved)
+        for s in moved:
+            self.assertEqual(after[s], "agent3", s)
+
+    def test_agent_joins_node(self):
+        """A joining agent takes over all services on its node."""
+
+        services = [
+            ("task{}".format(i), s, "node{}".format(i % 4))
+            for i, s in enumerate(self.SERVICES)
+        ]
+        self.api.set_tasks(self.agent_tasks(3) + services)
+        agents = [self.coordinator("agent{}".format(i)) for i in range(4)]
+        before = self.owners(agents[:3])
+
+        self.api.set_tasks(self.agent_tasks(4) + services)
+        after = self.owners(agents)
+
+        for i, s in enumerate(self.SERVICES):
+            if i % 4 == 3:
+                self.assertEqual(after[s], "agent3", s)
+            else:
+                self.assertEqual(before[s], after[s], s)
+
+    def test_service_moves_node(self):
+        """A service moves with its tasks to the agent on their node."""
+
+        self.api.set_tasks(self.agent_tasks(3) + [
+            ("task0", "service0", "node0")
+        ])
+        agents = [self.coordinator("agent{}".format(i)) for i in range(3)]
+
+        self.assertEqual(self.owners(agents)["service0"], "agent0")
+
+        self.api.set_tasks(self.agent_tasks(3) + [
+            ("task1", "service0", "node2")
+        ])
+
+        self.assertEqual(self.owners(agents)["service0"], "agent2")
+
+    def test_refresh_failure_keeps_members(self):
+        """The previous members are kept if the refresh fails."""
+
+        self.api.set_tasks(self.agent_tasks(2))
+        coordinator = self.coordinator("agent0")
+        owned = [s for s in self.SERVICES if coordinator.owns(s)]
+
+        self.api.fail = True
+
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(
+                [s for s in self.SERVICES if coordinator.owns(s)],
+                owned
+            )
+        self.assertEqual(coordinator.stats["agents"], 2)
+
+    def test_unknown_members(self):
+        """All services are owned if the members are unknown."""
+
+        self.api.fail = True
+        coordinator = self.coordinator("agent0")
+
+        with self.assertLogs(level="ERROR"):
+            self.assertTrue(all(coordinator.owns(s) for s in self.SERVICES))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+"""Benchmark the overhead of spawning restic commands.
+
+Compares running restic through a shell with a command line which is
+rebuilt for every invocation, the way ResticWrapper did before, with
+running a cached argv command from ResticCommandBuilder directly.
+Restic is replaced by /bin/true so that only the spawn overhead is
+measured. Run from the repository root:
+
+    PYTHONPATH=agent/restic_docker_swarm_agent \\
+        python3 benchmarks/restic_spawn.py -n 1000
+"""
+
+import time
+import shutil
+import argparse
+import subprocess
+from typing import Callable, List
+
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+from restic_docker_swarm_agent._internal.resticcommand import \
+    ResticCommandBuilder
+
+HOST = "backup@sftp.example.com"
+PORT = 2222
+SSH_OPTS = [
+    "-o UserKnownHostsFile=/run/secrets/known_hosts",
+    "-i /run/secrets/id_rsa"
+]
+RESTIC_ARGS = ["--password-file /run/secrets/restic_password"]
+
+
+def legacy_command(true: str, repo: str) -> str:
+    """Build a shell command line like ResticWrapper used to.
+
+    :param str true: The path of the true binary used instead of restic.
+    :param str repo: The repository path.
+
+    :return: The command line.
+    :rtype: str
+    """
+
+    ssh_cmd = ["ssh", HOST] + SSH_OPTS + ["-p", str(PORT), "-s", "sftp"]
+    cmd = [
+        true,
+        "-o", "sftp.command='{}'".format(" ".join(ssh_cmd)),
+        "-r", ResticUtils.full_repo(HOST, repo)
+    ] + RESTIC_ARGS + ["cat", "config"]
+
+    return " ".join(cmd)
+
+
+def run_legacy(true: str, repo: str) -> None:
+    """Run one command through a shell.
+
+    :param str true: The path of the true binary used instead of restic.
+    :param str repo: The repository path.
+    """
+
+    subprocess.run(
+        legacy_command(true, repo),
+        check=True,
+        shell=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+
+
+def run_argv(builder: ResticCommandBuilder, true: str, repo: str) -> None:
+    """Run one cached argv command without a shell.
+
+    :param ResticCommandBuilder builder: The command builder.
+    :param str true: The path of the true binary used instead of restic.
+    :param str repo: The repository path.
+    """
+
+    cmd = builder.command(repo)
+    cmd[0] = true
+    cmd.extend(["cat", "config"])
+
+    subprocess.run(
+        cmd,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+
+
+def measure(func: Callable[[], None], count: int) -> float:
+    """Call a function repeatedly and measure the total time.
+
+    :param Callable[[], None] func: The function to call.
+    :param int count: The number of calls.
+
+    :return: The total time in seconds.
+    :rtype: float
+    """
+
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+
+    return time.perf_counter() - start
+
+
+def format_times(times: List[float]) -> str:
+    """Format the times of all rounds.
+
+    :param List[float] times: The times in seconds.
+
+    :return: The minimum and maximum time.
+    :rtype: str
+    """
+
+    return "{:.2f}-{:.2f}s".format(min(times), max(times))
+
+
+def main() -> None:
+    """Run the benchmark and print the results."""
+
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument(
+        "-n",
+        "--count",
+        type=int,
+        default=1000,
+        help="Number of invocations per variant."
+    )
+    ap.add_argument(
+        "-r",
+        "--rounds",
+        type=int,
+        default=3,
+        help="Number of rounds per variant."
+    )
+    args = ap.parse_args()
+
+    true = shutil.which("true")
+    builder = ResticCommandBuilder(HOST, PORT, SSH_OPTS, RESTIC_ARGS)
+    variants = [
+        ("shell=True, rebuilt per call", lambda: run_legacy(true, "repo")),
+        ("argv, cached command", lambda: run_argv(builder, true, "repo"))
+    ]
+
+    print("{} invocations, {} rounds:".format(args.count, args.rounds))
+    for name, func in variants:
+        times = [measure(func, args.count) for _ in range(args.rounds)]
+        print("  {:<30} {}".format(name, format_times(times)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""Benchmark scanning a large number of services in the scheduler.
+
+Compares the service scan of BackupScheduler, which checks for pending
+backups in the keyed BackupQueue, with the previous scan which looked
+for the service in sched.scheduler.queue. The first scan schedules a
+backup for every service and the steady-state scan finds all of them
+already scheduled. Run from the repository root:
+
+    PYTHONPATH=agent/restic_docker_swarm_agent \\
+        python3 benchmarks/scheduler_scan.py -n 10000
+"""
+
+import sys
+import time
+import sched
+import logging
+import argparse
+from datetime import datetime
+from typing import Any, List, Tuple
+
+from croniter import croniter
+
+from restic_docker_swarm_agent._internal.backupscheduler import \
+    BackupScheduler
+from restic_docker_swarm_agent._internal.resticutils import ResticUtils
+
+
+class FakeService:  # pylint: disable=too-few-public-methods
+    """A synthetic service with backup labels."""
+
+    def __init__(self, index: int):
+        """Initialize a FakeService.
+
+        :param int index: The index of the service.
+        """
+
+        self.id = "service{:05d}".format(index)
+        self.name = "stack_service{}".format(index)
+        self.attrs = {
+            "Version": {"Index": 1},
+            "Spec": {
+                "Labels": {
+                    "rds.backup": "true",
+                    "rds.backup.at": "{} {} * * *".format(
+                        index % 60,
+                        index // 60 % 24
+                    ),
+                    "rds.backup.repos": self.name
+                }
+            }
+        }
+
+
+class FakeServices:  # pylint: disable=too-few-public-methods
+    """The services API of a fake DockerClient."""
+
+    def __init__(self, services: List[FakeService]):
+        """Initialize FakeServices.
+
+        :param List[FakeService] services: The services to list.
+        """
+
+        self.services = services
+
+    def list(self) -> List[FakeService]:
+        """List all services.
+
+        :return: The services.
+        :rtype: List[FakeService]
+        """
+
+        return self.services
+
+
+class FakeClient:  # pylint: disable=too-few-public-methods
+    """A fake DockerClient which only lists services."""
+
+    def __init__(self, services: List[FakeService]):
+        """Initialize a FakeClient.
+
+        :param List[FakeService] services: The services to list.
+        """
+
+        self.services = FakeServices(services)
+
+
+class LegacyScheduler:
+    """The service scan of the scheduler before BackupQueue."""
+
+    def __init__(self, services: List[FakeService]):
+        """Initialize a LegacyScheduler.
+
+        :param List[FakeService] services: The services to scan.
+        """
+
+        self.services = services
+        self.backup_sched = sched.scheduler(time.time, time.sleep)
+
+    def do_backup(self, service: FakeService, scheduled: float) -> None:
+        """Do nothing. The events are never run."""
+
+    def scan_services(self) -> None:
+        """Schedule backups for services which have none scheduled."""
+
+        for s in self.services:
+            skip = False
+            for ev in self.backup_sched.queue:
+                if "service" in ev.kwargs and ev.kwargs["service"].id == s.id:
+                    skip = True
+
+            if skip:
+                continue
+
+            run_at = ResticUtils.service_backup_at(s)
+            criter = croniter(run_at, datetime.now().astimezone())
+            ts = criter.get_next(float)
+            self.backup_sched.enterabs(
+                ts,
+                BackupScheduler.BACKUP_PRIORITY,
+                self.do_backup,
+                [],
+                {"service": s, "scheduled": ts}
+            )
+
+
+def measure(scheduler: Any) -> Tuple[float, float]:
+    """Measure the first and the steady-state scan of a scheduler.
+
+    :param Any scheduler: The scheduler.
+
+    :return: The durations of both scans in seconds.
+    :rtype: Tuple[float, float]
+    """
+
+    ret = []
+    for _ in range(2):
+        start = time.perf_counter()
+        scheduler.scan_services()
+        ret.append(time.perf_counter() - start)
+
+    return ret[0], ret[1]
+
+
+def main() -> None:
+    """Run the benchmark and print the results."""
+
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument(
+        "-n",
+        "--services",
+        type=int,
+        default=10000,
+        help="Number of synthetic services."
+    )
+    ap.add_argument(
+        "--skip-legacy",
+        action="store_true",
+        help="Only measure the current scheduler. The previous scheduler "
+             "takes minutes with 10,000 services."
+    )
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    services = [FakeService(i) for i in range(args.services)]
+
+    schedulers = []
+    if not args.skip_legacy:
+        schedulers.append(("sched.scheduler", LegacyScheduler(services)))
+    schedulers.append(("BackupQueue", BackupScheduler(
+        FakeClient(services),
+        lambda service, config: True
+    )))
+
+    results = [(name, measure(x)) for name, x in schedulers]
+
+    print("{} services:".format(args.services))
+    print("  {:<16} {:>12} {:>18}".format(
+        "",
+        "first scan",
+        "steady-state scan"
+    ))
+    for name, (first, steady) in results:
+        print("  {:<16} {:>11.3f}s {:>17.3f}s".format(name, first, steady))
+
+
+if __name__ == "__main__":
+    main()